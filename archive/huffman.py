@@ -7,6 +7,7 @@ from sortedcontainers import SortedList
 
 from library.fmt import print_separator, printf, single_quoted
 from library.math import min_max_average
+from library.profiler import span
 from library.utils import to_machine_size, to_human_size
 
 
@@ -177,23 +178,25 @@ def extract_data_count(node: Node):
 
 def scan_buffer(buffer_info: BufferInfo, data_bits: int, logger: logging.Logger = None):
     logger = logger or logging.root
-    buffer = get_buffer(buffer_info, logger)
+    with span('scan buffer'):
+        with span('reading'):
+            buffer = get_buffer(buffer_info, logger)
 
-    logger.info('counting data...')
-    data_count_dict, remaining = count_data_width(buffer, data_bits)
+        with span('counting data'):
+            data_count_dict, remaining = count_data_width(buffer, data_bits)
 
-    logger.info('sorting...')
-    data_count_list = SortedList(
-        (DataCount(key, value) for key, value in data_count_dict.items()), key=lambda item: item.count)
+        with span('sorting'):
+            data_count_list = SortedList(
+                (DataCount(key, value) for key, value in data_count_dict.items()), key=lambda item: item.count)
 
-    logger.info('pairing...')
-    root = pair_counts(data_count_list)
+        with span('pairing'):
+            root = pair_counts(data_count_list)
 
-    logger.info('setting codecs...')
-    set_tree_codecs(root)
+        with span('setting codecs'):
+            set_tree_codecs(root)
 
-    logger.info('extracting data count...')
-    codec_list = extract_data_count(root)
+        with span('extracting data count'):
+            codec_list = extract_data_count(root)
 
     assert len(codec_list) == len(data_count_dict), f'{len(codec_list)} != {len(data_count_dict)}'
 
@@ -0,0 +1,183 @@
+import hashlib
+import math
+import mmap
+import os
+from typing import Iterable
+
+from library.sio import FileWrapper
+
+BLOOM_MAGIC = b'BLMF'
+BLOOM_VERSION = 1
+DEFAULT_FP_RATE = 0.01
+# header size, the bits start here
+HEADER_SIZE = 64
+# places of the fields that change in a mapped filter
+COUNT_OFFSET = 40
+STALE_OFFSET = 48
+
+version_settings = {
+    'size': 1,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+field_settings = {
+    'size': 8,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+
+def optimal_bits(capacity: int, fp_rate: float):
+    """bits for `capacity` items at a false positive rate of `fp_rate`"""
+    return max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+
+
+def optimal_hashes(capacity: int, bits: int):
+    return max(1, round(bits / max(capacity, 1) * math.log(2)))
+
+
+def _positions(item: bytes, bits: int, hashes: int):
+    # double hashing: h1 + i * h2
+    digest = hashlib.blake2b(item, digest_size=16).digest()
+    first = int.from_bytes(digest[:8], 'little')
+    second = int.from_bytes(digest[8:], 'little') | 1
+    return [(first + step * second) % bits for step in range(hashes)]
+
+
+class BloomFilter:
+    """
+    set of bytes without false negatives, sized for `capacity` items at `fp_rate`.
+    items can't be removed, a filter is rebuilt instead.
+    a filter file is mapped & shared: bits added by one process are seen by the others right away.
+    a file that was replaced by a rebuilt one is marked `stale`, whoever maps it should open the new one.
+    """
+    __slots__ = '_buffer', '_bits', '_hashes', '_capacity', '_fp_rate', '_count'
+
+    def __init__(self, capacity: int, fp_rate: float = DEFAULT_FP_RATE, buffer=None, bits: int = None,
+                 hashes: int = None):
+        if capacity <= 0:
+            raise ValueError(f'invalid capacity: {capacity}')
+        if not 0 < fp_rate < 1:
+            raise ValueError(f'invalid false positive rate: {fp_rate}')
+        self._capacity = capacity
+        self._fp_rate = fp_rate
+        self._bits = bits or optimal_bits(capacity, fp_rate)
+        self._hashes = hashes or optimal_hashes(capacity, self._bits)
+        self._count = 0
+        if buffer is None:
+            buffer = bytearray(HEADER_SIZE + (self._bits + 7) // 8)
+        self._buffer = buffer
+
+    def __repr__(self):
+        return f'BloomFilter({self._capacity}, {self._fp_rate}, count={self.count})'
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def fp_rate(self):
+        return self._fp_rate
+
+    @property
+    def bits(self):
+        return self._bits
+
+    @property
+    def hashes(self):
+        return self._hashes
+
+    @property
+    def count(self):
+        """items added that set a new bit: a key added again isn't counted, nor are (rarely) false positives"""
+        if isinstance(self._buffer, mmap.mmap):
+            return int.from_bytes(self._buffer[COUNT_OFFSET:COUNT_OFFSET + 8], 'big')
+        return self._count
+
+    @property
+    def stale(self):
+        return isinstance(self._buffer, mmap.mmap) and self._buffer[STALE_OFFSET] != 0
+
+    def estimated_fp_rate(self):
+        """by the items added so far"""
+        return (1 - math.exp(-self._hashes * self.count / self._bits)) ** self._hashes
+
+    def __contains__(self, item: bytes):
+        buffer = self._buffer
+        for position in _positions(item, self._bits, self._hashes):
+            if not buffer[HEADER_SIZE + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, item: bytes):
+        """returns False if the item was already in (or a false positive)"""
+        buffer = self._buffer
+        added = False
+        for position in _positions(item, self._bits, self._hashes):
+            index = HEADER_SIZE + (position >> 3)
+            bit = 1 << (position & 7)
+            if not buffer[index] & bit:
+                buffer[index] |= bit
+                added = True
+        if not added:
+            return False
+        count = self.count + 1
+        if isinstance(buffer, mmap.mmap):
+            buffer[COUNT_OFFSET:COUNT_OFFSET + 8] = count.to_bytes(8, 'big')
+        else:
+            self._count = count
+        return True
+
+    def update(self, items: Iterable[bytes]):
+        for item in items:
+            self.add(item)
+
+    # files
+
+    def write(self, path: str):
+        """the header, then the bits"""
+        with FileWrapper.open(path, 'wb') as wrapper:
+            total = wrapper.write_bytes(BLOOM_MAGIC)  # magic
+            total += wrapper.write_int(BLOOM_VERSION, **version_settings)  # version
+            total += wrapper.write_bytes(bytes(3))  # padding
+            total += wrapper.write_int(self._capacity, **field_settings)  # capacity
+            total += wrapper.write_int(round(self._fp_rate * 1e15), **field_settings)  # fp rate
+            total += wrapper.write_int(self._bits, **field_settings)  # bits
+            total += wrapper.write_int(self._hashes, **field_settings)  # hashes
+            total += wrapper.write_int(self.count, **field_settings)  # count
+            total += wrapper.write_int(0, **field_settings)  # stale
+            total += wrapper.write_bytes(bytes(HEADER_SIZE - total))  # padding
+            total += wrapper.write_bytes(memoryview(self._buffer)[HEADER_SIZE:])  # bits
+            wrapper.file.flush()
+            os.fsync(wrapper.file.fileno())
+        return total
+
+    @staticmethod
+    def open(path: str):
+        """maps a filter file for reading & adding"""
+        with FileWrapper.open(path, 'r+b') as wrapper:
+            magic = wrapper.read_bytes(len(BLOOM_MAGIC))  # magic
+            if magic != BLOOM_MAGIC:
+                raise ValueError(f'unsupported bloom filter magic: {magic!r}')
+            version = wrapper.read_int(**version_settings)  # version
+            if version != BLOOM_VERSION:
+                raise ValueError(f'unsupported bloom filter version: {version}')
+            wrapper.read_bytes(3)  # padding
+            capacity = wrapper.read_int(**field_settings)  # capacity
+            fp_rate = wrapper.read_int(**field_settings) / 1e15  # fp rate
+            bits = wrapper.read_int(**field_settings)  # bits
+            hashes = wrapper.read_int(**field_settings)  # hashes
+            buffer = mmap.mmap(wrapper.file.fileno(), 0)
+        result = BloomFilter(capacity, fp_rate, buffer, bits, hashes)
+        if len(buffer) < HEADER_SIZE + (bits + 7) // 8:
+            buffer.close()
+            raise ValueError(f'corrupted bloom filter: {path}')
+        return result
+
+    def mark_stale(self):
+        self._buffer[STALE_OFFSET] = 1
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
@@ -0,0 +1,281 @@
+import io
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Sequence, Dict, Tuple, Iterable
+
+from library.compression import Transform
+from library.sio import FileWrapper
+from library.utils import StopWatch
+
+DEFAULT_BLOCK_SIZE = 1 << 18
+STAGES = 'suffix_array', 'bwt', 'mtf'
+
+
+def _as_view(buffer) -> memoryview:
+    view = memoryview(buffer)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
+# suffix array (SA-IS)
+
+def _sa_is(text: Sequence[int], upper: int) -> List[int]:
+    length = len(text)
+    if length == 0:
+        return []
+    if length == 1:
+        return [0]
+    if length == 2:
+        return [0, 1] if text[0] < text[1] else [1, 0]
+
+    suffix_array = [0] * length
+    is_s = [False] * length
+    for index in range(length - 2, -1, -1):
+        is_s[index] = is_s[index + 1] if text[index] == text[index + 1] else text[index] < text[index + 1]
+
+    # bucket starts for L & S types
+    sum_l = [0] * (upper + 1)
+    sum_s = [0] * (upper + 1)
+    for index in range(length):
+        if not is_s[index]:
+            sum_s[text[index]] += 1
+        else:
+            sum_l[text[index] + 1] += 1
+    for index in range(upper + 1):
+        sum_s[index] += sum_l[index]
+        if index < upper:
+            sum_l[index + 1] += sum_s[index]
+
+    def induce(lms: Iterable[int]):
+        for _index in range(length):
+            suffix_array[_index] = -1
+        bucket = sum_s[:]
+        for position in lms:
+            if position == length:
+                continue
+            suffix_array[bucket[text[position]]] = position
+            bucket[text[position]] += 1
+        bucket = sum_l[:]
+        suffix_array[bucket[text[length - 1]]] = length - 1
+        bucket[text[length - 1]] += 1
+        for _index in range(length):
+            value = suffix_array[_index]
+            if value >= 1 and not is_s[value - 1]:
+                suffix_array[bucket[text[value - 1]]] = value - 1
+                bucket[text[value - 1]] += 1
+        bucket = sum_l[:]
+        for _index in range(length - 1, -1, -1):
+            value = suffix_array[_index]
+            if value >= 1 and is_s[value - 1]:
+                bucket[text[value - 1] + 1] -= 1
+                suffix_array[bucket[text[value - 1] + 1]] = value - 1
+
+    lms_map = [-1] * (length + 1)
+    lms = []
+    for index in range(1, length):
+        if not is_s[index - 1] and is_s[index]:
+            lms_map[index] = len(lms)
+            lms.append(index)
+    induce(lms)
+
+    if lms:
+        # name the sorted LMS substrings, then sort them recursively
+        sorted_lms = [value for value in suffix_array if lms_map[value] != -1]
+        reduced = [0] * len(lms)
+        reduced_upper = 0
+        for index in range(1, len(lms)):
+            left, right = sorted_lms[index - 1], sorted_lms[index]
+            end_left = lms[lms_map[left] + 1] if lms_map[left] + 1 < len(lms) else length
+            end_right = lms[lms_map[right] + 1] if lms_map[right] + 1 < len(lms) else length
+            same = end_left - left == end_right - right
+            if same:
+                while left < end_left and text[left] == text[right]:
+                    left += 1
+                    right += 1
+                same = left != length and text[left] == text[right]
+            if not same:
+                reduced_upper += 1
+            reduced[lms_map[sorted_lms[index]]] = reduced_upper
+        reduced_suffix_array = _sa_is(reduced, reduced_upper)
+        induce([lms[index] for index in reduced_suffix_array])
+
+    return suffix_array
+
+
+def suffix_array(buffer) -> List[int]:
+    """linear time suffix array (SA-IS) of a bytes-like buffer"""
+    return _sa_is(_as_view(buffer), 255)
+
+
+# burrows-wheeler transform
+
+def bwt(buffer, suffixes: List[int] = None) -> Tuple[bytes, int]:
+    """returns the last column without the end marker, and the row the marker was removed from"""
+    text = _as_view(buffer)
+    if len(text) == 0:
+        return b'', 0
+    suffixes = suffix_array(text) if suffixes is None else suffixes
+    result = bytearray(len(text))
+    result[0] = text[-1]
+    primary = 0
+    index = 1
+    for position in suffixes:
+        if position == 0:
+            primary = index
+            continue
+        result[index] = text[position - 1]
+        index += 1
+    return bytes(result), primary
+
+
+def inverse_bwt(buffer, primary: int) -> bytes:
+    data = _as_view(buffer)
+    length = len(data)
+    if length == 0:
+        return b''
+    starts = [0] * 256
+    for value in data:
+        starts[value] += 1
+    total = 1  # end marker is the smallest
+    for value in range(256):
+        starts[value], total = total, total + starts[value]
+
+    # LF mapping over the rows, marker row maps to the first row
+    last_first = [0] * (length + 1)
+    row = 0
+    for value in data:
+        if row == primary:
+            row += 1
+        last_first[row] = starts[value]
+        starts[value] += 1
+        row += 1
+
+    result = bytearray(length)
+    row = 0
+    for index in range(length - 1, -1, -1):
+        result[index] = data[row - 1 if row > primary else row]
+        row = last_first[row]
+    return bytes(result)
+
+
+# move to front
+
+def mtf_encode(buffer) -> bytes:
+    table = bytearray(range(256))
+    result = bytearray(len(buffer))
+    find, remove, insert = table.index, table.__delitem__, table.insert
+    for position, value in enumerate(_as_view(buffer)):
+        index = find(value)
+        if index:
+            result[position] = index
+            remove(index)
+            insert(0, value)
+    return bytes(result)
+
+
+def mtf_decode(buffer) -> bytes:
+    table = bytearray(range(256))
+    result = bytearray(len(buffer))
+    remove, insert = table.__delitem__, table.insert
+    for position, index in enumerate(_as_view(buffer)):
+        value = table[index]
+        result[position] = value
+        if index:
+            remove(index)
+            insert(0, value)
+    return bytes(result)
+
+
+# blocks
+
+@dataclass(init=True, repr=True, eq=True)
+class BWTBlock:
+    __slots__ = 'primary', 'data'
+    primary: int
+    data: bytes
+
+    def write(self, wrapper: FileWrapper):
+        total = wrapper.write_big_int(self.primary, signed=False)  # primary
+        total += wrapper.write_big_int(len(self.data), signed=False)  # data size
+        return total + wrapper.write_bytes(self.data)  # data
+
+    @staticmethod
+    def read(wrapper: FileWrapper):
+        primary = wrapper.read_big_int(signed=False)  # primary
+        size = wrapper.read_big_int(signed=False)  # data size
+        data = wrapper.read_bytes(size)  # data
+        if len(data) != size:
+            raise EOFError(f'while reading {size} bytes bwt block')
+        return BWTBlock(primary, data)
+
+
+def encode_block(buffer) -> Tuple[BWTBlock, List[float]]:
+    """BWT + MTF of one block, with the time spent in each of `STAGES`"""
+    stop_watch = StopWatch(start=True)
+    suffixes = suffix_array(buffer)
+    stop_watch.lap()
+    data, primary = bwt(buffer, suffixes)
+    stop_watch.lap()
+    data = mtf_encode(data)
+    stop_watch.lap()
+    return BWTBlock(primary, data), stop_watch.differences
+
+
+def decode_block(block: BWTBlock) -> bytes:
+    return inverse_bwt(mtf_decode(block.data), block.primary)
+
+
+def _split_blocks(view: memoryview, block_size: int):
+    return [view[start: start + block_size] for start in range(0, len(view), block_size)]
+
+
+def transform(buffer, block_size: int = DEFAULT_BLOCK_SIZE, workers: int = None) \
+        -> Tuple[List[BWTBlock], Dict[str, float]]:
+    """
+    split `buffer` into blocks and BWT + MTF them, in `workers` processes when it's not 1.
+    timings are summed over the blocks, so with several workers they are CPU time rather than wall time.
+    """
+    blocks = _split_blocks(_as_view(buffer), block_size)
+    if workers == 1 or len(blocks) <= 1:
+        results = [encode_block(block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(encode_block, map(bytes, blocks)))
+
+    timings = defaultdict(float)
+    for block, differences in results:
+        for stage, difference in zip(STAGES, differences):
+            timings[stage] += difference
+    return [block for block, differences in results], dict(timings)
+
+
+def inverse_transform(blocks: List[BWTBlock], workers: int = None) -> bytes:
+    if workers == 1 or len(blocks) <= 1:
+        return b''.join(map(decode_block, blocks))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return b''.join(executor.map(decode_block, blocks))
+
+
+class BWTTransform(Transform):
+    __slots__ = 'block_size', 'workers'
+
+    def __init__(self, stage_id: int, name: str, block_size: int = DEFAULT_BLOCK_SIZE, workers: int = 1):
+        super().__init__(stage_id, name)
+        self.block_size = block_size
+        self.workers = workers
+
+    def encode(self, view: memoryview):
+        blocks, timings = transform(view, self.block_size, self.workers)
+        outfile = io.BytesIO()
+        wrapper = FileWrapper(outfile)
+        wrapper.write_big_int(len(blocks), signed=False)  # blocks number
+        for block in blocks:
+            block.write(wrapper)  # block
+        return outfile.getbuffer()
+
+    def decode(self, view: memoryview):
+        wrapper = FileWrapper(io.BytesIO(view))
+        blocks = [BWTBlock.read(wrapper) for step in range(wrapper.read_big_int(signed=False))]
+        return inverse_transform(blocks, self.workers)
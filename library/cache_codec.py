@@ -0,0 +1,156 @@
+import bz2
+import lzma
+import zlib
+from typing import Dict, Union
+
+from library.compression import Pipeline, get_pipeline
+from library.sio import BufferType
+
+# ids of `library.compression` pipelines are shifted by this
+PIPELINE_CODEC_OFFSET = 256
+DECOMPRESS_CHUNK_SIZE = 1 << 16
+
+DEFAULT_MIN_SIZE = 512
+DEFAULT_MAX_RATIO = 0.9
+SAMPLE_SIZE = 4096
+SAMPLE_COUNT = 3
+
+
+class ValueCodec:
+    """compression of cached values, `decompress_into` fills a caller's buffer chunk by chunk"""
+    __slots__ = 'codec_id', 'name'
+
+    def __init__(self, codec_id: int, name: str):
+        self.codec_id = codec_id
+        self.name = name
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.codec_id}, {self.name!r})'
+
+    def compress(self, buffer: BufferType) -> BufferType:
+        raise NotImplementedError
+
+    def decompress(self, buffer: BufferType) -> BufferType:
+        raise NotImplementedError
+
+    def decompress_into(self, buffer: BufferType, out) -> int:
+        """returns the number of bytes written to `out`"""
+        data = self.decompress(buffer)
+        memoryview(out)[:len(data)] = data
+        return len(data)
+
+
+class ZlibCodec(ValueCodec):
+    __slots__ = 'level',
+
+    def __init__(self, codec_id: int, name: str, level: int = 6):
+        super().__init__(codec_id, name)
+        self.level = level
+
+    def compress(self, buffer: BufferType):
+        return zlib.compress(buffer, self.level)
+
+    def decompress(self, buffer: BufferType):
+        return zlib.decompress(buffer)
+
+    def decompress_into(self, buffer: BufferType, out):
+        view = memoryview(out)
+        decompressor = zlib.decompressobj()
+        data = buffer
+        position = 0
+        while position < len(view):
+            chunk = decompressor.decompress(data, min(DECOMPRESS_CHUNK_SIZE, len(view) - position))
+            if not chunk:
+                break
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+            data = decompressor.unconsumed_tail
+        return position
+
+
+class StreamCodec(ValueCodec):
+    """bz2 & lzma, their decompressors keep the unconsumed input themselves"""
+    __slots__ = '_compress', '_decompress', '_decompressor'
+
+    def __init__(self, codec_id: int, name: str, compress, decompress, decompressor):
+        super().__init__(codec_id, name)
+        self._compress = compress
+        self._decompress = decompress
+        self._decompressor = decompressor
+
+    def compress(self, buffer: BufferType):
+        return self._compress(buffer)
+
+    def decompress(self, buffer: BufferType):
+        return self._decompress(buffer)
+
+    def decompress_into(self, buffer: BufferType, out):
+        view = memoryview(out)
+        decompressor = self._decompressor()
+        data = buffer
+        position = 0
+        while position < len(view) and not decompressor.eof:
+            chunk = decompressor.decompress(data, min(DECOMPRESS_CHUNK_SIZE, len(view) - position))
+            data = b''
+            if not chunk:
+                break
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return position
+
+
+class PipelineCodec(ValueCodec):
+    __slots__ = 'pipeline',
+
+    def __init__(self, pipeline: Pipeline):
+        super().__init__(PIPELINE_CODEC_OFFSET + pipeline.pipeline_id, pipeline.name)
+        self.pipeline = pipeline
+
+    def compress(self, buffer: BufferType):
+        return self.pipeline.encode(buffer)
+
+    def decompress(self, buffer: BufferType):
+        return self.pipeline.decode(buffer)
+
+
+codecs: Dict[int, ValueCodec] = {}
+_codec_names: Dict[str, ValueCodec] = {}
+
+
+def register_codec(codec: ValueCodec):
+    if codec.codec_id in codecs:
+        raise ValueError(f'codec id is already registered: {codec.codec_id}')
+    if codec.name in _codec_names:
+        raise ValueError(f'codec name is already registered: {codec.name!r}')
+    codecs[codec.codec_id] = _codec_names[codec.name] = codec
+    return codec
+
+
+def get_codec(codec: Union[ValueCodec, int, str]) -> ValueCodec:
+    """by instance, id or name, ids & names of `library.compression` pipelines work too"""
+    if isinstance(codec, ValueCodec):
+        return codec
+    found = codecs.get(codec) if isinstance(codec, int) else _codec_names.get(codec)
+    if found is not None:
+        return found
+    if isinstance(codec, int):
+        if codec < PIPELINE_CODEC_OFFSET:
+            raise ValueError(f'unsupported codec: {codec!r}')
+        codec -= PIPELINE_CODEC_OFFSET
+    return register_codec(PipelineCodec(get_pipeline(codec)))
+
+
+ZLIB = register_codec(ZlibCodec(1, 'zlib'))
+BZ2 = register_codec(StreamCodec(2, 'bz2', bz2.compress, bz2.decompress, bz2.BZ2Decompressor))
+LZMA = register_codec(StreamCodec(3, 'lzma', lzma.compress, lzma.decompress, lzma.LZMADecompressor))
+
+
+def is_compressible(buffer: BufferType, max_ratio: float = DEFAULT_MAX_RATIO):
+    """cheap estimate: fast zlib over a few samples from the start, middle & end"""
+    view = memoryview(buffer).cast('B')
+    if len(view) <= SAMPLE_SIZE * SAMPLE_COUNT:
+        sample = view
+    else:
+        step = (len(view) - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+        sample = b''.join(view[start:start + SAMPLE_SIZE] for start in range(0, step * SAMPLE_COUNT, step))
+    return len(zlib.compress(sample, 1)) <= len(sample) * max_ratio
@@ -1,40 +1,41 @@
+import asyncio
+import concurrent.futures
 import dataclasses
-import marshal
-from enum import IntEnum, auto
-from itertools import count
+import functools
+import inspect
+import io
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
 from os.path import join
-from typing import Callable, Dict, Tuple
+from typing import Callable, Any, Optional, BinaryIO, Dict, List, Tuple, Union, Iterable
 
-from traitlets import Any
+from library.cache_index import CacheIndex, CacheEntry, DataType, KeyType, EvictionPolicy, DEFAULT_COMPACT_THRESHOLD, \
+    StorageLayout, TEMP_SUFFIX
+from library.cache_codec import ValueCodec, get_codec, is_compressible, DEFAULT_MIN_SIZE
+from library.cache_key import call_key, content_hasher, content_digest
+from library.cache_metrics import CacheMetrics
+from library.file_lock import process_alive
+from library.fingerprint import function_fingerprint
+from library.memory_cache import MemoryCache
+from library.segment_store import SegmentStore, DEFAULT_SEGMENT_SIZE
+from library.single_flight import SingleFlight, AsyncSingleFlight
+from library.sio import FileWrapper, BufferType, ViewIO
+from library.utils import DotDict
 
-from library.sio import FileWrapper, read_int, BufferType
-
-MARSHAL_VERSION = 4
 ENCODING = 'utf-8'
+WRITE_BATCH_SIZE = 64
+# threads of `get_many`, `put_many` & `prefetch`
+IO_WORKERS = 8
+# entries per index update of `adopt_files`
+ADOPT_BATCH_SIZE = 4096
 
-size_settings = {
-    'size': 4,
-    'byteorder': 'big',
-    'signed': False,
-}
-
-data_type_settings = {
-    'size': 1,
-    'byteorder': 'big',
-    'signed': False,
-}
-
-file_index_settings = {
-    'size': 8,
-    'byteorder': 'big',
-    'signed': False,
-}
+_BUFFER_TYPES = bytes, bytearray, memoryview
 
-
-class DataType(IntEnum):
-    FUNCTION = auto()
-    TITLE = auto()
-    GET_REQUEST = auto()
+_MISSING = object()
 
 
 @dataclasses.dataclass(init=True, repr=True, eq=False)
@@ -44,103 +45,913 @@ class ReadWriteWrapper:
     write: Callable[[FileWrapper, Any], int]
 
 
-KeyType = Tuple[DataType, bytes]
+def title_key(title: str) -> KeyType:
+    return DataType.TITLE, title.encode(ENCODING)
 
 
 class CacheFolder:
-    __slots__ = '_root_path', '_container_name'
+    __slots__ = ('_root_path', '_container_name', '_index', '_memory', '_max_size', '_eviction_policy',
+                 '_sweeper', '_sweeper_stop', '_segments', '_flights', '_async_flights', '_write_queue', '_writer',
+                 '_pending', '_pending_lock', '_generations', '_write_error', '_codec', '_compress_min_size', '_deduplicate',
+                 '_io_pool', '_metrics')
 
-    def __init__(self, root_path, container_name='container.bin'):
+    def __init__(self, root_path, container_name='container.bin', compact_threshold=DEFAULT_COMPACT_THRESHOLD,
+                 memory_size: int = 0, max_size: int = 0, eviction_policy: EvictionPolicy = EvictionPolicy.LRU,
+                 sweep_interval: float = 0, packed: bool = False, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 write_behind: int = 0, compression: Union[ValueCodec, int, str] = None,
+                 compress_min_size: int = DEFAULT_MIN_SIZE, deduplicate: bool = False, bloom_fp_rate: float = 0,
+                 metrics: bool = False):
+        """
+        `memory_size` > 0 keeps up to that many bytes of recent values in memory, in front of the files.
+        `max_size` > 0 is a budget for the data files, exceeding it on insert evicts entries by `eviction_policy`.
+        `sweep_interval` > 0 prunes in a background thread every that many seconds, instead of on insert.
+        `packed` appends values to shared segment files of about `segment_size` bytes instead of a file per value,
+        bytes values are read back as memoryviews of the mapped segment. a folder is always opened the same way.
+        several processes can share a folder, each one sees the others' values once it misses them.
+        `write_behind` > 0 returns new values right away & writes them on a background thread,
+        queueing up to that many (callers block when it's full), see `flush`.
+        `compression` is a codec (or its id or name, `library.compression` pipelines included) for values of at least
+        `compress_min_size` bytes that look compressible, the codec of every value is kept in the index.
+        `deduplicate` stores equal values once, as `{digest}.blob` files shared by their keys (reference counted).
+        packed values are still appended, an equal one already stored is referred to instead & the copy is
+        left for `compact_segments`.
+        `bloom_fp_rate` > 0 keeps a bloom filter of the keys with that false positive rate, the keys it rules out
+        miss without a look at the index or the disk.
+        `metrics` counts hits, misses, inserts & evictions by data type and times lookups, reads, deserialization &
+        computations, see `metrics`. it's None (& costs nothing) otherwise.
+        """
         self._root_path = root_path
         self._container_name = container_name
+        self._metrics = CacheMetrics(self.__gauges) if metrics else None
+        os.makedirs(root_path, exist_ok=True)
+        self.__remove_stale_files()
+        self._deduplicate = deduplicate
+        layout = StorageLayout.PACKED if packed else StorageLayout.FILES
+        self._index = CacheIndex(join(root_path, container_name), compact_threshold, allocate_slots=not packed,
+                                 release_blob=self.__release_blob if deduplicate and not packed else None,
+                                 bloom_fp_rate=bloom_fp_rate, layout=layout)
+        self._memory = MemoryCache(memory_size) if memory_size > 0 else None
+        self._flights = SingleFlight()
+        self._async_flights = AsyncSingleFlight()
+        self._segments: Optional[SegmentStore] = None
+        if packed:
+            self._segments = SegmentStore(root_path, segment_size)
+        else:
+            self.__fill_sizes()
+        self._max_size = max_size
+        self._eviction_policy = EvictionPolicy(eviction_policy)
+        self._codec = None if compression is None else get_codec(compression)
+        self._compress_min_size = compress_min_size
+        # `(generation, value)` of the values queued for the background writer
+        self._pending: Dict[KeyType, Tuple[int, Any]] = {}
+        self._pending_lock = threading.RLock()
+        self._generations = itertools.count()
+        # threads are started on first use
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(IO_WORKERS, thread_name_prefix='cache-folder-io')
+        self._write_error: Optional[BaseException] = None
+        self._write_queue: Optional[queue.Queue] = None
+        self._writer: Optional[threading.Thread] = None
+        if write_behind > 0:
+            self._write_queue = queue.Queue(write_behind)
+            self._writer = threading.Thread(target=self.__write_behind, name='cache-folder-writer', daemon=True)
+            self._writer.start()
+        self._sweeper: Optional[threading.Thread] = None
+        self._sweeper_stop = threading.Event()
+        if sweep_interval > 0:
+            self._sweeper = threading.Thread(target=self.__sweep, args=(sweep_interval,), name='cache-folder-sweeper',
+                                             daemon=True)
+            self._sweeper.start()
 
-    def __read_container(self):
-        path = join(self._root_path, self._container_name)
-        data_dict = {}
-        with FileWrapper.open(path, 'rb') as wrapper:
-            data_size = wrapper.read_int(**size_settings)  # data size
-            for step in data_size:
-                data_type = DataType(read_int(**data_type_settings))  # data type
-                data = wrapper.read_big_bytes()  # data
-                file_index = wrapper.read_int(**file_index_settings)  # file index
-                # update data_dict
-                data_dict[(data_type, data)] = file_index
-        return data_dict
-
-    def __write_container(self, data_dict: Dict):
-        path = join(self._root_path, self._container_name)
-        with FileWrapper.open(path, 'wb') as wrapper:
-            total = wrapper.write_int(len(data_dict), **size_settings)  # data size
-            for key, value in data_dict.items():
-                total += wrapper.write_int(key[0], **data_type_settings)  # data type
-                total += wrapper.write_big_bytes(key[1])  # data
-                total += wrapper.write_big_bytes(value)  # file index
-        return total
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        # running prefetches first
+        self._io_pool.shutdown()
+        if self._writer is not None:
+            # after everything queued before
+            self._write_queue.put(None)
+            self._writer.join()
+        if self._sweeper is not None:
+            self._sweeper_stop.set()
+            self._sweeper.join()
+        self._index.close()
+        if self._segments is not None:
+            self._segments.close()
+        self.__raise_write_error()
+
+    def compact(self):
+        if self._segments is not None:
+            self.compact_segments()
+        self._index.compact()
+
+    @property
+    def memory(self):
+        return self._memory
+
+    @property
+    def size(self):
+        return self._index.total_size
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def metrics(self) -> Optional[CacheMetrics]:
+        return self._metrics
+
+    def __gauges(self):
+        gauges = {'entries': len(self._index), 'bytes_stored': self.size, 'pending_writes': len(self._pending)}
+        if self._memory is not None:
+            gauges['memory_entries'] = len(self._memory)
+            gauges['memory_bytes'] = self._memory.size
+        return gauges
+
+    def __count(self, key: KeyType, name: str, value: int = 1):
+        if self._metrics is not None:
+            self._metrics.count(key[0], name, value)
 
     def __format_path(self, index: int):
         return join(self._root_path, f'{hex(index)[2:]}.data')
 
-    def __read_file_index(self, index: int):
-        path = self.__format_path(index)
+    def __blob_path(self, digest: int):
+        return join(self._root_path, f'{digest:032x}.blob')
+
+    def __data_path(self, entry: CacheEntry):
+        if entry.digest:
+            return self.__blob_path(entry.digest)
+        return self.__format_path(entry.file_index)
+
+    @staticmethod
+    def __read_file(path: str):
         with open(path, 'rb') as infile:
             return infile.read()
 
-    def __write_file_index(self, index: int, buffer: BufferType):
-        path = self.__format_path(index)
-        with open(path, 'wb') as outfile:
-            return outfile.write(buffer)
+    @staticmethod
+    def __remove_path(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def __remove_file(self, index: int):
+        self.__remove_path(self.__format_path(index))
+
+    def __release_blob(self, entry: CacheEntry):
+        self.__remove_path(self.__blob_path(entry.digest))
 
-    def __read_file_index_call_back(self, index: int, rw: ReadWriteWrapper):
-        path = self.__format_path(index)
+    def __publish(self, write: Callable[[BinaryIO], Any], blob_path: str = None):
+        """
+        writes a temporary file, then links it to a free index: readers never see a half written value,
+        and a file index another process took meanwhile is skipped. returns the index & the size.
+        a blob is linked to its `blob_path` instead, an existing one has the same content already.
+        """
+        temp_path = join(self._root_path, f'{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}')
+        try:
+            with open(temp_path, 'wb') as outfile:
+                write(outfile)
+                size = outfile.tell()
+            if blob_path is not None:
+                try:
+                    os.link(temp_path, blob_path)
+                except FileExistsError:
+                    pass
+                return 0, size
+            while True:
+                index = self._index.allocate()
+                try:
+                    os.link(temp_path, self.__format_path(index))
+                except FileExistsError:
+                    # stays out of the free list until its deletion is read from the journal
+                    continue
+                except BaseException:
+                    self._index.release(index)
+                    raise
+                return index, size
+        finally:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+
+    def __link_file(self, path: str):
+        """hard links an existing file to a free index, returns the index & the size"""
+        size = os.stat(path).st_size
+        while True:
+            index = self._index.allocate()
+            try:
+                os.link(path, self.__format_path(index))
+            except FileExistsError:
+                continue
+            except BaseException:
+                self._index.release(index)
+                raise
+            return index, size
+
+    def __write_file_index(self, buffer: BufferType, blob_path: str = None):
+        return self.__publish(lambda outfile: outfile.write(buffer), blob_path)
+
+    @staticmethod
+    def __read_file_call_back(path: str, rw: ReadWriteWrapper):
         with FileWrapper.open(path, 'rb') as wrapper:
             return rw.read(wrapper)
 
-    def __write_file_index_call_back(self, index: int, rw: ReadWriteWrapper, instance: Any):
-        path = self.__format_path(index)
-        with FileWrapper.open(path, 'rb') as wrapper:
-            return rw.write(wrapper, instance)
+    def __write_file_index_call_back(self, rw: ReadWriteWrapper, instance: Any):
+        return self.__publish(lambda outfile: rw.write(FileWrapper(outfile), instance))
+
+    def __remove_stale_files(self):
+        """temporary files of processes that died while writing"""
+        for name in os.listdir(self._root_path):
+            if not name.endswith(TEMP_SUFFIX):
+                continue
+            pid = name.split('.', 1)[0]
+            if pid.isdigit() and not process_alive(int(pid)):
+                try:
+                    os.remove(join(self._root_path, name))
+                except FileNotFoundError:
+                    pass
+
+    def __fill_sizes(self):
+        """indexes written before the quota have no sizes"""
+        for key, entry in self._index.items():
+            if entry.size == 0 and not entry.digest:
+                try:
+                    size = os.stat(self.__format_path(entry.file_index)).st_size
+                except FileNotFoundError:
+                    self._index.delete(key)
+                    continue
+                if size:
+                    entry = entry.copy()
+                    entry.size = size
+                    self._index.insert(key, entry)
+
+    def __insert(self, items: List[Tuple[KeyType, CacheEntry]]):
+        """new entries of `__write_value`"""
+        if self._metrics is not None:
+            for key, entry in items:
+                self._metrics.count(key[0], 'inserts')
+                self._metrics.count(key[0], 'bytes_written', entry.size)
+        if self._segments is not None:
+            # taken before a shared entry is moved to the place of an equal value
+            appended = [entry.file_index for key, entry in items]
+            try:
+                self._index.insert_many(items)
+            finally:
+                self._segments.finish(appended)
+        else:
+            for replaced in self._index.insert_many(items):
+                if not replaced.digest:
+                    # computed by another thread or process at the same time
+                    self.__remove_file(replaced.file_index)
+        if self._deduplicate and self._segments is None:
+            for key, entry in items:
+                if entry.digest and not os.path.exists(self.__blob_path(entry.digest)):
+                    # the last other key of the blob was deleted (& its file with it) right before the insert
+                    if self._index.get(key) is entry:
+                        self.delete(key)
+        if self._max_size > 0 and self._sweeper is None:
+            self.prune()
+
+    def __write_value(self, rw: Optional[ReadWriteWrapper], instance, ttl: float = None):
+        """writes the data of a new entry & returns it, the index isn't changed"""
+        if isinstance(instance, _BUFFER_TYPES):
+            hasher = None
+            if self._deduplicate:
+                hasher = content_hasher(instance)
+                entry = None if self._segments is not None else self.__shared_entry(hasher)
+                if entry is not None:
+                    if ttl:
+                        entry.expires = time.time_ns() + int(ttl * 1e9)
+                    return entry
+            codec = raw_size = 0
+            if (self._codec is not None and len(instance) >= self._compress_min_size
+                    and is_compressible(instance)):
+                compressed = self._codec.compress(instance)
+                if len(compressed) < len(instance):
+                    codec, raw_size, instance = self._codec.codec_id, len(instance), compressed
+            digest = 0 if hasher is None else content_digest(hasher, codec)
+            if self._segments is not None:
+                segment, offset, size = self._segments.append(instance)
+                entry = CacheEntry(segment, size, offset=offset)
+            elif digest:
+                entry = CacheEntry(*self.__write_file_index(instance, self.__blob_path(digest)))
+            else:
+                entry = CacheEntry(*self.__write_file_index(instance))
+            entry.codec = codec
+            entry.raw_size = raw_size
+            entry.digest = digest
+        elif rw is None:
+            raise ValueError('for non-bytes return values you need to pass `rw` argument')
+        elif self._segments is not None or self._codec is not None or self._deduplicate:
+            outfile = io.BytesIO()
+            rw.write(FileWrapper(outfile), instance)
+            return self.__write_value(None, outfile.getbuffer(), ttl)
+        else:
+            entry = CacheEntry(*self.__write_file_index_call_back(rw, instance))
+        if ttl:
+            entry.expires = time.time_ns() + int(ttl * 1e9)
+        return entry
+
+    def __shared_entry(self, hasher):
+        """a new entry for the blob of an equal value, if one is stored (compressed or not)"""
+        codecs = (0,) if self._codec is None else (self._codec.codec_id, 0)
+        for codec in codecs:
+            digest = content_digest(hasher, codec)
+            blob = self._index.blob(digest)
+            if blob is not None:
+                entry = CacheEntry(0, digest=digest)
+                entry.share(blob)
+                return entry
+        return None
+
+    def __read_stored(self, entry: CacheEntry):
+        if self._segments is not None:
+            return self._segments.view(entry.file_index, entry.offset, entry.size)
+        return self.__read_file(self.__data_path(entry))
+
+    def __read_index(self, entry: CacheEntry, rw: ReadWriteWrapper):
+        """the value & its stored size"""
+        metrics = self._metrics
+        start = time.perf_counter_ns() if metrics is not None else 0
+        if entry.codec:
+            buffer = get_codec(entry.codec).decompress(self.__read_stored(entry))
+            size = entry.size
+        elif self._segments is not None:
+            buffer = self._segments.view(entry.file_index, entry.offset, entry.size)
+            size = entry.size
+        elif rw is None:
+            buffer = self.__read_file(self.__data_path(entry))
+            size = len(buffer)
+        else:
+            # read while it's deserialized
+            path = self.__data_path(entry)
+            instance = self.__read_file_call_back(path, rw)
+            if metrics is not None:
+                metrics.observe('deserialize', time.perf_counter_ns() - start)
+            return instance, os.stat(path).st_size
+        if metrics is not None:
+            read = time.perf_counter_ns()
+            metrics.observe('read', read - start)
+        if rw is None:
+            return buffer, size
+        instance = rw.read(FileWrapper(ViewIO(buffer)))
+        if metrics is not None:
+            metrics.observe('deserialize', time.perf_counter_ns() - read)
+        return instance, size
+
+    def __lookup(self, key: KeyType):
+        """the live entry of `key`, an expired one is deleted on the way"""
+        if not self._index.might_contain(key):
+            return None
+        entry = self._index.touch(key)
+        if entry is None:
+            if key in self._index:
+                self.__evict(key)
+            elif self._index.refresh():
+                # inserted by another process
+                entry = self._index.touch(key)
+        return entry
+
+    # eviction
+
+    def __evict(self, key: KeyType):
+        freed = self.delete(key)
+        if freed is not None:
+            self.__count(key, 'evictions')
+        return freed
+
+    def delete(self, key: KeyType):
+        """removes the entry & its data file, returns the freed size or None"""
+        with self._pending_lock:
+            # a value of it being written now isn't inserted, see `__write_behind`
+            self._pending.pop(key, None)
+        if self._memory is not None:
+            self._memory.pop(key)
+        entry = self._index.delete(key)
+        if entry is None:
+            return None
+        if entry.digest:
+            # the data goes with the last key referring to it
+            return 0 if self._index.refs(entry.digest) else entry.size
+        if self._segments is None:
+            # packed values are dead space until their segment is compacted
+            self.__remove_file(entry.file_index)
+        return entry.size
+
+    def prune(self, max_size: int = None):
+        """deletes expired entries, then the least valuable ones until the data files fit `max_size`"""
+        max_size = self._max_size if max_size is None else max_size
+        keys = self._index.expired()
+        removed = size = 0
+        for key in keys:
+            freed = self.__evict(key)
+            if freed is not None:
+                removed += 1
+                size += freed
+        if max_size > 0:
+            for key in self._index.victims(max_size, self._eviction_policy):
+                freed = self.__evict(key)
+                if freed is not None:
+                    removed += 1
+                    size += freed
+        return DotDict(entries=removed, size=size)
+
+    def compact_segments(self, min_dead_ratio: float = 0.5):
+        """moves the live values of segments with at least `min_dead_ratio` dead space to the active one"""
+        if self._segments is None:
+            raise ValueError('compacting segments needs a packed cache folder')
+        self._index.refresh()
+        by_segment = defaultdict(list)
+        for key, entry in self._index.items():
+            by_segment[entry.file_index].append((key, entry))
+        active = self._segments.active
+        removed = size = 0
+        for segment, segment_size in self._segments.segments().items():
+            if segment == active:
+                continue
+            entries = by_segment.get(segment, ())
+            # deduplicated values share their place
+            places = {entry.offset: entry.size for key, entry in entries}
+            live = sum(places.values())
+            if segment_size and segment_size - live < segment_size * min_dead_ratio:
+                continue
+            fd = self._segments.acquire(segment)
+            if fd is None:
+                # written by another process
+                continue
+            moved_places = {}
+            try:
+                # nothing is appended to it anymore, but values of it may be inserted meanwhile, by other processes
+                # or as the place of an equal (deduplicated) value: it's removed once a whole scan finds none
+                moving = True
+                while moving:
+                    moving = False
+                    self._index.refresh()
+                    for key, entry in self._index.items():
+                        while entry is not None and entry.file_index == segment:
+                            moving = True
+                            place = moved_places.get(entry.offset)
+                            if place is None:
+                                view = self._segments.view(entry.file_index, entry.offset, entry.size)
+                                place = moved_places[entry.offset] = self._segments.append(view)[:2]
+                            moved = entry.copy()
+                            moved.file_index, moved.offset = place
+                            if self._index.replace(key, entry, moved):
+                                break
+                            # touched, replaced or deleted meanwhile (the copy is dead space then), it's refreshed
+                            entry = self._index.get(key)
+                self._segments.remove(segment)
+            finally:
+                os.close(fd)
+                self._segments.finish(place[0] for place in moved_places.values())
+            removed += 1
+            size += segment_size - live
+        return DotDict(segments=removed, size=size)
+
+    def __sweep(self, interval: float):
+        while not self._sweeper_stop.wait(interval):
+            self.prune()
+            if self._segments is not None:
+                self.compact_segments()
+
+    def __get(self, key: KeyType, rw: ReadWriteWrapper, record: bool = True):
+        """`record` counts the hit or miss"""
+        instance = self.__find(key, rw)
+        if record and self._metrics is not None:
+            self._metrics.count(key[0], 'misses' if instance is _MISSING else 'hits')
+        return instance
+
+    def __find(self, key: KeyType, rw: ReadWriteWrapper):
+        if self._pending:
+            pending = self._pending.get(key)
+            if pending is not None:
+                return pending[1]
+        if self._metrics is None:
+            entry = self.__lookup(key)
+        else:
+            start = time.perf_counter_ns()
+            entry = self.__lookup(key)
+            self._metrics.observe('lookup', time.perf_counter_ns() - start)
+        if entry is None:
+            return _MISSING
+        memory = self._memory
+        if memory is not None:
+            instance = memory.get(key, _MISSING)
+            if instance is not _MISSING:
+                return instance
+        while True:
+            try:
+                instance, size = self.__read_index(entry, rw)
+            except Exception as error:
+                # deleted meanwhile, its file index may hold another key's value (or none) now
+                current = self.__current(key)
+                if current is entry:
+                    if isinstance(error, FileNotFoundError):
+                        return _MISSING
+                    raise
+            else:
+                current = self.__current(key)
+                if current is entry:
+                    break
+            if current is None:
+                return _MISSING
+            entry = current
+        self.__count(key, 'bytes_read', size)
+        if memory is not None:
+            memory.put(key, instance, size)
+        return instance
+
+    def __current(self, key: KeyType):
+        """the entry of `key` after a read, which is valid only if it's still the entry that was read"""
+        self._index.refresh()
+        return self._index.get(key)
+
+    def __get_many(self, keys: Iterable[KeyType], rw: ReadWriteWrapper, concurrent_reads: bool):
+        result = {}
+        entries: Dict[KeyType, CacheEntry] = {}
+        missing = []
+        now = time.time_ns()
+        for key in keys:
+            if key in result or key in entries:
+                continue
+            if self._pending:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    result[key] = pending[1]
+                    continue
+            if not self._index.might_contain(key):
+                continue
+            entry = self._index.touch(key, now)
+            if entry is None:
+                missing.append(key)
+            else:
+                entries[key] = entry
+        if missing:
+            for key in missing:
+                if key in self._index:
+                    # expired
+                    self.__evict(key)
+            # one refresh for all the keys inserted by other processes
+            if self._index.refresh():
+                for key in missing:
+                    entry = self._index.touch(key, now)
+                    if entry is not None:
+                        entries[key] = entry
+        memory = self._memory
+        if memory is not None:
+            for key in list(entries):
+                instance = memory.get(key, _MISSING)
+                if instance is not _MISSING:
+                    result[key] = instance
+                    del entries[key]
+        # in disk order
+        order = sorted(entries.items(), key=lambda item: (item[1].file_index, item[1].offset, item[1].digest))
+
+        def __read(item):
+            try:
+                return self.__read_index(item[1], rw)
+            except Exception as error:
+                # raised if it's still the entry that was read
+                return error
+
+        if concurrent_reads and self._segments is None and len(order) > 1:
+            # a file per value
+            values = list(self._io_pool.map(__read, order))
+        else:
+            # mapped segments, nothing to wait for
+            values = [__read(item) for item in order]
+        self._index.refresh()
+        for (key, entry), value in zip(order, values):
+            current = self._index.get(key)
+            if current is not entry:
+                # deleted or replaced while it was read, its file index may hold the value of another key now
+                if current is not None:
+                    instance = self.__find(key, rw)
+                    if instance is not _MISSING:
+                        result[key] = instance
+                continue
+            if isinstance(value, FileNotFoundError):
+                continue
+            if isinstance(value, Exception):
+                raise value
+            instance, size = value
+            result[key] = instance
+            self.__count(key, 'bytes_read', size)
+            if memory is not None:
+                memory.put(key, instance, size)
+        return result
+
+    def __get_memory(self, key: KeyType):
+        """memory tier only, no disk access"""
+        if self._memory is None or self._index.touch(key) is None:
+            return _MISSING
+        return self._memory.get(key, _MISSING)
+
+    def __put(self, key: KeyType, rw: Optional[ReadWriteWrapper], ttl: float, instance):
+        if self._write_queue is None:
+            entry = self.__write_value(rw, instance, ttl)
+            self.__insert([(key, entry)])
+            if self._memory is not None:
+                self._memory.put(key, instance, entry.size)
+            return
+        if rw is None and not isinstance(instance, _BUFFER_TYPES):
+            raise ValueError('for non-bytes return values you need to pass `rw` argument')
+        with self._pending_lock:
+            generation = next(self._generations)
+            self._pending[key] = generation, instance
+        if self._memory is not None:
+            self._memory.put(key, instance)
+        # blocks while the queue is full
+        self._write_queue.put((key, rw, ttl, generation, instance))
+
+    def __is_pending(self, key: KeyType, generation: int):
+        """the queued value is still the last one of `key`, it wasn't deleted or replaced since"""
+        pending = self._pending.get(key)
+        return pending is not None and pending[0] == generation
+
+    def __discard(self, entry: CacheEntry):
+        """the data of an entry that was written but never inserted"""
+        if self._segments is not None:
+            # dead space until its segment is compacted
+            self._segments.finish((entry.file_index,))
+            return
+        if entry.digest:
+            if not self._index.refs(entry.digest):
+                self.__release_blob(entry)
+            return
+        self.__remove_file(entry.file_index)
+        self._index.release(entry.file_index)
+
+    def __write_behind(self):
+        write_queue = self._write_queue
+        while True:
+            batch = [write_queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            writes = [item for item in batch if item is not None]
+            try:
+                written = []
+                try:
+                    for key, rw, ttl, generation, instance in writes:
+                        # deleted or replaced since
+                        if self.__is_pending(key, generation):
+                            written.append((key, generation, self.__write_value(rw, instance, ttl)))
+                except BaseException:
+                    for key, generation, entry in written:
+                        self.__discard(entry)
+                    raise
+                items = []
+                with self._pending_lock:
+                    # deleted or replaced while it was written, a `delete` waits for the insert
+                    for key, generation, entry in written:
+                        if self.__is_pending(key, generation):
+                            items.append((key, entry))
+                        else:
+                            self.__discard(entry)
+                    if items:
+                        self.__insert(items)
+            except BaseException as error:
+                if self._write_error is None:
+                    self._write_error = error
+            finally:
+                with self._pending_lock:
+                    for key, rw, ttl, generation, instance in writes:
+                        if self.__is_pending(key, generation):
+                            del self._pending[key]
+                for _ in batch:
+                    write_queue.task_done()
+            if len(writes) != len(batch):
+                return
+
+    def __raise_write_error(self):
+        error, self._write_error = self._write_error, None
+        if error is not None:
+            raise error
+
+    def flush(self):
+        """waits for the background writer, raises the first error it had"""
+        if self._write_queue is not None:
+            self._write_queue.join()
+        self.__raise_write_error()
+
+    def __compute(self, key: KeyType, rw: ReadWriteWrapper, ttl: float, func: Callable, args, kwargs):
+        # the previous flight may have finished between the miss & joining this one
+        instance = self.__get(key, rw, False)
+        if instance is _MISSING:
+            start = time.perf_counter_ns()
+            instance = func(*args, **kwargs)
+            if self._metrics is not None:
+                self._metrics.observe('compute', time.perf_counter_ns() - start)
+            self.__put(key, rw, ttl, instance)
+        return instance
+
+    async def __compute_async(self, key: KeyType, rw: ReadWriteWrapper, ttl: float, func: Callable, args, kwargs):
+        loop = asyncio.get_running_loop()
+        instance = await loop.run_in_executor(None, self.__get, key, rw, False)
+        if instance is _MISSING:
+            start = time.perf_counter_ns()
+            instance = await func(*args, **kwargs)
+            if self._metrics is not None:
+                self._metrics.observe('compute', time.perf_counter_ns() - start)
+            await loop.run_in_executor(None, self.__put, key, rw, ttl, instance)
+        return instance
+
+    def cached_call(self, rw: ReadWriteWrapper = None, transitive: bool = False, ttl: float = None,
+                    key: Callable[..., Any] = None):
+        """
+        the key is the function & its arguments (`self` too, for methods): they must be None, bools, numbers,
+        strings, buffers, numpy arrays, containers of those, or picklable. a `TypeError` naming the argument is
+        raised otherwise (locks, lambdas, sockets, open files, ...), pass `key` then: it's called with the
+        arguments & returns a value of those types to key on instead.
+        `ttl` is in seconds, expired values are computed again.
+        concurrent misses of one key compute it once, the other callers wait for that result.
+        `async def` functions get an `async def` wrapper, their disk reads & writes run in the default executor.
+        """
+        key_function = key
 
-    @staticmethod
-    def __search_new_index(data_dict: Dict):
-        for data_index, index in zip(data_dict.values(), count()):
-            if data_index != index:
-                return index
-        return 0
-
-    def __write_new_index_and_container(self, data_dict: Dict, key: KeyType, buffer: BufferType):
-        new_index = data_dict[key] = CacheFolder.__search_new_index(data_dict)
-        self.__write_file_index(new_index, buffer)
-        self.__write_container(data_dict)
-
-    def __write_new_index_and_container_call_back(self, data_dict: Dict, key: KeyType, rw: ReadWriteWrapper, instance):
-        new_index = data_dict[key] = CacheFolder.__search_new_index(data_dict)
-        self.__write_file_index_call_back(new_index, rw, instance)
-        self.__write_container(data_dict)
-
-    def cached_call(self, rw: ReadWriteWrapper = None):
         def __decorator(func: Callable):
+            fingerprint = function_fingerprint(func, transitive)
+            signature = inspect.signature(func)
+            no_arguments_key = (DataType.FUNCTION, call_key(fingerprint, (), {}, signature))
+
+            def __key(args, kwargs):
+                if key_function is not None:
+                    return DataType.FUNCTION, call_key(fingerprint, (key_function(*args, **kwargs),), {})
+                if args or kwargs:
+                    return DataType.FUNCTION, call_key(fingerprint, args, kwargs, signature)
+                return no_arguments_key
+
+            if inspect.iscoroutinefunction(func):
+                async def __async_wrapper(*args, **kwargs):
+                    key = __key(args, kwargs)
+                    instance = self.__get_memory(key)
+                    if instance is not _MISSING:
+                        self.__count(key, 'hits')
+                        return instance
+                    instance = await asyncio.get_running_loop().run_in_executor(None, self.__get, key, rw)
+                    if instance is not _MISSING:
+                        return instance
+                    return await self._async_flights.do(key, self.__compute_async, key, rw, ttl, func, args, kwargs)
+
+                return functools.wraps(func)(__async_wrapper)
+
             def __wrapper(*args, **kwargs):
-                func_codes = marshal.dumps(func, MARSHAL_VERSION)
-                data_dict = self.__read_container()
-                key = (DataType.FUNCTION, func_codes)
-                try:
-                    index = data_dict[key]
-                except KeyError:
-                    instance = func(*args, **kwargs)
-                    if isinstance(instance, (bytes, bytearray)):
-                        self.__write_new_index_and_container(data_dict, key, instance)
-                    elif ReadWriteWrapper is None:
-                        raise ValueError('for non-bytes return values you need to pass `rw` argument')
-                    else:
-                        self.__write_new_index_and_container_call_back(data_dict, key, rw, instance)
+                key = __key(args, kwargs)
+                instance = self.__get(key, rw)
+                if instance is not _MISSING:
                     return instance
-                return self.__read_file_index_call_back(index, rw)
+                return self._flights.do(key, self.__compute, key, rw, ttl, func, args, kwargs)
 
-            return __wrapper
+            return functools.wraps(func)(__wrapper)
 
         return __decorator
 
-    def cache_title(self, title: str, buffer: BufferType):
-        data_dict = self.__read_container()
-        key = (DataType.TITLE, title.encode(ENCODING))
-        self.__write_new_index_and_container(data_dict, key, buffer)
+    def get(self, key: KeyType, rw: ReadWriteWrapper = None, default: Any = None):
+        """the cached value of `key`, or `default`"""
+        instance = self.__get(key, rw)
+        return default if instance is _MISSING else instance
+
+    def put(self, key: KeyType, instance: Any, rw: ReadWriteWrapper = None, ttl: float = None):
+        """stores `instance` under `key`, replacing its value"""
+        self.__put(key, rw, ttl, instance)
+
+    def read_into(self, key: KeyType, out) -> Optional[int]:
+        """
+        copies the (decompressed) value of `key` into the writable buffer `out`, which must be big enough.
+        returns the value's size, or None if it's not cached (or still waiting for the background writer).
+        """
+        entry = self.__lookup(key)
+        while entry is not None:
+            try:
+                if entry.codec:
+                    size = get_codec(entry.codec).decompress_into(self.__read_stored(entry), out)
+                elif self._segments is not None:
+                    view = self.__read_stored(entry)
+                    memoryview(out)[:len(view)] = view
+                    size = len(view)
+                else:
+                    with open(self.__data_path(entry), 'rb') as infile:
+                        size = infile.readinto(out)
+            except Exception as error:
+                # read again if it was deleted meanwhile, see `__find`
+                current = self.__current(key)
+                if current is entry:
+                    if isinstance(error, FileNotFoundError):
+                        return None
+                    raise
+            else:
+                current = self.__current(key)
+                if current is entry:
+                    return size
+            entry = current
+        return None
+
+    def value_size(self, key: KeyType) -> Optional[int]:
+        """size of the (decompressed) value of `key`, to allocate the buffer of `read_into`"""
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        return entry.raw_size if entry.codec else entry.size
+
+    def cache_title(self, title: str, buffer: BufferType, ttl: float = None):
+        key = title_key(title)
+        # the old data file would be left behind otherwise
+        self.delete(key)
+        self.__put(key, None, ttl, buffer)
+
+    def get_many(self, keys: Iterable[KeyType], rw: ReadWriteWrapper = None) -> Dict[KeyType, Any]:
+        """
+        the cached values of `keys`, misses are left out. the index is searched (& refreshed) once for all of them,
+        data files are read by a pool of threads & packed values in segment order.
+        """
+        keys = set(keys)
+        result = self.__get_many(keys, rw, True)
+        if self._metrics is not None:
+            for key in keys:
+                self._metrics.count(key[0], 'hits' if key in result else 'misses')
+        return result
+
+    def put_many(self, items: Iterable[Tuple[KeyType, Any]], rw: ReadWriteWrapper = None, ttl: float = None):
+        """
+        stores `(key, value)` pairs, data files are written by a pool of threads & inserted with one index update.
+        with `write_behind` they're queued like single values instead.
+        """
+        # the last value of a key wins
+        items = dict(items)
+        if self._write_queue is not None:
+            for key, instance in items.items():
+                self.__put(key, rw, ttl, instance)
+            return
+
+        def __write(item):
+            return item[0], self.__write_value(rw, item[1], ttl)
+
+        if self._segments is None and len(items) > 1:
+            entries = list(self._io_pool.map(__write, items.items()))
+        else:
+            entries = []
+            try:
+                for item in items.items():
+                    entries.append(__write(item))
+            except BaseException:
+                for key, entry in entries:
+                    self.__discard(entry)
+                raise
+        if entries:
+            self.__insert(entries)
+        if self._memory is not None:
+            for key, entry in entries:
+                self._memory.put(key, items[key], entry.size)
+
+    def prefetch(self, keys: Iterable[KeyType], rw: ReadWriteWrapper = None) -> concurrent.futures.Future:
+        """reads `keys` into the memory tier in the background, the future's result is the number of hits"""
+        if self._memory is None:
+            raise ValueError('prefetching needs a memory tier, pass `memory_size`')
+        keys = list(keys)
+        # its reads aren't spread over the pool, it runs in the pool itself
+        return self._io_pool.submit(lambda: len(self.__get_many(keys, rw, False)))
+
+    def adopt_files(self, items: Iterable[Tuple[KeyType, str]], move: bool = False, ttl: float = None,
+                    batch_size: int = ADOPT_BATCH_SIZE):
+        """
+        takes `(key, path)` files as the values of their keys as they are: they're hard linked into the folder
+        (so they must be on its file system), nothing is copied. `move` removes the paths once they're inserted.
+        inserts `batch_size` entries per index update, files that don't exist are skipped.
+        """
+        if self._segments is not None:
+            raise ValueError('adopting files needs a file per value, not a packed cache folder')
+        expires = time.time_ns() + int(ttl * 1e9) if ttl else 0
+        files = missing = size = 0
+        batch = []
+        paths = []
+
+        def __flush():
+            self.__insert(batch)
+            if move:
+                for moved in paths:
+                    os.remove(moved)
+            batch.clear()
+            paths.clear()
+
+        for key, path in items:
+            try:
+                entry = CacheEntry(*self.__link_file(path), expires=expires)
+            except FileNotFoundError:
+                missing += 1
+                continue
+            batch.append((key, entry))
+            paths.append(path)
+            files += 1
+            size += entry.size
+            if len(batch) >= batch_size:
+                __flush()
+        if batch:
+            __flush()
+        return DotDict(files=files, missing=missing, size=size)
@@ -0,0 +1,805 @@
+import io
+import os
+import threading
+import time
+from enum import IntEnum, auto
+from typing import Dict, Tuple, Optional, List, Iterable, Callable, Any
+
+from library.bloom import BloomFilter
+from library.file_lock import FileLock
+from library.sio import FileWrapper
+
+size_settings = {
+    'size': 4,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+data_type_settings = {
+    'size': 1,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+file_index_settings = {
+    'size': 8,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+journal_op_settings = {
+    'size': 1,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+# sizes, nanosecond times & counters
+entry_field_settings = {
+    'size': 8,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+SNAPSHOT_MAGIC = b'CFIX'
+SNAPSHOT_VERSION = 5
+
+JOURNAL_SUFFIX = '.journal'
+OLD_JOURNAL_SUFFIX = '.journal.old'
+TEMP_SUFFIX = '.tmp'
+LOCK_SUFFIX = '.lock'
+COMPACT_LOCK_SUFFIX = '.compact.lock'
+BLOOM_SUFFIX = '.bloom'
+DEFAULT_COMPACT_THRESHOLD = 4096
+# a rebuilt bloom filter has room for this many times the keys
+BLOOM_GROWTH = 2
+BLOOM_MIN_CAPACITY = 1024
+# file indexes of older snapshots this large are segments
+PACKED_MIN_FILE_INDEX = 1 << 48
+
+
+class DataType(IntEnum):
+    FUNCTION = auto()
+    TITLE = auto()
+    GET_REQUEST = auto()
+
+
+KeyType = Tuple[DataType, bytes]
+
+
+class JournalOp(IntEnum):
+    # first version: key & file index only
+    INSERT = auto()
+    DELETE = auto()
+    # key & entry without offset
+    PUT = auto()
+    # key & entry with fixed size fields
+    ENTRY = auto()
+    # key & entry as counted fields, newer fields come last & older readers skip them
+    FIELDS = auto()
+
+
+class EvictionPolicy(IntEnum):
+    LRU = auto()
+    LFU = auto()
+
+
+class StorageLayout(IntEnum):
+    """where the values of an index are, recorded in its snapshot"""
+    # a file per file index
+    FILES = auto()
+    # file indexes are segments
+    PACKED = auto()
+
+
+class CacheEntry:
+    """
+    where a value lives & how it's used, times are `time.time_ns()`, `expires` is 0 for never.
+    packed values are `size` bytes at `offset` of segment `file_index`.
+    compressed values are stored with `codec` (0 for none) & are `raw_size` bytes once decompressed.
+    deduplicated values have the `digest` of their content (0 for none) & share its data with the other keys.
+    """
+    __slots__ = 'file_index', 'size', 'created', 'accessed', 'hits', 'expires', 'offset', 'codec', 'raw_size', 'digest'
+
+    def __init__(self, file_index: int, size: int = 0, created: int = 0, accessed: int = 0, hits: int = 0,
+                 expires: int = 0, offset: int = 0, codec: int = 0, raw_size: int = 0, digest: int = 0):
+        self.file_index = file_index
+        self.size = size
+        self.created = created
+        self.accessed = accessed
+        self.hits = hits
+        self.expires = expires
+        self.offset = offset
+        self.codec = codec
+        self.raw_size = raw_size
+        self.digest = digest
+
+    def __repr__(self):
+        return (f'CacheEntry({self.file_index}, offset={self.offset}, size={self.size}, hits={self.hits}, '
+                f'expires={self.expires}, codec={self.codec}, digest={self.digest:x})')
+
+    def fields(self):
+        return (self.file_index, self.size, self.created, self.accessed, self.hits, self.expires, self.offset,
+                self.codec, self.raw_size, self.digest)
+
+    def copy(self):
+        return CacheEntry(*self.fields())
+
+    def share(self, other: 'CacheEntry'):
+        """refers to the data of `other`, which has the same digest"""
+        self.file_index = other.file_index
+        self.offset = other.offset
+        self.size = other.size
+        self.codec = other.codec
+        self.raw_size = other.raw_size
+
+    def is_expired(self, now: int):
+        return 0 < self.expires <= now
+
+    def write(self, wrapper: FileWrapper):
+        fields = self.fields()
+        total = wrapper.write_big_int(len(fields), signed=False)  # field count
+        for value in fields:
+            total += wrapper.write_big_int(value, signed=False)  # field
+        return total
+
+    @staticmethod
+    def read(wrapper: FileWrapper):
+        count = wrapper.read_big_int(signed=False)  # field count
+        fields = [wrapper.read_big_int(signed=False) for step in range(count)]  # fields
+        # fields written by newer versions are dropped
+        return CacheEntry(*fields[:len(CacheEntry.__slots__)])
+
+    @staticmethod
+    def read_fixed(wrapper: FileWrapper, with_offset: bool = True):
+        """versions 2 & 3, version 2 has no offset"""
+        file_index = wrapper.read_int(**file_index_settings)  # file index
+        size = wrapper.read_int(**entry_field_settings)  # size
+        created = wrapper.read_int(**entry_field_settings)  # created
+        accessed = wrapper.read_int(**entry_field_settings)  # accessed
+        hits = wrapper.read_int(**entry_field_settings)  # hits
+        expires = wrapper.read_int(**entry_field_settings)  # expires
+        offset = wrapper.read_int(**entry_field_settings) if with_offset else 0  # offset
+        return CacheEntry(file_index, size, created, accessed, hits, expires, offset)
+
+
+def _read_key(wrapper: FileWrapper) -> KeyType:
+    data_type = DataType(wrapper.read_int(**data_type_settings))  # data type
+    return data_type, wrapper.read_big_bytes()  # data
+
+
+def _write_key(wrapper: FileWrapper, key: KeyType):
+    total = wrapper.write_int(key[0], **data_type_settings)  # data type
+    return total + wrapper.write_big_bytes(key[1])  # data
+
+
+# snapshot
+
+def read_snapshot(path: str) -> Dict[KeyType, CacheEntry]:
+    entries = {}
+    try:
+        wrapper = FileWrapper.open(path, 'rb')
+    except FileNotFoundError:
+        return entries
+    with wrapper:
+        if wrapper.read_bytes(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            # first version: no header, no metadata
+            wrapper.file.seek(0)
+            data_size = wrapper.read_int(**size_settings)  # data size
+            for step in range(data_size):
+                key = _read_key(wrapper)
+                entries[key] = CacheEntry(wrapper.read_int(**file_index_settings))  # file index
+            return entries
+        version = wrapper.read_int(**data_type_settings)  # version
+        if version not in (2, 3, 4, SNAPSHOT_VERSION):
+            raise ValueError(f'unsupported snapshot version: {version}')
+        if version >= 5:
+            wrapper.read_int(**data_type_settings)  # layout
+        data_size = wrapper.read_int(**size_settings)  # data size
+        for step in range(data_size):
+            key = _read_key(wrapper)
+            if version >= 4:
+                entries[key] = CacheEntry.read(wrapper)  # entry
+            else:
+                entries[key] = CacheEntry.read_fixed(wrapper, version > 2)  # entry
+    return entries
+
+
+def read_snapshot_layout(path: str) -> Optional[StorageLayout]:
+    """None without a snapshot, or for one older than the layout"""
+    try:
+        wrapper = FileWrapper.open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with wrapper:
+        if wrapper.read_bytes(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return None
+        if wrapper.read_int(**data_type_settings) < 5:  # version
+            return None
+        return StorageLayout(wrapper.read_int(**data_type_settings))  # layout
+
+
+def write_snapshot(path: str, entries: Dict[KeyType, CacheEntry], layout: StorageLayout = StorageLayout.FILES):
+    """written to a temporary file first, so a crash never leaves a half written snapshot"""
+    temp_path = path + TEMP_SUFFIX
+    with FileWrapper.open(temp_path, 'wb') as wrapper:
+        total = wrapper.write_bytes(SNAPSHOT_MAGIC)  # magic
+        total += wrapper.write_int(SNAPSHOT_VERSION, **data_type_settings)  # version
+        total += wrapper.write_int(layout, **data_type_settings)  # layout
+        total += wrapper.write_int(len(entries), **size_settings)  # data size
+        for key, entry in entries.items():
+            total += _write_key(wrapper, key)
+            total += entry.write(wrapper)  # entry
+        wrapper.file.flush()
+        os.fsync(wrapper.file.fileno())
+    os.replace(temp_path, path)
+    return total
+
+
+# journal
+
+def format_journal_record(op: JournalOp, key: KeyType, entry: CacheEntry = None):
+    outfile = io.BytesIO()
+    wrapper = FileWrapper(outfile)
+    wrapper.write_int(op, **journal_op_settings)  # op
+    _write_key(wrapper, key)
+    if op == JournalOp.FIELDS:
+        entry.write(wrapper)  # entry
+    else:
+        wrapper.write_int(0 if entry is None else entry.file_index, **file_index_settings)  # file index
+    return outfile.getvalue()
+
+
+def read_journal(path: str, offset: int = 0):
+    """yields `(op, key, entry, end)` for each whole record from `offset` on, a torn or unfinished record ends it"""
+    try:
+        wrapper = FileWrapper.open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with wrapper:
+        wrapper.file.seek(offset)
+        while True:
+            try:
+                op = JournalOp(wrapper.read_int(**journal_op_settings))  # op
+                key = _read_key(wrapper)
+                if op == JournalOp.FIELDS:
+                    entry = CacheEntry.read(wrapper)  # entry
+                elif op == JournalOp.ENTRY:
+                    entry = CacheEntry.read_fixed(wrapper)  # entry
+                elif op == JournalOp.PUT:
+                    entry = CacheEntry.read_fixed(wrapper, with_offset=False)  # entry
+                else:
+                    entry = CacheEntry(wrapper.read_int(**file_index_settings))  # file index
+            except (EOFError, ValueError):
+                return
+            yield op, key, entry, wrapper.file.tell()
+
+
+def replay_journal(path: str, entries: Dict[KeyType, CacheEntry], offset: int = 0):
+    """applies the records to `entries`, returns the number of records & where the last one ended"""
+    records = 0
+    end = offset
+    for op, key, entry, end in read_journal(path, offset):
+        if op == JournalOp.DELETE:
+            entries.pop(key, None)
+        else:
+            entries[key] = entry
+        records += 1
+    return records, end
+
+
+def _file_id(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def _bloom_item(key: KeyType):
+    return key[0].to_bytes(1, 'big') + key[1]
+
+
+def _same_place(entry: CacheEntry, other: CacheEntry):
+    return entry.file_index == other.file_index and entry.offset == other.offset and entry.created == other.created
+
+
+class SlotAllocator:
+    """file indexes: freed slots are reused first (LIFO), then new ones past the highest"""
+    __slots__ = '_free', '_next'
+
+    def __init__(self, used=()):
+        used = set(used)
+        self._next = max(used) + 1 if used else 0
+        self._free = [index for index in range(self._next - 1, -1, -1) if index not in used]
+
+    def __len__(self):
+        """number of slots in use"""
+        return self._next - len(self._free)
+
+    def allocate(self):
+        if self._free:
+            return self._free.pop()
+        index = self._next
+        self._next += 1
+        return index
+
+    def release(self, index: int):
+        self._free.append(index)
+
+
+class CacheIndex:
+    """
+    resident key -> entry map, loaded once from the snapshot & its journal.
+    inserts append one record to the journal, the snapshot is rewritten in the background
+    once `compact_threshold` records piled up.
+    file indexes come from `allocate()` and return to it when their entry is deleted or replaced;
+    the free slots aren't stored, they're the gaps in the index.
+    without `allocate_slots` file indexes are picked by the caller (e.g. shared segments).
+    hits only change memory, they reach the disk with the next snapshot (at the latest on close).
+
+    entries with a digest are reference counted: an inserted one shares the data of a live entry with its digest,
+    their size counts once, and `release_blob` is called (under the file lock) once the last of them is gone.
+
+    several processes can share the index: changes are appended under an exclusive file lock after reading
+    the others' records from the journal's tail (`refresh()`, under a shared lock), so every process sees
+    what its change replaced.
+
+    with `bloom_fp_rate` a shared bloom filter of the keys answers `might_contain` without locks or file access,
+    keys are added to it before they're journaled. it's rebuilt after each snapshot, or sooner once it's over
+    capacity, and the file it replaces is marked stale for the processes that have it mapped.
+    """
+    __slots__ = ('_path', '_journal_path', '_old_journal_path', '_entries', '_journal', '_journal_id',
+                 '_journal_offset', '_journal_records', '_compact_threshold', '_lock', '_file_lock', '_compact_lock',
+                 '_compactor', '_total_size', '_touched', '_slots', '_blobs', '_release_blob', '_bloom_path',
+                 '_bloom_fp_rate', '_bloom', '_layout')
+
+    def __init__(self, path: str, compact_threshold: int = DEFAULT_COMPACT_THRESHOLD, allocate_slots: bool = True,
+                 release_blob: Callable[[CacheEntry], Any] = None, bloom_fp_rate: float = 0,
+                 layout: StorageLayout = StorageLayout.FILES):
+        """`layout` is recorded for a new index, opening it with another one raises `ValueError`"""
+        self._path = path
+        self._journal_path = path + JOURNAL_SUFFIX
+        self._old_journal_path = path + OLD_JOURNAL_SUFFIX
+        self._compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        # appends & journal rotation
+        self._file_lock = FileLock(path + LOCK_SUFFIX)
+        # held by the process writing a snapshot
+        self._compact_lock = FileLock(path + COMPACT_LOCK_SUFFIX)
+        self._compactor: Optional[threading.Thread] = None
+        self._touched = False
+        self._entries: Dict[KeyType, CacheEntry] = {}
+        self._journal = None
+        self._total_size = 0
+        # after the layout is checked, file indexes of another layout could be any size
+        self._slots: Optional[SlotAllocator] = None
+        # digest -> the entries sharing its data
+        self._blobs: Dict[int, Dict[KeyType, CacheEntry]] = {}
+        self._release_blob = release_blob
+        self._bloom_path = path + BLOOM_SUFFIX
+        self._bloom_fp_rate = bloom_fp_rate
+        self._bloom: Optional[BloomFilter] = None
+
+        with self._file_lock.exclusive():
+            self._load()
+            if os.path.getsize(self._journal_path) > self._journal_offset:
+                # a process died while appending, later records would be unreadable
+                os.truncate(self._journal_path, self._journal_offset)
+            stored = read_snapshot_layout(path)
+            if stored is None and self._entries:
+                # written before the layout was recorded: segments are numbered by `time.time_ns()`
+                packed = any(entry.file_index >= PACKED_MIN_FILE_INDEX for entry in self._entries.values())
+                stored = StorageLayout.PACKED if packed else StorageLayout.FILES
+            elif stored is None and not os.path.exists(path):
+                write_snapshot(path, {}, layout)
+            if stored is not None and stored != layout:
+                self._journal.close()
+                raise ValueError(f'unsupported layout: {path} was created {stored.name.lower()}, '
+                                 f'not {StorageLayout(layout).name.lower()}')
+            self._layout = StorageLayout(layout)
+            if allocate_slots:
+                self._slots = SlotAllocator(entry.file_index for entry in self._entries.values() if not entry.digest)
+            if bloom_fp_rate:
+                try:
+                    self._bloom = BloomFilter.open(self._bloom_path)
+                except (FileNotFoundError, ValueError, EOFError):
+                    # an older folder, or a filter that wasn't finished
+                    self._write_bloom(self._entries)
+                    self._publish_bloom(self._entries)
+        if os.path.exists(self._old_journal_path):
+            # a compaction didn't finish
+            self.compact()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: KeyType):
+        return key in self._entries
+
+    @property
+    def total_size(self):
+        return self._total_size
+
+    @property
+    def layout(self):
+        return self._layout
+
+    def _load(self):
+        """needs the file lock, reads everything again, access metadata of unchanged entries is kept"""
+        while True:
+            snapshot_id = _file_id(self._path)
+            entries = read_snapshot(self._path)
+            # the old journal may be part of a new snapshot already, replaying it again is harmless
+            replay_journal(self._old_journal_path, entries)
+            if _file_id(self._path) == snapshot_id:
+                break
+            # a compaction finished meanwhile & may have removed the old journal before it was read
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._journal_path, 'ab', buffering=0)
+        self._journal_records, self._journal_offset = replay_journal(self._journal_path, entries)
+        stat = os.fstat(self._journal.fileno())
+        self._journal_id = stat.st_dev, stat.st_ino
+
+        for key, entry in entries.items():
+            old = self._entries.get(key)
+            if old is not None and _same_place(old, entry):
+                entries[key] = old
+        self._entries = entries
+        self._total_size = 0
+        self._blobs = {}
+        for key, entry in entries.items():
+            self._link(key, entry)
+        if self._slots is not None:
+            self._slots = SlotAllocator(entry.file_index for entry in entries.values() if not entry.digest)
+
+    # bloom filter
+
+    def _bloom_temp_path(self):
+        return f'{self._bloom_path}.{os.getpid()}{TEMP_SUFFIX}'
+
+    def _write_bloom(self, entries: Dict[KeyType, CacheEntry]):
+        """a new filter of `entries` as a temporary file, `_publish_bloom` replaces the current one with it"""
+        bloom = BloomFilter(max(len(entries) * BLOOM_GROWTH, BLOOM_MIN_CAPACITY), self._bloom_fp_rate)
+        bloom.update(_bloom_item(key) for key in entries)
+        bloom.write(self._bloom_temp_path())
+
+    def _publish_bloom(self, entries: Dict[KeyType, CacheEntry]):
+        """needs the file lock, the keys inserted since `entries` were taken are added first"""
+        temp_path = self._bloom_temp_path()
+        bloom = BloomFilter.open(temp_path)
+        for key in self._entries:
+            if key not in entries:
+                bloom.add(_bloom_item(key))
+        try:
+            old = BloomFilter.open(self._bloom_path)
+        except (FileNotFoundError, ValueError, EOFError):
+            old = None
+        os.replace(temp_path, self._bloom_path)
+        if old is not None:
+            old.mark_stale()
+            old.close()
+        # the previous one isn't closed, other threads may be reading it
+        self._bloom = bloom
+
+    def might_contain(self, key: KeyType):
+        """False only for keys that aren't in the index (of any process), always True without a bloom filter"""
+        bloom = self._bloom
+        if bloom is None:
+            return True
+        if bloom.stale:
+            with self._lock:
+                if self._bloom is bloom:
+                    self._bloom = BloomFilter.open(self._bloom_path)
+                bloom = self._bloom
+        return _bloom_item(key) in bloom
+
+    def _add_to_bloom(self, keys: List[KeyType]):
+        """needs the file lock, returns True once the filter is over capacity"""
+        if self._bloom.stale:
+            self._bloom = BloomFilter.open(self._bloom_path)
+        for key in keys:
+            self._bloom.add(_bloom_item(key))
+        return self._bloom.count > self._bloom.capacity
+
+    def _refresh(self):
+        """needs the file lock, returns True if anything changed"""
+        stat = os.stat(self._journal_path)
+        if (stat.st_dev, stat.st_ino) != self._journal_id:
+            # rotated by another process
+            self._load()
+            return True
+        if stat.st_size <= self._journal_offset:
+            return False
+        changed = False
+        for op, key, entry, end in read_journal(self._journal_path, self._journal_offset):
+            changed |= self._apply(op, key, entry)
+            self._journal_records += 1
+            self._journal_offset = end
+        return changed
+
+    def refresh(self):
+        """reads the records appended by other processes"""
+        with self._lock, self._file_lock.shared():
+            return self._refresh()
+
+    def _link(self, key: KeyType, entry: CacheEntry):
+        if not entry.digest:
+            self._total_size += entry.size
+            return
+        holders = self._blobs.get(entry.digest)
+        if holders is None:
+            holders = self._blobs[entry.digest] = {}
+            self._total_size += entry.size
+        holders[key] = entry
+
+    def _unlink(self, key: KeyType, entry: CacheEntry, dropped: List[CacheEntry] = None, release: bool = True):
+        if not entry.digest:
+            self._total_size -= entry.size
+            if self._slots is not None and release:
+                self._slots.release(entry.file_index)
+            return
+        holders = self._blobs[entry.digest]
+        del holders[key]
+        if not holders:
+            del self._blobs[entry.digest]
+            self._total_size -= entry.size
+            if dropped is not None:
+                dropped.append(entry)
+
+    def _apply(self, op: JournalOp, key: KeyType, entry: CacheEntry, dropped: List[CacheEntry] = None):
+        """`dropped` collects the entries whose digest lost its last reference"""
+        old = self._entries.get(key)
+        if op == JournalOp.DELETE:
+            if old is None:
+                return False
+            del self._entries[key]
+            self._unlink(key, old, dropped)
+            return True
+        if old is not None:
+            if old is entry:
+                return False
+            if _same_place(old, entry):
+                # read back, or only its metadata changed
+                changed = old.size != entry.size or old.expires != entry.expires
+                if not old.digest:
+                    self._total_size += entry.size - old.size
+                old.size = entry.size
+                old.expires = entry.expires
+                return changed
+            self._unlink(key, old, dropped, release=old.file_index != entry.file_index)
+        self._entries[key] = entry
+        self._link(key, entry)
+        return True
+
+    def _release_blobs(self, dropped: List[CacheEntry]):
+        """needs the file lock, so no other process refers to a digest again before its data is gone"""
+        if self._release_blob is None:
+            return
+        for entry in dropped:
+            # a later record of the batch may have referred to it again
+            if entry.digest not in self._blobs:
+                self._release_blob(entry)
+
+    def get(self, key: KeyType, default: CacheEntry = None):
+        return self._entries.get(key, default)
+
+    def blob(self, digest: int) -> Optional[CacheEntry]:
+        """a live entry holding the data of `digest`, or None"""
+        holders = self._blobs.get(digest)
+        if not holders:
+            return None
+        return next(iter(holders.values()))
+
+    def refs(self, digest: int):
+        """number of entries sharing the data of `digest`"""
+        return len(self._blobs.get(digest, ()))
+
+    def touch(self, key: KeyType, now: int = None):
+        """counts a hit, returns the entry or None if it's missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = now or time.time_ns()
+        if entry.is_expired(now):
+            return None
+        entry.accessed = now
+        entry.hits += 1
+        self._touched = True
+        return entry
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def values(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def allocate(self):
+        """reserves a file index, give it back with `release` if it's never inserted"""
+        with self._lock:
+            return self._slots.allocate()
+
+    def release(self, file_index: int):
+        with self._lock:
+            self._slots.release(file_index)
+
+    def _append(self, op: JournalOp, key: KeyType, entry: CacheEntry):
+        """needs the file lock, returns True if it's time to compact"""
+        dropped = []
+        self._apply(op, key, entry, dropped)
+        full = self._write(format_journal_record(op, key, entry), 1)
+        self._release_blobs(dropped)
+        return full
+
+    def _write(self, records: bytes, count: int):
+        # one write, so the records of a batch land together
+        self._journal.write(records)
+        self._journal_records += count
+        end = self._journal.tell()
+        if end - len(records) == self._journal_offset:
+            # nobody appended since the last refresh, no need to read it back
+            self._journal_offset = end
+        return self._journal_records >= self._compact_threshold
+
+    def insert(self, key: KeyType, entry: CacheEntry):
+        """returns the entry it replaced (with another file index or offset) or None"""
+        replaced = self.insert_many(((key, entry),))
+        return replaced[0] if replaced else None
+
+    def insert_many(self, items: Iterable[Tuple[KeyType, CacheEntry]]) -> List[CacheEntry]:
+        """
+        one lock & one journal write for all of them, returns the entries they replaced.
+        an entry with a digest is moved to the data of a live entry with the same digest, if there's one.
+        """
+        now = time.time_ns()
+        replaced = []
+        records = []
+        dropped = []
+        keys = []
+        with self._lock:
+            with self._file_lock.exclusive():
+                self._refresh()
+                for key, entry in items:
+                    keys.append(key)
+                    if not entry.created:
+                        entry.created = entry.accessed = now
+                    if entry.digest:
+                        blob = self.blob(entry.digest)
+                        if blob is not None:
+                            entry.share(blob)
+                    old = self._entries.get(key)
+                    if old is not None and not _same_place(old, entry):
+                        replaced.append(old)
+                    self._apply(JournalOp.FIELDS, key, entry, dropped)
+                    records.append(format_journal_record(JournalOp.FIELDS, key, entry))
+                # seen by the others before the records
+                over = self._bloom is not None and self._add_to_bloom(keys)
+                full = records and self._write(b''.join(records), len(records))
+                self._release_blobs(dropped)
+            if full or over:
+                self.compact(wait=False)
+            return replaced
+
+    def replace(self, key: KeyType, old: CacheEntry, entry: CacheEntry):
+        """inserts `entry` only if `key` still maps to `old`"""
+        with self._lock:
+            with self._file_lock.exclusive():
+                self._refresh()
+                if self._entries.get(key) is not old:
+                    return False
+                full = self._append(JournalOp.FIELDS, key, entry)
+            if full:
+                self.compact(wait=False)
+            return True
+
+    def delete(self, key: KeyType):
+        """returns the removed entry or None"""
+        with self._lock:
+            with self._file_lock.exclusive():
+                self._refresh()
+                entry = self._entries.get(key)
+                if entry is None:
+                    return None
+                full = self._append(JournalOp.DELETE, key, entry)
+            if full:
+                self.compact(wait=False)
+            return entry
+
+    # eviction
+
+    def expired(self, now: int = None) -> List[KeyType]:
+        now = now or time.time_ns()
+        with self._lock:
+            return [key for key, entry in self._entries.items() if entry.is_expired(now)]
+
+    def victims(self, max_size: int, policy: EvictionPolicy = EvictionPolicy.LRU) -> List[KeyType]:
+        """
+        least valuable keys, enough of them to bring the total size down to `max_size`.
+        the data of a digest only counts as freed with the last key referring to it.
+        """
+        with self._lock:
+            excess = self._total_size - max_size
+            if excess <= 0:
+                return []
+            if policy == EvictionPolicy.LRU:
+                order = sorted(self._entries.items(), key=lambda item: item[1].accessed)
+            elif policy == EvictionPolicy.LFU:
+                order = sorted(self._entries.items(), key=lambda item: (item[1].hits, item[1].accessed))
+            else:
+                raise ValueError(f'unsupported eviction policy: {policy}')
+            refs = {digest: len(holders) for digest, holders in self._blobs.items()}
+        result = []
+        for key, entry in order:
+            if excess <= 0:
+                break
+            result.append(key)
+            if entry.digest:
+                refs[entry.digest] -= 1
+                if refs[entry.digest]:
+                    continue
+            excess -= entry.size
+        return result
+
+    # compaction
+
+    def _write_snapshot(self, entries: Dict[KeyType, CacheEntry], fd: int):
+        try:
+            write_snapshot(self._path, entries, self._layout)
+            os.remove(self._old_journal_path)
+            if self._bloom is not None:
+                # deleted keys are dropped, and it's sized for the keys there are now
+                self._write_bloom(entries)
+                with self._lock, self._file_lock.exclusive():
+                    self._refresh()
+                    self._publish_bloom(entries)
+        finally:
+            FileLock.release(fd)
+
+    def compact(self, wait: bool = True):
+        """skipped while another process compacts"""
+        while True:
+            with self._lock:
+                compactor = self._compactor
+                if compactor is None or not compactor.is_alive():
+                    fd = self._compact_lock.acquire(blocking=False)
+                    if fd is None:
+                        return
+                    try:
+                        with self._file_lock.exclusive():
+                            self._refresh()
+                            if os.path.exists(self._old_journal_path):
+                                # left by a crash, its records must reach a snapshot before it's replaced
+                                write_snapshot(self._path, dict(self._entries), self._layout)
+                            # new inserts go to a fresh journal while the snapshot is written
+                            self._journal.close()
+                            os.replace(self._journal_path, self._old_journal_path)
+                            self._journal = open(self._journal_path, 'ab', buffering=0)
+                            stat = os.fstat(self._journal.fileno())
+                            self._journal_id = stat.st_dev, stat.st_ino
+                            self._journal_offset = self._journal_records = 0
+                            self._touched = False
+                            entries = dict(self._entries)
+                    except BaseException:
+                        FileLock.release(fd)
+                        raise
+                    compactor = self._compactor = threading.Thread(
+                        target=self._write_snapshot, args=(entries, fd), name='cache-index-compactor', daemon=True)
+                    compactor.start()
+                    break
+            if not wait:
+                return
+            compactor.join()
+        if wait:
+            compactor.join()
+
+    def close(self):
+        if self._touched:
+            # access metadata only lives in the snapshot
+            self.compact()
+        with self._lock:
+            compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        self._journal.close()
@@ -0,0 +1,195 @@
+import hashlib
+import inspect
+import pickle
+import struct
+from typing import Callable, Dict, Any, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DIGEST_SIZE = 16
+PICKLE_PROTOCOL = 4
+
+_length = struct.Struct('>Q')
+_float = struct.Struct('>d')
+
+
+def new_hasher():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+# canonical argument hashing: a type tag, then a length prefixed payload, so (b'ab', b'c') != (b'a', b'bc')
+
+def _update_bytes(hasher, tag: bytes, buffer):
+    hasher.update(tag)
+    hasher.update(_length.pack(len(buffer)))
+    hasher.update(buffer)
+
+
+def _update_none(hasher, value):
+    hasher.update(b'N')
+
+
+def _update_bool(hasher, value: bool):
+    hasher.update(b'T' if value else b'F')
+
+
+def _update_int(hasher, value: int):
+    _update_bytes(hasher, b'i', value.to_bytes((value.bit_length() + 8) // 8, byteorder='big', signed=True))
+
+
+def _update_float(hasher, value: float):
+    hasher.update(b'f')
+    hasher.update(_float.pack(value))
+
+
+def _update_str(hasher, value: str):
+    _update_bytes(hasher, b's', value.encode('utf-8', 'surrogatepass'))
+
+
+def _update_buffer(hasher, value):
+    view = memoryview(value)
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+    _update_bytes(hasher, b'b', view.cast('B'))
+
+
+def _update_sequence(hasher, value):
+    hasher.update(b'l' if isinstance(value, list) else b't')
+    hasher.update(_length.pack(len(value)))
+    for item in value:
+        update_hasher(hasher, item)
+
+
+def _digest(value):
+    hasher = new_hasher()
+    update_hasher(hasher, value)
+    return hasher.digest()
+
+
+def _update_dict(hasher, value: Dict):
+    # insertion order doesn't matter, so items are sorted by their own digests
+    hasher.update(b'd')
+    hasher.update(_length.pack(len(value)))
+    for item in sorted(_digest(key) + _digest(item) for key, item in value.items()):
+        hasher.update(item)
+
+
+def _update_set(hasher, value):
+    hasher.update(b'e')
+    hasher.update(_length.pack(len(value)))
+    for item in sorted(map(_digest, value)):
+        hasher.update(item)
+
+
+def _update_object(hasher, value):
+    try:
+        pickled = pickle.dumps(value, PICKLE_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as error:
+        raise TypeError(f'unhashable {type(value).__qualname__} value, it can\'t be pickled: {error}') from error
+    _update_bytes(hasher, b'p', pickled)
+
+
+_updaters: Dict[type, Callable[[Any, Any], None]] = {
+    type(None): _update_none,
+    bool: _update_bool,
+    int: _update_int,
+    float: _update_float,
+    str: _update_str,
+    bytes: _update_buffer,
+    bytearray: _update_buffer,
+    memoryview: _update_buffer,
+    tuple: _update_sequence,
+    list: _update_sequence,
+    dict: _update_dict,
+    set: _update_set,
+    frozenset: _update_set,
+}
+
+if numpy is not None:
+    def _update_ndarray(hasher, value):
+        hasher.update(b'a')
+        _update_str(hasher, value.dtype.str)
+        _update_sequence(hasher, value.shape)
+        if value.dtype.hasobject:
+            _update_sequence(hasher, value.tolist())
+        else:
+            _update_bytes(hasher, b'b', memoryview(numpy.ascontiguousarray(value)).cast('B'))
+
+    def _update_numpy_scalar(hasher, value):
+        hasher.update(b'g')
+        _update_str(hasher, value.dtype.str)
+        _update_bytes(hasher, b'b', value.tobytes())
+
+    _updaters[numpy.ndarray] = _update_ndarray
+
+
+def update_hasher(hasher, value):
+    updater = _updaters.get(type(value))
+    if updater is not None:
+        return updater(hasher, value)
+    # subclasses & less common types
+    if numpy is not None:
+        if isinstance(value, numpy.ndarray):
+            return _update_ndarray(hasher, value)
+        elif isinstance(value, numpy.generic):
+            return _update_numpy_scalar(hasher, value)
+    for _type, updater in _updaters.items():
+        if isinstance(value, _type):
+            return updater(hasher, value)
+    return _update_object(hasher, value)
+
+
+def _update_argument(hasher, name, value):
+    try:
+        update_hasher(hasher, value)
+    except TypeError as error:
+        raise TypeError(f'argument {name!r} can\'t be hashed for the cache key: {error}') from error
+
+
+def hash_arguments(args: Tuple, kwargs: Dict[str, Any]) -> bytes:
+    """raises `TypeError` naming the argument (or its position) that can't be hashed"""
+    hasher = new_hasher()
+    # as `_update_sequence(hasher, args)`
+    hasher.update(b't')
+    hasher.update(_length.pack(len(args)))
+    for position, value in enumerate(args):
+        _update_argument(hasher, position, value)
+    hasher.update(_length.pack(len(kwargs)))
+    for name in sorted(kwargs):
+        _update_str(hasher, name)
+        _update_argument(hasher, name, kwargs[name])
+    return hasher.digest()
+
+
+def bind_arguments(signature: inspect.Signature, args: Tuple, kwargs: Dict[str, Any]):
+    """`f(1)`, `f(x=1)` & `f(1, y=default)` all bind to the same arguments"""
+    try:
+        bound = signature.bind(*args, **kwargs)
+    except TypeError:
+        return args, kwargs  # the call itself will raise
+    bound.apply_defaults()
+    return (), bound.arguments
+
+
+def call_key(fingerprint: bytes, args: Tuple, kwargs: Dict[str, Any], signature: inspect.Signature = None) -> bytes:
+    if signature is not None:
+        args, kwargs = bind_arguments(signature, args, kwargs)
+    return fingerprint + hash_arguments(args, kwargs)
+
+
+# content addressing
+
+def content_hasher(buffer):
+    hasher = new_hasher()
+    _update_buffer(hasher, buffer)
+    return hasher
+
+
+def content_digest(hasher, codec: int = 0) -> int:
+    """digest of the content hashed by `content_hasher`, as stored with `codec`, never 0"""
+    hasher = hasher.copy()
+    _update_int(hasher, codec)
+    return int.from_bytes(hasher.digest(), byteorder='big') or 1
@@ -0,0 +1,140 @@
+import json
+import threading
+from collections import defaultdict
+from sys import stdout
+from typing import Callable, Dict, Optional
+
+from library.types.table import Table
+from library.utils import DotDict, to_human_size
+
+COUNTERS = 'hits', 'misses', 'inserts', 'evictions', 'bytes_written', 'bytes_read'
+LATENCIES = 'lookup', 'read', 'deserialize', 'compute'
+PERCENTILES = 50, 90, 99
+# bucket i holds the durations of [2 ** (i - 1), 2 ** i) nanoseconds
+HISTOGRAM_BUCKETS = 48
+
+
+class Histogram:
+    """durations in nanoseconds, by powers of two: percentiles are upper bounds within a factor of two"""
+    __slots__ = 'buckets', 'count', 'total', 'min', 'max'
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def observe(self, nanoseconds: int):
+        self.buckets[min(max(nanoseconds, 0).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        if not self.count or nanoseconds < self.min:
+            self.min = nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+        self.count += 1
+        self.total += nanoseconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, percent: float):
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(1 << index, self.max)
+        return self.max
+
+    def snapshot(self):
+        """microseconds"""
+        result = DotDict(count=self.count, mean_us=self.mean / 1e3, min_us=self.min / 1e3, max_us=self.max / 1e3)
+        for percent in PERCENTILES:
+            result[f'p{percent}_us'] = self.percentile(percent) / 1e3
+        return result
+
+
+class CacheMetrics:
+    """
+    counters by data type & latency histograms of a `CacheFolder`, thread safe.
+    `gauges` returns the current values of things like the stored size, they're read by `snapshot`.
+    """
+    __slots__ = '_counters', '_latencies', '_lock', '_gauges'
+
+    def __init__(self, gauges: Callable[[], Dict[str, int]] = None):
+        self._counters: Dict[str, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self._latencies: Dict[str, Histogram] = {name: Histogram() for name in LATENCIES}
+        self._lock = threading.Lock()
+        self._gauges = gauges
+
+    def count(self, data_type, name: str, value: int = 1):
+        with self._lock:
+            self._counters[getattr(data_type, 'name', str(data_type))][name] += value
+
+    def observe(self, name: str, nanoseconds: int):
+        with self._lock:
+            self._latencies[name].observe(nanoseconds)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            for name in LATENCIES:
+                self._latencies[name] = Histogram()
+
+    def snapshot(self):
+        """plain dicts & numbers, ready for json"""
+        with self._lock:
+            counters = {data_type: dict(values) for data_type, values in self._counters.items()}
+            latencies = {name: histogram.snapshot() for name, histogram in self._latencies.items()}
+        total = dict.fromkeys(COUNTERS, 0)
+        for values in counters.values():
+            for name, value in values.items():
+                total[name] += value
+        return DotDict(counters=counters, total=total, latencies=latencies,
+                       gauges=dict(self._gauges()) if self._gauges is not None else {})
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    @staticmethod
+    def _hit_rate(values: Dict[str, int]):
+        lookups = values['hits'] + values['misses']
+        return f'{values["hits"] / lookups:.2%}' if lookups else '-'
+
+    def counters_table(self, snapshot: Optional[dict] = None):
+        snapshot = snapshot or self.snapshot()
+        table = Table()
+        table.set_titles('data type', 'hits', 'misses', 'hit rate', 'inserts', 'evictions', 'written', 'read')
+        rows = sorted(snapshot['counters'].items())
+        rows.append(('total', snapshot['total']))
+        for data_type, values in rows:
+            table.add_row(data_type, str(values['hits']), str(values['misses']), self._hit_rate(values),
+                          str(values['inserts']), str(values['evictions']), to_human_size(values['bytes_written']),
+                          to_human_size(values['bytes_read']))
+        return table
+
+    def latency_table(self, snapshot: Optional[dict] = None):
+        snapshot = snapshot or self.snapshot()
+        table = Table()
+        table.set_titles('latency', 'count', 'mean', *(f'p{percent}' for percent in PERCENTILES), 'max')
+        for name, values in snapshot['latencies'].items():
+            table.add_row(name, str(values['count']), f'{values["mean_us"]:.1f} us',
+                          *(f'{values[f"p{percent}_us"]:.1f} us' for percent in PERCENTILES),
+                          f'{values["max_us"]:.1f} us')
+        return table
+
+    def print(self, file=stdout):
+        snapshot = self.snapshot()
+        self.counters_table(snapshot).print(file=file)
+        print(file=file)
+        self.latency_table(snapshot).print(file=file)
+        if snapshot['gauges']:
+            print(file=file)
+            table = Table()
+            table.set_titles('gauge', 'value')
+            for name, value in snapshot['gauges'].items():
+                table.add_row(name, str(value))
+            table.print(file=file)
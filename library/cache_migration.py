@@ -0,0 +1,182 @@
+import argparse
+import json
+import sys
+from os import path
+from typing import Any, Callable, Iterator, List, Tuple
+
+from library.cache_folder import CacheFolder, ReadWriteWrapper, title_key
+from library.sio import BinaryFile
+from library.utils import run_main, to_human_size
+
+# `archive/data_cache.py`
+LEGACY_INFO_NAME = '.cache_info'
+LEGACY_CHUNK_SIZE = 1 << 16
+
+LegacyReadWrite = Tuple[Callable[[BinaryFile], Any], Callable[[Any, BinaryFile], None]]
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_NUMBER_START = '-0123456789'
+_NUMBER_CHARACTERS = '+-.0123456789eE'
+
+
+def legacy_path(dir_name: str, index: int):
+    return path.join(dir_name, f'{index}.bin')
+
+
+def legacy_read_write(read_write: LegacyReadWrite):
+    """the `(read, write)` pair of `DataCache.cached_function` as a `ReadWriteWrapper`"""
+    read, write = read_write
+    return ReadWriteWrapper(lambda wrapper: read(wrapper.file), lambda wrapper, data: write(data, wrapper.file))
+
+
+class _JsonReader:
+    """a json document read in chunks, a value at a time, so a huge object is never loaded whole"""
+    __slots__ = '_file', '_chunk_size', '_buffer', '_position', '_eof'
+
+    def __init__(self, file, chunk_size: int = LEGACY_CHUNK_SIZE):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    def _fill(self):
+        data = self._file.read(self._chunk_size)
+        if not data:
+            self._eof = True
+        self._buffer = self._buffer[self._position:] + data
+        self._position = 0
+
+    def peek(self):
+        """the next character that isn't whitespace"""
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in _WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if self._eof:
+                raise ValueError('unexpected end of json document')
+            self._fill()
+
+    def expect(self, characters: str):
+        """consumes the next character, which must be one of `characters`"""
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(f'unexpected character in json document: {character!r}')
+        self._position += 1
+        return character
+
+    def value(self):
+        if self.peek() in _NUMBER_START:
+            # `1.5e` of `1.5e3` would parse as `1.5`, the whole number is read first
+            while not self._eof:
+                end = self._position
+                while end < len(self._buffer) and self._buffer[end] in _NUMBER_CHARACTERS:
+                    end += 1
+                if end < len(self._buffer):
+                    break
+                self._fill()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            self._position = end
+            return value
+
+
+def read_legacy_titles(dir_name: str) -> Iterator[Tuple[str, int]]:
+    """`(title, file index)` pairs of a legacy directory, streamed from its info file"""
+    try:
+        infile = open(path.join(dir_name, LEGACY_INFO_NAME), 'rt')
+    except FileNotFoundError:
+        return
+    with infile:
+        reader = _JsonReader(infile)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name != 'titles':
+                reader.value()
+            elif reader.expect('{') == '{' and reader.peek() == '}':
+                reader.expect('}')
+            else:
+                while True:
+                    title = reader.value()
+                    reader.expect(':')
+                    yield title, reader.value()
+                    if reader.expect(',}') == '}':
+                        break
+            if reader.expect(',}') == '}':
+                return
+
+
+def migrate_data_cache(dir_name: str, folder: CacheFolder, move: bool = False):
+    """
+    adopts every value of a legacy directory as a title of `folder` in one pass, the data files are hard linked
+    (or moved) & the legacy cache keeps working meanwhile. titles already in `folder` are replaced.
+    """
+    return folder.adopt_files(((title_key(title), legacy_path(dir_name, index))
+                               for title, index in read_legacy_titles(dir_name)), move)
+
+
+class LegacyDataCache:
+    """
+    `archive/data_cache.py:DataCache` on a `CacheFolder`: the same `cached_function`, without rewriting an info file.
+    titles of `legacy_dir` that aren't in the folder yet are adopted from it on first use.
+    """
+    __slots__ = '_folder', '_legacy_dir', '_legacy_titles'
+
+    def __init__(self, folder: CacheFolder, legacy_dir: str = None):
+        self._folder = folder
+        self._legacy_dir = legacy_dir
+        self._legacy_titles = None
+
+    @property
+    def folder(self):
+        return self._folder
+
+    def __adopt(self, title: str):
+        if self._legacy_dir is None:
+            return False
+        if self._legacy_titles is None:
+            self._legacy_titles = dict(read_legacy_titles(self._legacy_dir))
+        index = self._legacy_titles.get(title)
+        if index is None:
+            return False
+        return self._folder.adopt_files([(title_key(title), legacy_path(self._legacy_dir, index))]).files > 0
+
+    def cached_function(self, title: str, read_write: LegacyReadWrite, function, *args, **kwargs):
+        key = title_key(title)
+        rw = legacy_read_write(read_write)
+        missing = object()
+        data = self._folder.get(key, rw, missing)
+        if data is missing and self.__adopt(title):
+            data = self._folder.get(key, rw, missing)
+        if data is missing:
+            data = function(*args, **kwargs)
+            self._folder.put(key, data, rw)
+        return data
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog=argv[0], description='import a legacy DataCache directory into a CacheFolder')
+    parser.add_argument('legacy_dir')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--move', action='store_true', help='remove the legacy data files once imported')
+    args = parser.parse_args(argv[1:])
+
+    with CacheFolder(args.cache_dir) as folder:
+        result = migrate_data_cache(args.legacy_dir, folder, args.move)
+    print(f'{result.files} files ({to_human_size(result.size)}) imported, {result.missing} missing', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    run_main(main)
@@ -0,0 +1,98 @@
+import io
+import mmap
+import pickle
+from typing import Any, List
+
+from library.cache_folder import ReadWriteWrapper
+from library.sio import FileWrapper
+
+PICKLE_MAGIC = b'CFP5'
+PICKLE_PROTOCOL = 5
+# out of band buffers start at multiples of this, counted from the start of the value
+BUFFER_ALIGNMENT = 64
+# smaller buffers stay in the pickle
+OUT_OF_BAND_MIN_SIZE = 4096
+
+count_settings = {
+    'size': 4,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+length_settings = {
+    'size': 8,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+
+def _align(position: int):
+    return -(-position // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+
+
+def write_pickle(wrapper: FileWrapper, instance: Any):
+    """
+    pickle protocol 5 with the large buffers (numpy arrays, bytearrays, ...) out of band:
+    the pickle comes first, then every buffer as it is in memory, aligned. `bytes` are always pickled in band.
+    """
+    buffers: List[memoryview] = []
+
+    def __buffer_callback(buffer: pickle.PickleBuffer):
+        raw = buffer.raw()
+        if raw.nbytes < OUT_OF_BAND_MIN_SIZE:
+            # in band
+            return True
+        buffers.append(raw)
+        return False
+
+    data = io.BytesIO()
+    pickle.Pickler(data, protocol=PICKLE_PROTOCOL, buffer_callback=__buffer_callback).dump(instance)
+    pickled = data.getvalue()
+
+    total = wrapper.write_bytes(PICKLE_MAGIC)  # magic
+    total += wrapper.write_int(len(buffers), **count_settings)  # buffer count
+    total += wrapper.write_int(len(pickled), **length_settings)  # pickle length
+    for buffer in buffers:
+        total += wrapper.write_int(buffer.nbytes, **length_settings)  # buffer length
+    total += wrapper.write_bytes(pickled)  # pickle
+    for buffer in buffers:
+        padding = _align(total) - total
+        if padding:
+            total += wrapper.write_bytes(bytes(padding))  # padding
+        total += wrapper.write_bytes(buffer)  # buffer
+    return total
+
+
+def _value_view(file):
+    """the whole value under `file`, from a buffer it wraps or a read only map of it"""
+    getbuffer = getattr(file, 'getbuffer', None)
+    if getbuffer is not None:
+        return getbuffer()
+    return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def read_pickle(wrapper: FileWrapper):
+    """the out of band buffers are read only views of the cached value (a map of its file), nothing is copied"""
+    start = wrapper.file.tell()
+    magic = wrapper.read_bytes(len(PICKLE_MAGIC))  # magic
+    if magic != PICKLE_MAGIC:
+        raise ValueError(f'unsupported pickle magic: {magic!r}')
+    count = wrapper.read_int(**count_settings)  # buffer count
+    pickle_length = wrapper.read_int(**length_settings)  # pickle length
+    lengths = [wrapper.read_int(**length_settings) for step in range(count)]  # buffer lengths
+    view = _value_view(wrapper.file)[start:]
+    position = wrapper.file.tell() - start
+    pickled = view[position:position + pickle_length]
+    position += pickle_length
+    buffers = []
+    for length in lengths:
+        position = _align(position)
+        buffers.append(view[position:position + length])
+        position += length
+    if position > len(view):
+        raise EOFError(f'while reading {position} bytes of pickled value')
+    return pickle.loads(pickled, buffers=buffers)
+
+
+# `CacheFolder.cached_call(rw=PICKLE)`
+PICKLE = ReadWriteWrapper(read_pickle, write_pickle)
@@ -1,14 +1,16 @@
+import io
 import secrets
 import sys
-from collections import defaultdict
+from collections import Counter
 from dataclasses import dataclass
 from enum import IntEnum, auto
-from typing import Callable, Union, Tuple, Dict
+from typing import Callable, Union, Tuple, Dict, Iterable, List
 
 from sortedcontainers import SortedList
 
 from library.math import ceil_module
-from library.sio import AnyFile, FileWrapper, BitsIO, bits_mask, from_bytes
+from library.sio import (AnyFile, BinaryFile, BufferType, FileWrapper, BitsIO, BitsWriter, bits_mask, from_bytes,
+                         to_bytes)
 from library.utils import to_machine_size, StopWatch
 
 RandBytes = Callable[[int], bytes]
@@ -66,12 +68,133 @@ class Method(IntEnum):
 
     @staticmethod
     def read(wrapper: FileWrapper):
-        return Method(wrapper.read_unsigned_int(1))
+        value = wrapper.read_unsigned_int(1)
+        try:
+            return Method(value)
+        except ValueError:
+            if value in method_handlers:
+                return value
+            raise
 
     def write(self, wrapper: FileWrapper):
         wrapper.write_unsigned_int(self.value, 1)
 
 
+MethodType = Union[Method, int]
+
+
+class MethodHandler:
+    """how the data of a `Method` is split, joined, stored & printed"""
+    __slots__ = ()
+
+    def split(self, buffer: bytes, data_bits: int) -> Tuple[List[DataType], DataType]:
+        raise NotImplementedError
+
+    def join(self, data: Iterable[DataType], remaining: DataType, data_bits: int, remaining_bits: int) -> bytes:
+        raise NotImplementedError
+
+    def write_data(self, wrapper: FileWrapper, data: DataType, size: int):
+        raise NotImplementedError
+
+    def read_data(self, wrapper: FileWrapper, size: int) -> DataType:
+        raise NotImplementedError
+
+    def format_data(self, data: DataType, bits: int) -> str:
+        raise NotImplementedError
+
+
+class IntMethodHandler(MethodHandler):
+    __slots__ = ()
+
+    def split(self, buffer: bytes, data_bits: int):
+        if data_bits == 8:
+            return list(buffer), 0
+        elif data_bits % 8 == 0:
+            data_size = data_bits // 8
+            max_index = len(buffer) - (len(buffer) % data_size)
+            return [from_bytes(buffer[index:index + data_size]) for index in range(0, max_index, data_size)], \
+                from_bytes(buffer[max_index:])
+        bits_io = BitsIO(buffer, data_bits)
+        return list(bits_io), bits_io.remaining()
+
+    def join(self, data: Iterable[DataType], remaining: DataType, data_bits: int, remaining_bits: int):
+        if data_bits == 8:
+            return bytes(data)
+        elif data_bits % 8 == 0:
+            data_size = data_bits // 8
+            remaining_size = get_bytes_per_bits(remaining_bits)
+            return b''.join(to_bytes(value, data_size) for value in data) + to_bytes(remaining, remaining_size)
+        writer = BitsWriter()
+        for value in data:
+            writer.write(value, data_bits)
+        writer.write(remaining, remaining_bits)
+        return writer.getvalue()
+
+    def write_data(self, wrapper: FileWrapper, data: DataType, size: int):
+        return wrapper.write_unsigned_int(data, size)
+
+    def read_data(self, wrapper: FileWrapper, size: int):
+        return wrapper.read_unsigned_int(size)
+
+    def format_data(self, data: DataType, bits: int):
+        return f'{data:0>{bits}b}'
+
+
+class ByteMethodHandler(MethodHandler):
+    __slots__ = ()
+
+    def split(self, buffer: bytes, data_bits: int):
+        if data_bits % 8 != 0:
+            raise ValueError(f'{data_bits} data bits is not supported in {Method.BYTE}')
+        data_size = data_bits // 8
+        max_index = len(buffer) - (len(buffer) % data_size)
+        return [bytes(buffer[index:index + data_size]) for index in range(0, max_index, data_size)], \
+            bytes(buffer[max_index:])
+
+    def join(self, data: Iterable[DataType], remaining: DataType, data_bits: int, remaining_bits: int):
+        return b''.join(data) + remaining
+
+    def write_data(self, wrapper: FileWrapper, data: DataType, size: int):
+        return wrapper.write_bytes(data)
+
+    def read_data(self, wrapper: FileWrapper, size: int):
+        data = wrapper.read_bytes(size)
+        if len(data) != size:
+            raise EOFError(f'while reading {size} bytes data')
+        return data
+
+    def format_data(self, data: DataType, bits: int):
+        return data.hex()
+
+
+method_handlers: Dict[int, MethodHandler] = {
+    Method.INT: IntMethodHandler(),
+    Method.BYTE: ByteMethodHandler(),
+}
+
+
+def register_method(method: MethodType, handler: MethodHandler):
+    if method in method_handlers:
+        raise ValueError(f'method is already registered: {method}')
+    method_handlers[method] = handler
+
+
+def get_method_handler(method: MethodType) -> MethodHandler:
+    try:
+        return method_handlers[method]
+    except KeyError:
+        raise ValueError(f'unsupported method: {method}')
+
+
+def split_data(buffer: bytes, data_bits: int, method: MethodType = Method.INT) -> Tuple[List[DataType], DataType]:
+    return get_method_handler(method).split(buffer, data_bits)
+
+
+def join_data(data: Iterable[DataType], remaining: DataType, data_bits: int, remaining_bits: int,
+              method: MethodType = Method.INT) -> bytes:
+    return get_method_handler(method).join(data, remaining, data_bits, remaining_bits)
+
+
 @dataclass(init=False, repr=False, eq=True)
 class SegmentedBuffer:
     __slots__ = ('buffer_size', 'buffer_bits', 'data_bits', 'data_size', 'method', 'sorted_data_count',
@@ -84,7 +207,7 @@ class SegmentedBuffer:
         self.data_bits: int = 0
         self.data_size: int = 0
 
-        self.method: Method = Method.UNDEFINED
+        self.method: MethodType = Method.UNDEFINED
         self.sorted_data_count: SortedList[DataCount] = SortedList()
 
         self.remaining_bits: int = 0
@@ -102,57 +225,37 @@ class SegmentedBuffer:
         _print_bits_size('buffer', self.buffer_bits, self.buffer_size, file=file)
         _print_bits_size('data', self.data_bits, self.data_size, file=file)
 
-        if self.method == Method.INT:
-            def print_data_count(item: DataCount):
-                return print(f'-\t{item.data:0>{self.data_bits}b}: {item.count}', file=file)
-        else:
-            raise ValueError(f'unsupported method: {self.method}')
-
+        handler = get_method_handler(self.method)
         for data_count in self.sorted_data_count:
-            print_data_count(data_count)
+            print(f'-\t{handler.format_data(data_count.data, self.data_bits)}: {data_count.count}', file=file)
 
         _print_bits_size('remaining', self.remaining_bits, self.remaining_size, file=file)
-        if self.method == Method.INT:
-            print(f'-\t{self.remaining:0>{self.remaining_bits}b}')
+        print(f'-\t{handler.format_data(self.remaining, self.remaining_bits)}', file=file)
 
     # write, read
 
     def _write_sorted_data_count(self, wrapper: FileWrapper, size_of_size: int):
+        handler = get_method_handler(self.method)
         wrapper.write_unsigned_int(len(self.sorted_data_count), size_of_size)
-        if self.method == Method.INT:
-            for data_count in self.sorted_data_count:
-                wrapper.write_unsigned_int(data_count.data, self.data_size)
-                wrapper.write_unsigned_int(data_count.count, size_of_size)
-        else:
-            raise ValueError(f'unsupported method: {self.method}')
+        for data_count in self.sorted_data_count:
+            handler.write_data(wrapper, data_count.data, self.data_size)
+            wrapper.write_unsigned_int(data_count.count, size_of_size)
 
     def _read_sorted_data_count(self, wrapper: FileWrapper, size_of_size: int):
+        handler = get_method_handler(self.method)
         length = wrapper.read_unsigned_int(size_of_size)
-        self.sorted_data_count = SortedList()
-        if self.method == Method.INT:
-            for step in range(length):
-                data = wrapper.read_unsigned_int(self.data_size)
-                count = wrapper.read_unsigned_int(size_of_size)
-                self.sorted_data_count.add(DataCount(data, count))
-        else:
-            raise ValueError(f'unsupported method: {self.method}')
-        return SortedList()
+        count_dict = {}
+        for step in range(length):
+            data = handler.read_data(wrapper, self.data_size)
+            count_dict[data] = wrapper.read_unsigned_int(size_of_size)
+        self.sorted_data_count = SegmentedBuffer._sort_count_dict(count_dict)
+        return self.sorted_data_count
 
     def _write_remaining(self, wrapper: FileWrapper, size_of_size: int):
-        if self.method == Method.INT:
-            wrapper.write_unsigned_int(self.remaining, self.remaining_size)
-        elif self.method == Method.BYTE:
-            wrapper.write_bytes(self.remaining)
-        else:
-            raise ValueError(f'unsupported method: {self.method}')
+        get_method_handler(self.method).write_data(wrapper, self.remaining, self.remaining_size)
 
     def _read_remaining(self, wrapper: FileWrapper):
-        if self.method == Method.INT:
-            self.remaining = wrapper.read_unsigned_int(self.remaining_size)
-        elif self.method == Method.BYTE:
-            self.remaining = wrapper.read_bytes(self.remaining_size)
-        else:
-            raise ValueError(f'unsupported method: {self.method}')
+        self.remaining = get_method_handler(self.method).read_data(wrapper, self.remaining_size)
 
     def write(self, wrapper: FileWrapper, size_of_size: int = 4):
         wrapper.write_unsigned_int(size_of_size, 1)  # size of size
@@ -162,7 +265,7 @@ class SegmentedBuffer:
         wrapper.write_unsigned_int(self.data_size, size_of_size)  # data size
         wrapper.write_unsigned_int(self.remaining_bits, size_of_size)  # remaining bits
         wrapper.write_unsigned_int(self.remaining_size, size_of_size)  # remaining size
-        self.method.write(wrapper)  # method
+        wrapper.write_unsigned_int(self.method, 1)  # method
         # sorted data count & remaining
         self._write_sorted_data_count(wrapper, size_of_size)
         self._write_remaining(wrapper, size_of_size)
@@ -190,40 +293,26 @@ class SegmentedBuffer:
     def static_write(wrapper: FileWrapper, instance: 'SegmentedBuffer', size_of_size: int = 4):
         return instance.write(wrapper, size_of_size=size_of_size)
 
+    # split & join data
+    def split(self, buffer: bytes):
+        return split_data(buffer, self.data_bits, self.method)
+
+    def join(self, data: Iterable[DataType], remaining: DataType = None):
+        if remaining is None:
+            remaining = self.remaining
+        return join_data(data, remaining, self.data_bits, self.remaining_bits, self.method)
+
     # scan & sort data count
     def _scan_data_count(self, buffer: bytes):
-        if self.method == Method.BYTE:
-            if self.data_bits % 8 == 0:
-                max_index = self.buffer_size - self.remaining_size
-                count_dict = defaultdict(lambda: 1)
-                for index in range(0, max_index, self.data_size):
-                    count_dict[buffer[index:index + self.data_size]] += 1
-                return count_dict, buffer[max_index:]
-            else:
-                raise ValueError(f'{self.data_bits} data bits is not supported in {self.method}')
-        elif self.method == Method.INT:
-            count_dict = defaultdict(lambda: 0)
-            if self.data_bits == 8:
-                for value in buffer:
-                    count_dict[value] += 1
-                return count_dict, 0
-            elif self.data_bits % 8 == 0:
-                max_index = self.data_size - self.remaining_size
-                for index in range(0, max_index, self.data_size):
-                    count_dict[from_bytes(buffer[index:index + self.data_size])] += 1
-                return count_dict, from_bytes(buffer[max_index:])
-            else:
-                bits_io = BitsIO(buffer, self.data_bits)
-                for value in bits_io:
-                    count_dict[value] += 1
-                return count_dict, bits_io.remaining()
+        data, remaining = self.split(buffer)
+        return Counter(data), remaining
 
     @staticmethod
     def _sort_count_dict(count_dict: Dict):
         return SortedList((DataCount(key, value) for key, value in count_dict.items()), key=lambda item: item.count)
 
     @staticmethod
-    def scan_buffer(data_bits: int, buffer: bytes, method: Method = Method.INT):
+    def scan_buffer(data_bits: int, buffer: bytes, method: MethodType = Method.INT):
         if data_bits <= 1:
             raise ValueError(f'invalid data bits: {data_bits}')
         elif data_bits > 1024:
@@ -261,5 +350,246 @@ class SegmentedBuffer:
         raise BaseException('incomplete code!')
 
 
+# stages & pipelines
+
+class StageKind(IntEnum):
+    UNDEFINED = auto()
+    TRANSFORM = auto()
+    MODELER = auto()
+    ENTROPY = auto()
+
+
+class Stage:
+    __slots__ = 'stage_id', 'name'
+    kind = StageKind.UNDEFINED
+
+    def __init__(self, stage_id: int, name: str):
+        self.stage_id = stage_id
+        self.name = name
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.stage_id}, {self.name!r})'
+
+
+class Transform(Stage):
+    """reversible bytes to bytes stage"""
+    __slots__ = ()
+    kind = StageKind.TRANSFORM
+
+    def encode(self, view: memoryview) -> BufferType:
+        raise NotImplementedError
+
+    def decode(self, view: memoryview) -> BufferType:
+        raise NotImplementedError
+
+
+class Modeler(Stage):
+    """builds the model (count table) that an `EntropyCoder` codes the data with"""
+    __slots__ = ()
+    kind = StageKind.MODELER
+
+    def scan(self, view: memoryview):
+        raise NotImplementedError
+
+    def write(self, wrapper: FileWrapper, model):
+        raise NotImplementedError
+
+    def read(self, wrapper: FileWrapper):
+        raise NotImplementedError
+
+
+class EntropyCoder(Stage):
+    __slots__ = ()
+    kind = StageKind.ENTROPY
+
+    def encode(self, wrapper: FileWrapper, view: memoryview, model):
+        raise NotImplementedError
+
+    def decode(self, wrapper: FileWrapper, model) -> BufferType:
+        raise NotImplementedError
+
+
+class SegmentedModeler(Modeler):
+    __slots__ = 'data_bits', 'method'
+
+    def __init__(self, stage_id: int, name: str, data_bits: int, method: MethodType = Method.INT):
+        super().__init__(stage_id, name)
+        self.data_bits = data_bits
+        self.method = method
+
+    def scan(self, view: memoryview):
+        return SegmentedBuffer.scan_buffer(self.data_bits, view, self.method)
+
+    def write(self, wrapper: FileWrapper, model: SegmentedBuffer):
+        return model.write(wrapper)
+
+    def read(self, wrapper: FileWrapper):
+        return SegmentedBuffer.static_read(wrapper)
+
+
+stages: Dict[int, Stage] = {}
+pipelines: Dict[int, 'Pipeline'] = {}
+_pipeline_names: Dict[str, 'Pipeline'] = {}
+
+
+def register_stage(stage: Stage):
+    if stage.stage_id in stages:
+        raise ValueError(f'stage id is already registered: {stage.stage_id}')
+    stages[stage.stage_id] = stage
+    return stage
+
+
+def get_stage(stage_id: int) -> Stage:
+    _load_builtin_pipelines()
+    try:
+        return stages[stage_id]
+    except KeyError:
+        raise ValueError(f'unsupported stage: {stage_id}')
+
+
+class Pipeline:
+    """transforms, then optionally a modeler & an entropy coder"""
+    __slots__ = 'pipeline_id', 'name', 'transforms', 'modeler', 'entropy_coder'
+
+    def __init__(self, pipeline_id: int, name: str, chain: Iterable[Stage]):
+        self.pipeline_id = pipeline_id
+        self.name = name
+        self.transforms: List[Transform] = []
+        self.modeler: Modeler = None
+        self.entropy_coder: EntropyCoder = None
+        for stage in chain:
+            if self.modeler is None and stage.kind == StageKind.TRANSFORM:
+                self.transforms.append(stage)
+            elif self.modeler is None and stage.kind == StageKind.MODELER:
+                self.modeler = stage
+            elif self.modeler is not None and self.entropy_coder is None and stage.kind == StageKind.ENTROPY:
+                self.entropy_coder = stage
+            else:
+                raise ValueError(f'invalid stage order in {name!r}: {stage}')
+        if (self.modeler is None) != (self.entropy_coder is None):
+            raise ValueError(f'modeler & entropy coder should come together in {name!r}')
+
+    def __repr__(self):
+        return f'Pipeline({self.pipeline_id}, {self.name!r})'
+
+    @property
+    def chain(self):
+        if self.modeler is None:
+            return list(self.transforms)
+        return self.transforms + [self.modeler, self.entropy_coder]
+
+    def encode(self, buffer) -> BufferType:
+        view = memoryview(buffer)
+        for transform in self.transforms:
+            view = memoryview(transform.encode(view))
+        if self.modeler is None:
+            return view
+        outfile = io.BytesIO()
+        wrapper = FileWrapper(outfile)
+        model = self.modeler.scan(view)
+        self.modeler.write(wrapper, model)
+        self.entropy_coder.encode(wrapper, view, model)
+        return outfile.getbuffer()
+
+    def decode(self, buffer) -> BufferType:
+        view = memoryview(buffer)
+        if self.modeler is not None:
+            wrapper = FileWrapper(io.BytesIO(view))
+            view = memoryview(self.entropy_coder.decode(wrapper, self.modeler.read(wrapper)))
+        for transform in reversed(self.transforms):
+            view = memoryview(transform.decode(view))
+        return view
+
+    def write(self, wrapper: FileWrapper, buffer):
+        payload = self.encode(buffer)
+        total = wrapper.write_unsigned_int(self.pipeline_id, 1)  # pipeline id
+        total += wrapper.write_big_int(len(payload), signed=False)  # payload size
+        return total + wrapper.write_bytes(payload)  # payload
+
+    @staticmethod
+    def read(wrapper: FileWrapper) -> BufferType:
+        pipeline = get_pipeline(wrapper.read_unsigned_int(1))  # pipeline id
+        size = wrapper.read_big_int(signed=False)  # payload size
+        payload = wrapper.read_bytes(size)  # payload
+        if len(payload) != size:
+            raise EOFError(f'while reading {size} bytes payload')
+        return pipeline.decode(payload)
+
+
+def register_pipeline(pipeline_id: int, name: str, chain: Iterable[Union[Stage, int]]):
+    if pipeline_id in pipelines:
+        raise ValueError(f'pipeline id is already registered: {pipeline_id}')
+    if name in _pipeline_names:
+        raise ValueError(f'pipeline name is already registered: {name!r}')
+    pipeline = Pipeline(pipeline_id, name, (stage if isinstance(stage, Stage) else stages[stage] for stage in chain))
+    pipelines[pipeline_id] = _pipeline_names[name] = pipeline
+    return pipeline
+
+
+def get_pipeline(pipeline: Union[int, str]) -> Pipeline:
+    _load_builtin_pipelines()
+    try:
+        if isinstance(pipeline, str):
+            return _pipeline_names[pipeline]
+        return pipelines[pipeline]
+    except KeyError:
+        raise ValueError(f'unsupported pipeline: {pipeline!r}')
+
+
+def all_pipelines() -> List[Pipeline]:
+    _load_builtin_pipelines()
+    return [pipelines[pipeline_id] for pipeline_id in sorted(pipelines)]
+
+
+def _load_builtin_pipelines():
+    # stages live next to their algorithms, which import this module
+    import library.pipelines  # noqa: F401
+
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+class StreamDriver:
+    """pushes chunks of a file through a pipeline; each chunk is read into one reused buffer"""
+    __slots__ = '_pipeline', '_chunk_size'
+
+    def __init__(self, pipeline: Union[Pipeline, int, str], chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self._pipeline = pipeline if isinstance(pipeline, Pipeline) else get_pipeline(pipeline)
+        self._chunk_size = chunk_size
+
+    def compress(self, infile: BinaryFile, outfile: BinaryFile):
+        wrapper = FileWrapper(outfile)
+        total = wrapper.write_unsigned_int(self._pipeline.pipeline_id, 1)  # pipeline id
+        total += wrapper.write_big_int(self._chunk_size, signed=False)  # chunk size
+        chunk = bytearray(self._chunk_size)
+        view = memoryview(chunk)
+        while True:
+            size = infile.readinto(chunk)
+            if not size:
+                break
+            payload = self._pipeline.encode(view[:size])
+            total += wrapper.write_big_int(len(payload), signed=False)  # payload size
+            total += wrapper.write_bytes(payload)  # payload
+        return total + wrapper.write_big_int(0, signed=False)  # end
+
+    @staticmethod
+    def decompress(infile: BinaryFile, outfile: BinaryFile):
+        wrapper = FileWrapper(infile)
+        pipeline = get_pipeline(wrapper.read_unsigned_int(1))  # pipeline id
+        chunk_size = wrapper.read_big_int(signed=False)  # chunk size
+        payload = bytearray(chunk_size)
+        total = 0
+        while True:
+            size = wrapper.read_big_int(signed=False)  # payload size
+            if size == 0:
+                return total
+            if size > len(payload):
+                payload = bytearray(size)
+            view = memoryview(payload)[:size]
+            if infile.readinto(view) != size:
+                raise EOFError(f'while reading {size} bytes payload')
+            total += outfile.write(pipeline.decode(view))
+
+
 class DataTree:
     pass
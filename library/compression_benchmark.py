@@ -0,0 +1,194 @@
+import argparse
+import bz2
+import json
+import lzma
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Tuple, Iterable
+
+from library.compression import Pipeline, SegmentedModeler, all_pipelines
+from library.pipelines import ENTROPY
+from library.types.table import Table
+from library.utils import to_machine_size, to_human_size, run_main
+
+DEFAULT_SEED = 0
+DEFAULT_SIZE = 1 << 16
+DEFAULT_DATA_BITS = 4, 8, 12, 16
+
+Codec = Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]
+
+
+# corpus
+
+def random_corpus(size: int, rand: random.Random):
+    return rand.randbytes(size)
+
+
+def skewed_corpus(size: int, rand: random.Random, alpha: float = 0.25):
+    # geometric-like distribution, a few bytes dominate
+    return bytes(min(int(rand.expovariate(alpha)), 255) for step in range(size))
+
+
+def text_corpus(size: int, rand: random.Random, words_number: int = 2000):
+    letters = 'etaoinshrdlcumwfgypbvkjxqz'
+    weights = [len(letters) - index for index in range(len(letters))]
+    words = [''.join(rand.choices(letters, weights, k=rand.randint(1, 10))) for step in range(words_number)]
+    word_weights = [1 / (index + 1) for index in range(words_number)]  # zipf
+    result = []
+    total = 0
+    while total < size:
+        sentence = ' '.join(rand.choices(words, word_weights, k=rand.randint(4, 16))).capitalize() + '.\n'
+        result.append(sentence)
+        total += len(sentence)
+    return ''.join(result).encode('ascii')[:size]
+
+
+def binary_corpus(size: int, rand: random.Random):
+    # fixed size records: slowly increasing id, small enum, noisy measurement, padding
+    result = bytearray()
+    record_id = rand.randrange(1 << 20)
+    while len(result) < size:
+        record_id += rand.randint(1, 3)
+        result += record_id.to_bytes(4, byteorder='little')
+        result += rand.choice((1, 2, 3, 7)).to_bytes(2, byteorder='little')
+        result += int(rand.gauss(1000, 30)).to_bytes(4, byteorder='little', signed=True)
+        result += bytes(6)
+    return bytes(result[:size])
+
+
+corpus_generators: Dict[str, Callable[[int, random.Random], bytes]] = {
+    'random': random_corpus,
+    'skewed': skewed_corpus,
+    'text': text_corpus,
+    'binary': binary_corpus,
+}
+
+
+def generate_corpus(size: int = DEFAULT_SIZE, seed: int = DEFAULT_SEED) -> Dict[str, bytes]:
+    """same `size` & `seed` always gives the same corpus"""
+    return {name: generator(size, random.Random(f'{seed}:{name}')) for name, generator in corpus_generators.items()}
+
+
+# codecs
+
+def stdlib_codecs() -> Dict[str, Codec]:
+    return {
+        'zlib-6': (lambda buffer: zlib.compress(buffer, 6), zlib.decompress),
+        'zlib-9': (lambda buffer: zlib.compress(buffer, 9), zlib.decompress),
+        'bz2-9': (lambda buffer: bz2.compress(buffer, 9), bz2.decompress),
+        'lzma-6': (lambda buffer: lzma.compress(buffer, preset=6), lzma.decompress),
+    }
+
+
+def _pipeline_codec(pipeline: Pipeline) -> Codec:
+    return (lambda buffer: bytes(pipeline.encode(buffer))), (lambda buffer: bytes(pipeline.decode(buffer)))
+
+
+def pipeline_codecs(data_bits: Iterable[int] = DEFAULT_DATA_BITS) -> Dict[str, Codec]:
+    codecs = {pipeline.name: _pipeline_codec(pipeline) for pipeline in all_pipelines()}
+    for bits in data_bits:
+        # ad-hoc pipelines, never written to a stream so they don't need a registered id
+        modeler = SegmentedModeler(0, f'segmented-{bits}', bits)
+        codecs[f'entropy@{bits}'] = _pipeline_codec(Pipeline(0, f'entropy@{bits}', [modeler, ENTROPY]))
+    return codecs
+
+
+# benchmark
+
+@dataclass(init=True, repr=True, eq=True)
+class BenchmarkResult:
+    __slots__ = ('corpus', 'codec', 'size', 'compressed_size', 'ratio', 'compress_speed', 'decompress_speed',
+                 'peak_memory')
+    corpus: str
+    codec: str
+    size: int
+    compressed_size: int
+    ratio: float
+    compress_speed: float  # MB/s
+    decompress_speed: float  # MB/s
+    peak_memory: int  # bytes, 0 when not tracked
+
+
+def _speed(size: int, seconds: float):
+    return size / seconds / 1e6 if seconds > 0 else float('inf')
+
+
+def _peak_memory(function: Callable[[bytes], bytes], buffer: bytes):
+    tracemalloc.start()
+    try:
+        function(buffer)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_codec(corpus: str, name: str, codec: Codec, buffer: bytes, track_memory: bool = True):
+    compress, decompress = codec
+    start = time.perf_counter()
+    compressed = compress(buffer)
+    middle = time.perf_counter()
+    decompressed = decompress(compressed)
+    end = time.perf_counter()
+    if decompressed != buffer:
+        raise ValueError(f'{name} failed to round trip {corpus}')
+    # traced separately, tracemalloc slows the timed runs down
+    peak_memory = max(_peak_memory(compress, buffer), _peak_memory(decompress, compressed)) if track_memory else 0
+    return BenchmarkResult(corpus, name, len(buffer), len(compressed), len(compressed) / len(buffer),
+                           _speed(len(buffer), middle - start), _speed(len(buffer), end - middle), peak_memory)
+
+
+def run_benchmark(corpus: Dict[str, bytes], codecs: Dict[str, Codec], track_memory: bool = True,
+                  progress: Callable[[str, str], None] = None) -> List[BenchmarkResult]:
+    results = []
+    for corpus_name, buffer in corpus.items():
+        for codec_name, codec in codecs.items():
+            if progress:
+                progress(corpus_name, codec_name)
+            results.append(run_codec(corpus_name, codec_name, codec, buffer, track_memory))
+    return results
+
+
+def results_json(results: Iterable[BenchmarkResult], **kwargs):
+    return json.dumps([asdict(result) for result in results], **kwargs)
+
+
+def results_table(results: Iterable[BenchmarkResult]):
+    table = Table()
+    table.set_titles('corpus', 'codec', 'size', 'compressed', 'ratio', 'compress', 'decompress', 'memory')
+    for result in results:
+        table.add_row(result.corpus, result.codec, to_human_size(result.size),
+                      to_human_size(result.compressed_size), f'{result.ratio:.4f}',
+                      f'{result.compress_speed:.2f} MB/s', f'{result.decompress_speed:.2f} MB/s',
+                      to_human_size(result.peak_memory))
+    return table
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog=argv[0], description='benchmark library.compression against stdlib')
+    parser.add_argument('-s', '--size', default=f'{DEFAULT_SIZE // 1024}KB', help='corpus size, like 64KB')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('-b', '--data-bits', type=int, nargs='*', default=list(DEFAULT_DATA_BITS))
+    parser.add_argument('-c', '--corpus', nargs='*', choices=sorted(corpus_generators))
+    parser.add_argument('--no-memory', action='store_true', help='skip peak memory tracking')
+    parser.add_argument('-o', '--output', help='json output path')
+    args = parser.parse_args(argv[1:])
+
+    corpus = generate_corpus(to_machine_size(args.size), args.seed)
+    if args.corpus:
+        corpus = {name: corpus[name] for name in args.corpus}
+    codecs = {**stdlib_codecs(), **pipeline_codecs(args.data_bits)}
+    results = run_benchmark(corpus, codecs, not args.no_memory,
+                            lambda corpus_name, codec_name: print(f'{corpus_name}: {codec_name}...', file=sys.stderr))
+
+    if args.output:
+        with open(args.output, 'wt') as outfile:
+            outfile.write(results_json(results, indent=2))
+    results_table(results).print()
+
+
+if __name__ == '__main__':
+    run_main(main)
@@ -0,0 +1,338 @@
+import heapq
+from bisect import bisect_right
+from dataclasses import dataclass
+from enum import IntEnum, auto
+from itertools import accumulate
+from math import log2
+from typing import List, Sequence
+
+from library.compression import SegmentedBuffer, DataType, EntropyCoder, get_bytes_per_bits
+from library.sio import FileWrapper, BitsWriter
+
+DEFAULT_PROB_BITS = 12
+RANS_STREAMS = 4
+RANS_RENORM_BITS = 16
+RANS_BYTE_BITS = 8
+RANS_TABLE_MAX_BITS = 16
+
+
+class Backend(IntEnum):
+    UNDEFINED = auto()
+    HUFFMAN = auto()
+    RANS = auto()
+
+    @staticmethod
+    def read(wrapper: FileWrapper):
+        return Backend(wrapper.read_unsigned_int(1))
+
+    def write(self, wrapper: FileWrapper):
+        wrapper.write_unsigned_int(self.value, 1)
+
+
+class FrequencyTable:
+    """symbols & counts of a `SegmentedBuffer`, ordered by data so encoder & decoder agree"""
+    __slots__ = 'symbols', 'counts', 'indexes', 'total'
+
+    def __init__(self, symbols: Sequence[DataType], counts: Sequence[int]):
+        self.symbols = list(symbols)
+        self.counts = list(counts)
+        self.indexes = {symbol: index for index, symbol in enumerate(self.symbols)}
+        self.total = sum(self.counts)
+
+    @staticmethod
+    def from_segmented_buffer(segmented: SegmentedBuffer):
+        data_counts = sorted(segmented.sorted_data_count, key=lambda item: item.data)
+        return FrequencyTable([item.data for item in data_counts], [item.count for item in data_counts])
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+# huffman
+
+def huffman_code_lengths(counts: Sequence[int]) -> List[int]:
+    if len(counts) == 1:
+        return [0]
+    lengths = [0] * len(counts)
+    heap = [(count, index, (index,)) for index, count in enumerate(counts)]
+    heapq.heapify(heap)
+    tie_breaker = len(counts)
+    while len(heap) > 1:
+        left_count, _, left = heapq.heappop(heap)
+        right_count, _, right = heapq.heappop(heap)
+        for index in left:
+            lengths[index] += 1
+        for index in right:
+            lengths[index] += 1
+        heapq.heappush(heap, (left_count + right_count, tie_breaker, left + right))
+        tie_breaker += 1
+    return lengths
+
+
+def canonical_codes(lengths: Sequence[int]) -> List[int]:
+    codes = [0] * len(lengths)
+    code = 0
+    last_length = 0
+    for index in sorted(range(len(lengths)), key=lambda item: (lengths[item], item)):
+        code <<= lengths[index] - last_length
+        last_length = lengths[index]
+        codes[index] = code
+        code += 1
+    return codes
+
+
+def huffman_encode(data: Sequence[DataType], table: FrequencyTable) -> bytes:
+    lengths = huffman_code_lengths(table.counts)
+    codes = canonical_codes(lengths)
+    writer = BitsWriter()
+    write, indexes = writer.write, table.indexes
+    for symbol in data:
+        index = indexes[symbol]
+        write(codes[index], lengths[index])
+    return writer.getvalue()
+
+
+def huffman_decode(payload: bytes, length: int, table: FrequencyTable) -> List[DataType]:
+    lengths = huffman_code_lengths(table.counts)
+    if len(table) == 1:
+        return [table.symbols[0]] * length
+    ordered = sorted(range(len(lengths)), key=lambda item: (lengths[item], item))
+    max_length = max(lengths)
+    length_count = [0] * (max_length + 1)
+    for value in lengths:
+        length_count[value] += 1
+    # first canonical code & first ordered index of each length
+    first_code = [0] * (max_length + 1)
+    first_index = [0] * (max_length + 1)
+    code = index = 0
+    for bits in range(1, max_length + 1):
+        code = (code + length_count[bits - 1]) << 1 if bits > 1 else 0
+        first_code[bits] = code
+        first_index[bits] = index
+        index += length_count[bits]
+
+    result = []
+    append, symbols = result.append, table.symbols
+    code = bits = 0
+    for byte in payload:
+        for shift in range(7, -1, -1):
+            code = (code << 1) | ((byte >> shift) & 1)
+            bits += 1
+            offset = code - first_code[bits]
+            if offset < length_count[bits]:
+                append(symbols[ordered[first_index[bits] + offset]])
+                if len(result) == length:
+                    return result
+                code = bits = 0
+    if len(result) != length:
+        raise EOFError(f'huffman payload ended after {len(result)} of {length} data')
+    return result
+
+
+def huffman_estimate_bits(table: FrequencyTable) -> int:
+    return sum(count * bits for count, bits in zip(table.counts, huffman_code_lengths(table.counts)))
+
+
+# rANS
+
+def rans_prob_bits(table: FrequencyTable) -> int:
+    # at least four slots for every symbol so the normalization never starves one
+    return max(DEFAULT_PROB_BITS, (len(table) - 1).bit_length() + 2)
+
+
+def normalize_frequencies(counts: Sequence[int], prob_bits: int) -> List[int]:
+    scale = 1 << prob_bits
+    total = sum(counts)
+    frequencies = [max(1, count * scale // total) for count in counts]
+    difference = scale - sum(frequencies)
+    if difference:
+        order = sorted(range(len(counts)), key=lambda item: frequencies[item], reverse=True)
+        if difference > 0:
+            frequencies[order[0]] += difference
+        else:
+            for index in order:
+                taken = min(frequencies[index] - 1, -difference)
+                frequencies[index] -= taken
+                difference += taken
+                if difference == 0:
+                    break
+    return frequencies
+
+
+def _rans_state_size(prob_bits: int):
+    return get_bytes_per_bits(prob_bits + RANS_RENORM_BITS + RANS_BYTE_BITS)
+
+
+def rans_encode(data: Sequence[DataType], table: FrequencyTable, prob_bits: int, streams: int = RANS_STREAMS):
+    """interleaved rANS: data[i] goes to state i % streams, all states share one byte stream"""
+    frequencies = normalize_frequencies(table.counts, prob_bits)
+    cumulative = [0] + list(accumulate(frequencies))
+    lower_bound = 1 << (prob_bits + RANS_RENORM_BITS)
+    renorm_shift = RANS_RENORM_BITS + RANS_BYTE_BITS
+    states = [lower_bound] * streams
+    output = bytearray()
+    append, indexes = output.append, table.indexes
+
+    for position in range(len(data) - 1, -1, -1):
+        index = indexes[data[position]]
+        frequency = frequencies[index]
+        stream = position % streams
+        state = states[stream]
+        state_max = frequency << renorm_shift
+        while state >= state_max:
+            append(state & 0xFF)
+            state >>= 8
+        states[stream] = ((state // frequency) << prob_bits) + (state % frequency) + cumulative[index]
+
+    state_size = _rans_state_size(prob_bits)
+    for stream in range(streams - 1, -1, -1):
+        output += states[stream].to_bytes(state_size, byteorder='little')
+    output.reverse()
+    return bytes(output)
+
+
+def rans_decode(payload: bytes, length: int, table: FrequencyTable, prob_bits: int, streams: int = RANS_STREAMS):
+    frequencies = normalize_frequencies(table.counts, prob_bits)
+    cumulative = [0] + list(accumulate(frequencies))
+    lower_bound = 1 << (prob_bits + RANS_RENORM_BITS)
+    mask = (1 << prob_bits) - 1
+
+    if prob_bits <= RANS_TABLE_MAX_BITS:
+        slot_table = []
+        for index, frequency in enumerate(frequencies):
+            slot_table.extend([index] * frequency)
+        lookup = slot_table.__getitem__
+    else:
+        def lookup(slot: int):
+            return bisect_right(cumulative, slot) - 1
+
+    state_size = _rans_state_size(prob_bits)
+    position = streams * state_size
+    if len(payload) < position:
+        raise EOFError('rANS payload is shorter than its states')
+    states = [int.from_bytes(payload[index: index + state_size], byteorder='big')
+              for index in range(0, position, state_size)]
+
+    result = []
+    append, symbols = result.append, table.symbols
+    for step in range(length):
+        stream = step % streams
+        state = states[stream]
+        slot = state & mask
+        index = lookup(slot)
+        append(symbols[index])
+        state = frequencies[index] * (state >> prob_bits) + slot - cumulative[index]
+        while state < lower_bound:
+            state = (state << 8) | payload[position]
+            position += 1
+        states[stream] = state
+    return result
+
+
+def rans_estimate_bits(table: FrequencyTable, prob_bits: int = None, streams: int = RANS_STREAMS) -> int:
+    if len(table) == 0:
+        return 0
+    prob_bits = prob_bits or rans_prob_bits(table)
+    frequencies = normalize_frequencies(table.counts, prob_bits)
+    bits = sum(count * (prob_bits - log2(frequency)) for count, frequency in zip(table.counts, frequencies))
+    return int(bits) + 1 + streams * _rans_state_size(prob_bits) * 8
+
+
+# blocks
+
+def estimate_bits(table: FrequencyTable, backend: Backend) -> int:
+    if backend == Backend.HUFFMAN:
+        return huffman_estimate_bits(table)
+    elif backend == Backend.RANS:
+        return rans_estimate_bits(table)
+    raise ValueError(f'unsupported backend: {backend}')
+
+
+def choose_backend(table: FrequencyTable, min_gain: float = 0.0):
+    """rANS is picked only when it saves more than `min_gain` (fraction of the huffman size)"""
+    if len(table) == 0:
+        return Backend.HUFFMAN
+    huffman_bits = huffman_estimate_bits(table)
+    rans_bits = rans_estimate_bits(table)
+    if rans_bits < huffman_bits * (1 - min_gain):
+        return Backend.RANS
+    return Backend.HUFFMAN
+
+
+@dataclass(init=True, repr=True, eq=True)
+class EntropyBlock:
+    __slots__ = 'backend', 'length', 'prob_bits', 'streams', 'payload'
+    backend: Backend
+    length: int
+    prob_bits: int
+    streams: int
+    payload: bytes
+
+    def write(self, wrapper: FileWrapper):
+        self.backend.write(wrapper)  # backend
+        total = 1 + wrapper.write_big_int(self.length, signed=False)  # length
+        total += wrapper.write_unsigned_int(self.prob_bits, 1)  # prob bits
+        total += wrapper.write_unsigned_int(self.streams, 1)  # streams
+        total += wrapper.write_big_int(len(self.payload), signed=False)  # payload size
+        return total + wrapper.write_bytes(self.payload)  # payload
+
+    @staticmethod
+    def read(wrapper: FileWrapper):
+        backend = Backend.read(wrapper)  # backend
+        length = wrapper.read_big_int(signed=False)  # length
+        prob_bits = wrapper.read_unsigned_int(1)  # prob bits
+        streams = wrapper.read_unsigned_int(1)  # streams
+        payload_size = wrapper.read_big_int(signed=False)  # payload size
+        payload = wrapper.read_bytes(payload_size)  # payload
+        if len(payload) != payload_size:
+            raise EOFError(f'while reading {payload_size} bytes entropy payload')
+        return EntropyBlock(backend, length, prob_bits, streams, payload)
+
+
+def encode_data(data: Sequence[DataType], table: FrequencyTable, backend: Backend = None,
+                streams: int = RANS_STREAMS):
+    backend = backend or choose_backend(table)
+    if len(data) == 0:
+        return EntropyBlock(backend, 0, 0, 0, b'')
+    elif backend == Backend.HUFFMAN:
+        return EntropyBlock(backend, len(data), 0, 0, huffman_encode(data, table))
+    elif backend == Backend.RANS:
+        prob_bits = rans_prob_bits(table)
+        return EntropyBlock(backend, len(data), prob_bits, streams, rans_encode(data, table, prob_bits, streams))
+    raise ValueError(f'unsupported backend: {backend}')
+
+
+def decode_data(block: EntropyBlock, table: FrequencyTable):
+    if block.length == 0:
+        return []
+    elif block.backend == Backend.HUFFMAN:
+        return huffman_decode(block.payload, block.length, table)
+    elif block.backend == Backend.RANS:
+        return rans_decode(block.payload, block.length, table, block.prob_bits, block.streams)
+    raise ValueError(f'unsupported backend: {block.backend}')
+
+
+def encode_block(buffer: bytes, segmented: SegmentedBuffer, backend: Backend = None, streams: int = RANS_STREAMS):
+    data, remaining = segmented.split(buffer)
+    return encode_data(data, FrequencyTable.from_segmented_buffer(segmented), backend, streams)
+
+
+def decode_block(block: EntropyBlock, segmented: SegmentedBuffer):
+    data = decode_data(block, FrequencyTable.from_segmented_buffer(segmented))
+    return segmented.join(data)
+
+
+class EntropyStage(EntropyCoder):
+    """pipeline stage, `backend=None` picks the smaller backend per block"""
+    __slots__ = 'backend', 'streams'
+
+    def __init__(self, stage_id: int, name: str, backend: Backend = None, streams: int = RANS_STREAMS):
+        super().__init__(stage_id, name)
+        self.backend = backend
+        self.streams = streams
+
+    def encode(self, wrapper: FileWrapper, view: memoryview, model: SegmentedBuffer):
+        return encode_block(view, model, self.backend, self.streams).write(wrapper)
+
+    def decode(self, wrapper: FileWrapper, model: SegmentedBuffer):
+        return decode_block(EntropyBlock.read(wrapper), model)
@@ -0,0 +1,89 @@
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLock:
+    """
+    advisory `flock` on a lock file, shared between processes.
+    every acquisition opens its own descriptor, so threads of one process exclude each other too,
+    but a thread must not nest acquisitions. without `fcntl` (windows) locking does nothing.
+    """
+    __slots__ = '_path',
+
+    def __init__(self, path: str):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def acquire(self, shared: bool = False, blocking: bool = True):
+        """returns the locked descriptor, or None when `blocking` is off and the lock is taken"""
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o666)
+        if fcntl is None:
+            return fd
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def release(fd: int):
+        # closing the descriptor drops the lock
+        os.close(fd)
+
+    @contextlib.contextmanager
+    def shared(self):
+        fd = self.acquire(shared=True)
+        try:
+            yield
+        finally:
+            self.release(fd)
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        fd = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(fd)
+
+
+def lock_fd(fd: int, shared: bool = False, blocking: bool = True):
+    """locks an already open file, returns False when `blocking` is off and the lock is taken"""
+    if fcntl is None:
+        return True
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(fd, operation)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def process_alive(pid: int):
+    if os.name != 'posix':
+        # os.kill would terminate it
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
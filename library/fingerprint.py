@@ -0,0 +1,114 @@
+import types
+from typing import Callable, Set
+from weakref import WeakKeyDictionary
+
+from library.cache_key import new_hasher, update_hasher
+
+# global values that are hashed by value when a function refers to them
+_VALUE_TYPES = (type(None), bool, int, float, complex, str, bytes, frozenset)
+
+_memo: 'WeakKeyDictionary[Callable, dict]' = WeakKeyDictionary()
+
+
+def _update_code(hasher, code: types.CodeType):
+    """everything that changes behaviour, nothing that only moves (file name, line numbers, position tables)"""
+    hasher.update(b'c')
+    update_hasher(hasher, (code.co_argcount, code.co_posonlyargcount, code.co_kwonlyargcount, code.co_flags))
+    update_hasher(hasher, code.co_code)
+    update_hasher(hasher, code.co_names)
+    update_hasher(hasher, code.co_varnames)
+    update_hasher(hasher, code.co_freevars)
+    update_hasher(hasher, len(code.co_consts))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code(hasher, const)
+        else:
+            update_hasher(hasher, const)
+
+
+def code_fingerprint(code: types.CodeType) -> bytes:
+    hasher = new_hasher()
+    _update_code(hasher, code)
+    return hasher.digest()
+
+
+def _referenced_names(code: types.CodeType):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_referenced_names(const))
+    return names
+
+
+def _update_dependency(hasher, value, visited: Set[int]):
+    if isinstance(value, types.FunctionType):
+        _update_function(hasher, value, visited)
+    elif isinstance(value, types.MethodType):
+        _update_function(hasher, value.__func__, visited)
+    elif isinstance(value, _VALUE_TYPES):
+        update_hasher(hasher, value)
+    elif isinstance(value, tuple) and all(isinstance(item, _VALUE_TYPES) for item in value):
+        update_hasher(hasher, value)
+    elif isinstance(value, types.ModuleType):
+        update_hasher(hasher, value.__name__)
+    else:
+        # classes, instances, builtins: only their type is part of the fingerprint
+        update_hasher(hasher, f'{type(value).__module__}.{type(value).__qualname__}')
+
+
+def _update_function(hasher, func: types.FunctionType, visited: Set[int]):
+    if id(func) in visited:
+        # recursion, the function is already part of the fingerprint
+        update_hasher(hasher, f'{func.__module__}.{func.__qualname__}')
+        return
+    visited.add(id(func))
+
+    code = func.__code__
+    _update_code(hasher, code)
+    update_hasher(hasher, func.__defaults__ or ())
+    update_hasher(hasher, func.__kwdefaults__ or {})
+
+    # closures
+    for name, cell in zip(code.co_freevars, func.__closure__ or ()):
+        update_hasher(hasher, name)
+        try:
+            _update_dependency(hasher, cell.cell_contents, visited)
+        except ValueError:
+            update_hasher(hasher, None)  # empty cell
+
+    # globals & callees, builtins are skipped
+    global_values = func.__globals__
+    for name in sorted(_referenced_names(code)):
+        if name in global_values:
+            update_hasher(hasher, name)
+            _update_dependency(hasher, global_values[name], visited)
+
+
+def function_fingerprint(func: Callable, transitive: bool = False) -> bytes:
+    """
+    normalized hash of a function's name & code, memoized per function object.
+    with `transitive`, referenced globals, closures & callee functions are walked too.
+    memoization means a changed global is only noticed by a new function object (e.g. after a reload).
+    """
+    while isinstance(func, types.MethodType):
+        func = func.__func__
+    try:
+        memo = _memo[func]
+    except KeyError:
+        memo = _memo[func] = {}
+    except TypeError:
+        memo = {}  # not weak referenceable
+    try:
+        return memo[transitive]
+    except KeyError:
+        pass
+
+    hasher = new_hasher()
+    # identical code under another name may still read different globals
+    update_hasher(hasher, f'{func.__module__}.{func.__qualname__}')
+    if transitive and isinstance(func, types.FunctionType):
+        _update_function(hasher, func, set())
+    else:
+        _update_code(hasher, func.__code__)
+    memo[transitive] = hasher.digest()
+    return memo[transitive]
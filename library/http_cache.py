@@ -0,0 +1,326 @@
+import email.utils
+import http.client
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+from library.cache_folder import CacheFolder, ReadWriteWrapper, ENCODING
+from library.cache_index import DataType, KeyType
+from library.single_flight import SingleFlight
+from library.sio import FileWrapper
+
+DEFAULT_TIMEOUT = 30
+# idle connections kept per host
+DEFAULT_MAX_IDLE = 4
+# of the time since `Last-Modified`, for responses without an explicit lifetime (RFC 9111 4.2.2)
+HEURISTIC_FRACTION = 0.1
+
+# cacheable by default (RFC 9110 15.1)
+CACHEABLE_STATUSES = frozenset((200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501))
+# a 304 doesn't update these (RFC 9111 3.2)
+_KEEP_HEADERS = frozenset(('content-length', 'content-encoding', 'transfer-encoding'))
+
+status_settings = {
+    'size': 2,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+time_settings = {
+    'size': 8,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+count_settings = {
+    'size': 4,
+    'byteorder': 'big',
+    'signed': False,
+}
+
+HeadersType = List[Tuple[str, str]]
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """lowercase directive -> argument (None without one)"""
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        name, sep, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') if sep else None
+    return directives
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _seconds(value: Optional[str]):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CachedResponse:
+    """a response & when it was stored (`time.time_ns()`), `from_cache` tells if this request used the network"""
+    __slots__ = 'url', 'status', 'reason', 'headers', 'body', 'stored', 'from_cache'
+
+    def __init__(self, url: str, status: int, reason: str, headers: HeadersType, body: bytes, stored: int = 0,
+                 from_cache: bool = False):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.stored = stored or time.time_ns()
+        self.from_cache = from_cache
+
+    def __repr__(self):
+        return f'CachedResponse({self.url!r}, {self.status}, from_cache={self.from_cache})'
+
+    def copy(self, from_cache: bool = None):
+        from_cache = self.from_cache if from_cache is None else from_cache
+        return CachedResponse(self.url, self.status, self.reason, list(self.headers), self.body, self.stored,
+                              from_cache)
+
+    def header(self, name: str, default: str = None):
+        """the last header called `name`, case insensitive"""
+        name = name.lower()
+        for header, value in reversed(self.headers):
+            if header.lower() == name:
+                return value
+        return default
+
+    @property
+    def cache_control(self):
+        return parse_cache_control(self.header('cache-control'))
+
+    @property
+    def validators(self) -> Dict[str, str]:
+        """the conditional request headers"""
+        result = {}
+        etag = self.header('etag')
+        if etag is not None:
+            result['If-None-Match'] = etag
+        last_modified = self.header('last-modified')
+        if last_modified is not None:
+            result['If-Modified-Since'] = last_modified
+        return result
+
+    def storable(self):
+        if self.status not in CACHEABLE_STATUSES:
+            return False
+        if 'no-store' in self.cache_control:
+            return False
+        return self.header('vary', '').strip() != '*'
+
+    def freshness_lifetime(self):
+        """seconds, RFC 9111 4.2.1"""
+        directives = self.cache_control
+        max_age = _seconds(directives.get('max-age'))
+        if max_age is not None:
+            return max_age
+        date = parse_http_date(self.header('date')) or self.stored / 1e9
+        expires = self.header('expires')
+        if expires is not None:
+            # an invalid date means already expired
+            expires = parse_http_date(expires)
+            return max(expires - date, 0) if expires is not None else 0
+        last_modified = parse_http_date(self.header('last-modified'))
+        if last_modified is not None and 'must-revalidate' not in directives:
+            return max(date - last_modified, 0) * HEURISTIC_FRACTION
+        return 0
+
+    def age(self, now: int = None):
+        """seconds, RFC 9111 4.2.3 without the transit delay"""
+        now = now or time.time_ns()
+        return (_seconds(self.header('age')) or 0) + max(now - self.stored, 0) / 1e9
+
+    def is_fresh(self, now: int = None):
+        if 'no-cache' in self.cache_control:
+            return False
+        return self.age(now) < self.freshness_lifetime()
+
+    def revalidated(self, response: 'CachedResponse'):
+        """this response updated with the headers of a 304 `response`"""
+        replaced = {name.lower() for name, value in response.headers} - _KEEP_HEADERS
+        headers = [(name, value) for name, value in self.headers if name.lower() not in replaced]
+        headers.extend((name, value) for name, value in response.headers if name.lower() in replaced)
+        return CachedResponse(self.url, self.status, self.reason, headers, self.body, response.stored)
+
+
+def read_response(wrapper: FileWrapper):
+    url = wrapper.read_big_bytes().decode(ENCODING)  # url
+    status = wrapper.read_int(**status_settings)  # status
+    reason = wrapper.read_big_bytes().decode(ENCODING)  # reason
+    stored = wrapper.read_int(**time_settings)  # stored
+    count = wrapper.read_int(**count_settings)  # header count
+    headers = []
+    for step in range(count):
+        name = wrapper.read_big_bytes().decode('latin-1')  # header name
+        value = wrapper.read_big_bytes().decode('latin-1')  # header value
+        headers.append((name, value))
+    body = wrapper.read_big_bytes()  # body
+    return CachedResponse(url, status, reason, headers, body, stored, from_cache=True)
+
+
+def write_response(wrapper: FileWrapper, response: CachedResponse):
+    total = wrapper.write_big_bytes(response.url.encode(ENCODING))  # url
+    total += wrapper.write_int(response.status, **status_settings)  # status
+    total += wrapper.write_big_bytes(response.reason.encode(ENCODING))  # reason
+    total += wrapper.write_int(response.stored, **time_settings)  # stored
+    total += wrapper.write_int(len(response.headers), **count_settings)  # header count
+    for name, value in response.headers:
+        total += wrapper.write_big_bytes(name.encode('latin-1'))  # header name
+        total += wrapper.write_big_bytes(value.encode('latin-1'))  # header value
+    total += wrapper.write_big_bytes(response.body)  # body
+    return total
+
+
+RESPONSE = ReadWriteWrapper(read_response, write_response)
+
+
+class ConnectionPool:
+    """keep alive connections by (scheme, host, port), up to `max_idle` idle ones each"""
+    __slots__ = '_timeout', '_max_idle', '_idle', '_lock'
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, max_idle: int = DEFAULT_MAX_IDLE):
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme: str, host: str, port: int):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self._timeout)
+        if scheme == 'http':
+            return http.client.HTTPConnection(host, port, timeout=self._timeout)
+        raise ValueError(f'unsupported url scheme: {scheme!r}')
+
+    def request(self, method: str, url: str, headers: Dict[str, str] = None):
+        """returns the response with its body read, `(status, reason, headers, body)`"""
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        address = scheme, parts.hostname, port
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        while True:
+            with self._lock:
+                idle = self._idle.get(address)
+                connection = idle.pop() if idle else None
+            reused = connection is not None
+            if connection is None:
+                connection = self._connect(*address)
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused:
+                    # closed by the server while it was idle
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self._lock:
+                    idle = self._idle.setdefault(address, [])
+                    if len(idle) < self._max_idle:
+                        idle.append(connection)
+                        connection = None
+                if connection is not None:
+                    connection.close()
+            return response.status, response.reason, response.getheaders(), body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+def request_key(url: str, headers: Dict[str, str] = None) -> KeyType:
+    """the url & the request headers, which may change the response"""
+    lines = [url]
+    if headers:
+        lines.extend(sorted(f'{name.lower()}: {value}' for name, value in headers.items()))
+    return DataType.GET_REQUEST, '\n'.join(lines).encode(ENCODING)
+
+
+class HttpCache:
+    """
+    GET requests cached in a `CacheFolder` by `Cache-Control`, `Expires` & `Last-Modified` (RFC 9111, private cache).
+    stale responses are revalidated with `ETag` & `Last-Modified`, and served stale if that fails on the network,
+    unless they must be revalidated. concurrent requests of one url share one fetch, connections are kept alive.
+    redirects aren't followed.
+    """
+    __slots__ = '_folder', '_pool', '_flights', '_headers'
+
+    def __init__(self, folder: CacheFolder, headers: Dict[str, str] = None, timeout: float = DEFAULT_TIMEOUT,
+                 max_idle: int = DEFAULT_MAX_IDLE):
+        """`headers` are sent with every request"""
+        self._folder = folder
+        self._pool = ConnectionPool(timeout, max_idle)
+        self._flights = SingleFlight()
+        self._headers = dict(headers or {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """the folder stays open"""
+        self._pool.close()
+
+    @property
+    def folder(self):
+        return self._folder
+
+    def get(self, url: str, headers: Dict[str, str] = None) -> CachedResponse:
+        headers = {**self._headers, **(headers or {})}
+        key = request_key(url, headers)
+        cached = self._folder.get(key, RESPONSE)
+        if cached is not None and cached.is_fresh():
+            return cached
+        return self._flights.do(key, self.__fetch, key, url, headers)
+
+    def __fetch(self, key: KeyType, url: str, headers: Dict[str, str]):
+        # the previous flight may have stored it between the miss & joining this one
+        cached = self._folder.get(key, RESPONSE)
+        if cached is not None and cached.is_fresh():
+            return cached
+        request_headers = dict(headers)
+        if cached is not None:
+            request_headers.update(cached.validators)
+        try:
+            response = CachedResponse(url, *self._pool.request('GET', url, request_headers))
+        except (OSError, http.client.HTTPException):
+            if cached is None or 'must-revalidate' in cached.cache_control:
+                raise
+            return cached
+        if response.status == 304 and cached is not None:
+            response = cached.revalidated(response)
+            response.from_cache = True
+        if response.storable():
+            # shared with later requests through the memory tier
+            stored = response if response.from_cache else response.copy(from_cache=True)
+            self._folder.put(key, stored, RESPONSE)
+        elif cached is not None:
+            self._folder.delete(key)
+        return response
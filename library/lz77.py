@@ -0,0 +1,294 @@
+import io
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+from library.compression import SegmentedBuffer, Transform
+from library.entropy import Backend, EntropyBlock, encode_block, decode_block
+from library.sio import FileWrapper, CONTINUE_MASK, VALUE_BITS, VALUE_MASK
+
+MIN_MATCH = 4
+MAX_MATCH = 1 << 16
+DEFAULT_WINDOW = 1 << 16
+DEFAULT_LEVEL = 5
+
+_COMPARE_STEP = 32
+
+
+@dataclass(init=True, repr=True, eq=True)
+class LZLevel:
+    __slots__ = 'max_chain', 'nice_length', 'lazy', 'insert_matches'
+    max_chain: int
+    nice_length: int
+    lazy: bool
+    insert_matches: bool
+
+
+LEVELS: Dict[int, LZLevel] = {
+    1: LZLevel(max_chain=1, nice_length=16, lazy=False, insert_matches=False),
+    2: LZLevel(max_chain=2, nice_length=32, lazy=False, insert_matches=False),
+    3: LZLevel(max_chain=4, nice_length=32, lazy=False, insert_matches=True),
+    4: LZLevel(max_chain=8, nice_length=64, lazy=False, insert_matches=True),
+    5: LZLevel(max_chain=16, nice_length=128, lazy=True, insert_matches=True),
+    6: LZLevel(max_chain=32, nice_length=128, lazy=True, insert_matches=True),
+    7: LZLevel(max_chain=64, nice_length=256, lazy=True, insert_matches=True),
+    8: LZLevel(max_chain=256, nice_length=1024, lazy=True, insert_matches=True),
+    9: LZLevel(max_chain=4096, nice_length=MAX_MATCH, lazy=True, insert_matches=True),
+}
+
+
+# same layout as `sio.write_big_int(..., signed=False)`, but on in-memory buffers
+def _append_size(buffer: bytearray, value: int):
+    if value <= VALUE_MASK:
+        buffer.append(value)
+        return
+    shift = (value.bit_length() - 1) // VALUE_BITS * VALUE_BITS
+    while shift:
+        buffer.append(CONTINUE_MASK | ((value >> shift) & VALUE_MASK))
+        shift -= VALUE_BITS
+    buffer.append(value & VALUE_MASK)
+
+
+def _read_size(buffer: bytes, index: int) -> Tuple[int, int]:
+    byte = buffer[index]
+    value = byte & VALUE_MASK
+    while byte & CONTINUE_MASK:
+        index += 1
+        byte = buffer[index]
+        value = (value << VALUE_BITS) | (byte & VALUE_MASK)
+    return value, index + 1
+
+
+class LZStreams:
+    """sequences of (literals, match) split into byte streams that histogram well on their own"""
+    __slots__ = 'sequences', 'literals', 'literal_lengths', 'match_lengths', 'distances'
+
+    def __init__(self):
+        self.sequences = 0
+        self.literals = bytearray()
+        self.literal_lengths = bytearray()
+        self.match_lengths = bytearray()
+        self.distances = bytearray()
+
+    def streams(self):
+        return self.literals, self.literal_lengths, self.match_lengths, self.distances
+
+    def add_sequence(self, literals: bytes, match_length: int, distance: int):
+        self.sequences += 1
+        self.literals += literals
+        _append_size(self.literal_lengths, len(literals))
+        if match_length:
+            _append_size(self.match_lengths, match_length - MIN_MATCH + 1)
+            _append_size(self.distances, distance)
+        else:
+            self.match_lengths.append(0)
+
+    def __iter__(self):
+        literal_index = literal_length_index = match_length_index = distance_index = 0
+        for step in range(self.sequences):
+            literal_length, literal_length_index = _read_size(self.literal_lengths, literal_length_index)
+            literals = self.literals[literal_index: literal_index + literal_length]
+            literal_index += literal_length
+            match_length, match_length_index = _read_size(self.match_lengths, match_length_index)
+            if match_length:
+                distance, distance_index = _read_size(self.distances, distance_index)
+                yield literals, match_length + MIN_MATCH - 1, distance
+            else:
+                yield literals, 0, 0
+
+    def write(self, wrapper: FileWrapper):
+        total = wrapper.write_big_int(self.sequences, signed=False)  # sequences
+        for stream in self.streams():
+            total += wrapper.write_big_int(len(stream), signed=False)  # stream size
+            total += wrapper.write_bytes(stream)  # stream
+        return total
+
+    @staticmethod
+    def read(wrapper: FileWrapper):
+        instance = LZStreams()
+        instance.sequences = wrapper.read_big_int(signed=False)  # sequences
+        streams = []
+        for step in range(4):
+            size = wrapper.read_big_int(signed=False)  # stream size
+            stream = wrapper.read_bytes(size)  # stream
+            if len(stream) != size:
+                raise EOFError(f'while reading {size} bytes lz stream')
+            streams.append(bytearray(stream))
+        instance.literals, instance.literal_lengths, instance.match_lengths, instance.distances = streams
+        return instance
+
+    def write_entropy(self, wrapper: FileWrapper, backend: Backend = None):
+        """histogram every stream by `SegmentedBuffer` and entropy code it"""
+        wrapper.write_big_int(self.sequences, signed=False)  # sequences
+        for stream in self.streams():
+            segmented = SegmentedBuffer.scan_buffer(8, stream)
+            segmented.write(wrapper)  # data count
+            encode_block(stream, segmented, backend).write(wrapper)  # entropy block
+
+    @staticmethod
+    def read_entropy(wrapper: FileWrapper):
+        instance = LZStreams()
+        instance.sequences = wrapper.read_big_int(signed=False)  # sequences
+        streams = []
+        for step in range(4):
+            segmented = SegmentedBuffer.static_read(wrapper)  # data count
+            streams.append(bytearray(decode_block(EntropyBlock.read(wrapper), segmented)))  # entropy block
+        instance.literals, instance.literal_lengths, instance.match_lengths, instance.distances = streams
+        return instance
+
+
+class LZEncoder:
+    """hash-chain LZ77 match finder; history is kept between `compress` calls so chunks can stream"""
+    __slots__ = '_window', '_level', '_history', '_base', '_head', '_prev', '_next_insert'
+
+    def __init__(self, window: int = DEFAULT_WINDOW, level: int = DEFAULT_LEVEL):
+        if window <= 0:
+            raise ValueError(f'invalid window: {window}')
+        if level not in LEVELS:
+            raise ValueError(f'invalid level: {level}')
+        self._window = window
+        self._level = LEVELS[level]
+        self._history = bytearray()
+        self._base = 0  # absolute position of `_history[0]`
+        self._head: Dict[int, int] = {}
+        self._prev: Dict[int, int] = {}
+        self._next_insert = 0
+
+    def _insert_until(self, data: bytearray, position: int, end: int):
+        base, head, prev = self._base, self._head, self._prev
+        index = self._next_insert - base
+        limit = min(position - base, end - MIN_MATCH + 1)
+        while index < limit:
+            key = int.from_bytes(data[index: index + MIN_MATCH], byteorder='little')
+            absolute = index + base
+            previous = head.get(key)
+            if previous is not None:
+                prev[absolute] = previous
+            head[key] = absolute
+            index += 1
+        if index + base > self._next_insert:
+            self._next_insert = index + base
+
+    def _find(self, data: bytearray, index: int, end: int):
+        base = self._base
+        self._insert_until(data, index + base, end)
+        absolute = index + base
+        key = int.from_bytes(data[index: index + MIN_MATCH], byteorder='little')
+        candidate = self._head.get(key)
+        limit = min(MAX_MATCH, end - index)
+        best_length, best_distance = MIN_MATCH - 1, 0
+        chain = self._level.max_chain
+        nice_length = self._level.nice_length
+        prev = self._prev
+        while candidate is not None and chain:
+            distance = absolute - candidate
+            if distance > self._window:
+                break
+            other = candidate - base
+            if best_length < limit and data[other + best_length] == data[index + best_length]:
+                length = MIN_MATCH
+                while length + _COMPARE_STEP <= limit and \
+                        data[other + length: other + length + _COMPARE_STEP] == \
+                        data[index + length: index + length + _COMPARE_STEP]:
+                    length += _COMPARE_STEP
+                while length < limit and data[other + length] == data[index + length]:
+                    length += 1
+                if length > best_length:
+                    best_length, best_distance = length, distance
+                    if length >= nice_length:
+                        break
+            candidate = prev.get(candidate)
+            chain -= 1
+        if best_length < MIN_MATCH:
+            return 0, 0
+        return best_length, best_distance
+
+    def compress(self, chunk: bytes) -> LZStreams:
+        streams = LZStreams()
+        data = self._history + chunk
+        end = len(data)
+        index = literal_start = len(self._history)
+        level = self._level
+
+        while index + MIN_MATCH <= end:
+            length, distance = self._find(data, index, end)
+            if length == 0:
+                index += 1
+                continue
+            if level.lazy:
+                while length < level.nice_length and index + 1 + MIN_MATCH <= end:
+                    next_length, next_distance = self._find(data, index + 1, end)
+                    if next_length <= length:
+                        break
+                    index += 1
+                    length, distance = next_length, next_distance
+            streams.add_sequence(data[literal_start:index], length, distance)
+            index += length
+            literal_start = index
+            if not level.insert_matches:
+                self._next_insert = index + self._base
+        if literal_start < end:
+            streams.add_sequence(data[literal_start:end], 0, 0)
+
+        self._trim(data)
+        return streams
+
+    def _trim(self, data: bytearray):
+        dropped = max(0, len(data) - self._window)
+        self._history = data[dropped:]
+        self._base += dropped
+        if len(self._prev) > 2 * self._window:
+            base = self._base
+            self._prev = {key: value for key, value in self._prev.items() if key >= base}
+
+
+class LZDecoder:
+    __slots__ = '_window', '_history'
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self._window = window
+        self._history = bytearray()
+
+    def decompress(self, streams: LZStreams) -> bytes:
+        output = self._history
+        start = len(output)
+        for literals, length, distance in streams:
+            output += literals
+            if length:
+                source = len(output) - distance
+                if source < 0:
+                    raise ValueError(f'invalid distance: {distance}')
+                if distance >= length:
+                    output += output[source: source + length]
+                else:
+                    # overlapping match, repeat the period
+                    period = output[source:]
+                    repeats, extra = divmod(length, distance)
+                    output += period * repeats + period[:extra]
+        result = bytes(output[start:])
+        self._history = output[max(0, len(output) - self._window):]
+        return result
+
+
+def compress(buffer: bytes, window: int = DEFAULT_WINDOW, level: int = DEFAULT_LEVEL):
+    return LZEncoder(window, level).compress(buffer)
+
+
+def decompress(streams: LZStreams, window: int = DEFAULT_WINDOW):
+    return LZDecoder(window).decompress(streams)
+
+
+class LZTransform(Transform):
+    __slots__ = 'window', 'level'
+
+    def __init__(self, stage_id: int, name: str, window: int = DEFAULT_WINDOW, level: int = DEFAULT_LEVEL):
+        super().__init__(stage_id, name)
+        self.window = window
+        self.level = level
+
+    def encode(self, view: memoryview):
+        outfile = io.BytesIO()
+        compress(view, self.window, self.level).write(FileWrapper(outfile))
+        return outfile.getbuffer()
+
+    def decode(self, view: memoryview):
+        return decompress(LZStreams.read(FileWrapper(io.BytesIO(view))), self.window)
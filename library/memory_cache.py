@@ -0,0 +1,83 @@
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from library.utils import DotDict
+
+_MISSING = object()
+
+
+class MemoryCache:
+    """thread safe LRU cache bounded by the total size of its values, not by their number"""
+    __slots__ = '_max_size', '_size', '_entries', '_lock', 'hits', 'misses', 'evictions'
+
+    def __init__(self, max_size: int):
+        if max_size <= 0:
+            raise ValueError(f'invalid max size: {max_size}')
+        self._max_size = max_size
+        self._size = 0
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int = None):
+        """`size` defaults to `len(value)` for buffers and `sys.getsizeof` for the rest"""
+        if size is None:
+            size = len(value) if isinstance(value, (bytes, bytearray, memoryview)) else sys.getsizeof(value)
+        if size > self._max_size:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = value, size
+            self._size += size
+            while self._size > self._max_size:
+                evicted_key, (evicted, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+        return True
+
+    def pop(self, key: Hashable, default: Any = None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._size -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        return DotDict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                       entries=len(self._entries), size=self._size, max_size=self._max_size)
@@ -0,0 +1,23 @@
+from library.bwt import BWTTransform
+from library.compression import SegmentedModeler, register_stage, register_pipeline
+from library.entropy import Backend, EntropyStage
+from library.lz77 import LZTransform
+
+# built-in ids are below 128, the rest are free for callers
+
+LZ77 = register_stage(LZTransform(1, 'lz77'))
+BWT = register_stage(BWTTransform(2, 'bwt'))
+SEGMENTED_8 = register_stage(SegmentedModeler(3, 'segmented-8', 8))
+SEGMENTED_16 = register_stage(SegmentedModeler(4, 'segmented-16', 16))
+HUFFMAN = register_stage(EntropyStage(5, 'huffman', Backend.HUFFMAN))
+RANS = register_stage(EntropyStage(6, 'rans', Backend.RANS))
+ENTROPY = register_stage(EntropyStage(7, 'entropy'))
+
+STORE_PIPELINE = register_pipeline(1, 'store', [])
+HUFFMAN_PIPELINE = register_pipeline(2, 'huffman', [SEGMENTED_8, HUFFMAN])
+RANS_PIPELINE = register_pipeline(3, 'rans', [SEGMENTED_8, RANS])
+ENTROPY_PIPELINE = register_pipeline(4, 'entropy', [SEGMENTED_8, ENTROPY])
+ENTROPY_16_PIPELINE = register_pipeline(5, 'entropy-16', [SEGMENTED_16, ENTROPY])
+LZ77_PIPELINE = register_pipeline(6, 'lz77', [LZ77])
+LZ77_ENTROPY_PIPELINE = register_pipeline(7, 'lz77-entropy', [LZ77, SEGMENTED_8, ENTROPY])
+BWT_ENTROPY_PIPELINE = register_pipeline(8, 'bwt-entropy', [BWT, SEGMENTED_8, ENTROPY])
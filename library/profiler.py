@@ -0,0 +1,329 @@
+import contextvars
+import functools
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from library import trace_export
+from library.types.table import Table
+from library.utils import DotDict
+
+PERCENTILES = 50, 95, 99
+# durations kept per span for its percentiles, a uniform sample of them after that
+DEFAULT_MAX_SAMPLES = 4096
+
+PathType = Tuple[str, ...]
+
+_random = random.random
+
+
+class _Node:
+    """a span name under its parent, with its durations in nanoseconds"""
+    __slots__ = 'name', 'parent', 'children', 'count', 'total', 'min', 'max', 'samples', 'state'
+
+    def __init__(self, name: Optional[str], parent: Optional['_Node'], state: '_ThreadState'):
+        self.name = name
+        self.parent = parent
+        self.children: Dict[str, _Node] = {}
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+        self.samples: List[int] = []
+        self.state = state
+
+    @property
+    def path(self) -> PathType:
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return tuple(reversed(names))
+
+    def child(self, name: str):
+        node = self.children.get(name)
+        if node is None:
+            node = self.children[name] = _Node(name, self, self.state)
+        return node
+
+
+class _ThreadState:
+    """the span tree of a thread & its recorded spans `(node, start, duration)`, only that thread changes them"""
+    __slots__ = 'thread_id', 'thread_name', 'root', 'events'
+
+    def __init__(self):
+        thread = threading.current_thread()
+        self.thread_id = thread.native_id
+        self.thread_name = thread.name
+        self.root = _Node(None, None, self)
+        self.events: List[Tuple[_Node, int, int]] = []
+
+    def find(self, path: PathType):
+        node = self.root
+        for name in path:
+            node = node.child(name)
+        return node
+
+
+class Span:
+    """a context manager, entered once"""
+    __slots__ = '_profiler', '_name', '_node', '_token', '_start'
+
+    def __init__(self, profiler: 'Profiler', name: str):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        profiler = self._profiler
+        current = profiler._current
+        parent = current.get()
+        try:
+            state = profiler._local.state
+        except AttributeError:
+            state = profiler._new_state()
+        if parent is None:
+            parent = state.root
+        elif parent.state is not state:
+            # the context was copied to another thread, its spans go to the tree of that thread
+            parent = state.find(parent.path)
+        node = parent.children.get(self._name)
+        if node is None:
+            node = parent.child(self._name)
+        self._node = node
+        self._token = current.set(node)
+        self._start = profiler._now()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        profiler = self._profiler
+        duration = profiler._now() - self._start
+        profiler._current.reset(self._token)
+        node = self._node
+        count = node.count = node.count + 1
+        node.total += duration
+        if duration > node.max:
+            node.max = duration
+        if count == 1 or duration < node.min:
+            node.min = duration
+        if profiler._record:
+            node.state.events.append((node, self._start, duration))
+        samples = node.samples
+        if len(samples) < profiler._max_samples:
+            samples.append(duration)
+        else:
+            index = int(_random() * count)
+            if index < len(samples):
+                samples[index] = duration
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _percentile(ordered: List[int], percent: float):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class Profiler:
+    """
+    nested timing spans, as context managers (`span`) or decorators (`profile`), aggregated by their path of names.
+    the current span is kept in a context variable, so threads & asyncio tasks nest their spans apart, and every
+    thread has its own tree: spans take no lock. `now` returns integer nanoseconds, like `time.perf_counter_ns`.
+    `record` keeps every span too, for `write_chrome_trace`.
+    """
+    __slots__ = '_now', '_max_samples', '_enabled', '_record', '_current', '_local', '_states', '_lock'
+
+    def __init__(self, enabled: bool = True, now: Callable[[], int] = None, max_samples: int = DEFAULT_MAX_SAMPLES,
+                 record: bool = False):
+        self._now = now or time.perf_counter_ns
+        self._max_samples = max_samples
+        self._enabled = enabled
+        self._record = record
+        self._current: contextvars.ContextVar[Optional[_Node]] = contextvars.ContextVar('profiler_span', default=None)
+        self._local = threading.local()
+        self._states: List[_ThreadState] = []
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value: bool):
+        self._enabled = value
+
+    @property
+    def record(self):
+        return self._record
+
+    @record.setter
+    def record(self, value: bool):
+        self._record = value
+
+    def _new_state(self) -> _ThreadState:
+        state = self._local.state = _ThreadState()
+        with self._lock:
+            self._states.append(state)
+        return state
+
+    def span(self, name: str):
+        if not self._enabled:
+            return _NULL_SPAN
+        return Span(self, name)
+
+    def profile(self, name_or_function=None):
+        """decorator, `@profile`, or `@profile('name')` to name its span other than the function's qualified name"""
+
+        def decorator(function, name: str = None):
+            name = name or function.__qualname__
+
+            if inspect.iscoroutinefunction(function):
+                # the span is the awaiting, in the task's context
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    if not self._enabled:
+                        return await function(*args, **kwargs)
+                    with Span(self, name):
+                        return await function(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self._enabled:
+                    return function(*args, **kwargs)
+                with Span(self, name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        if callable(name_or_function):
+            return decorator(name_or_function)
+        return lambda function: decorator(function, name_or_function)
+
+    def reset(self):
+        """forgets the finished spans, spans open in other threads are still counted when they end"""
+        with self._lock:
+            states = list(self._states)
+        for state in states:
+            state.root.children = {}
+            state.events = []
+
+    def stats(self) -> List[DotDict]:
+        """
+        a row per span path, parents before their children, durations in microseconds.
+        `self_us` is the total minus the time in child spans, negative when children ran concurrently (tasks).
+        """
+        with self._lock:
+            states = list(self._states)
+        merged: Dict[PathType, List[_Node]] = {}
+        order: List[PathType] = []
+
+        def __collect(node: _Node, path: PathType):
+            for name, child in list(node.children.items()):
+                child_path = path + (name,)
+                nodes = merged.get(child_path)
+                if nodes is None:
+                    nodes = merged[child_path] = []
+                    order.append(child_path)
+                nodes.append(child)
+                __collect(child, child_path)
+
+        for state in states:
+            __collect(state.root, ())
+        # children under their parent, in the order they were first seen
+        position = {path: index for index, path in enumerate(order)}
+        order.sort(key=lambda path: [position[path[:length]] for length in range(1, len(path) + 1)])
+
+        rows = []
+        totals: Dict[PathType, int] = {}
+        children: Dict[PathType, int] = {}
+        for path in order:
+            nodes = [node for node in merged[path] if node.count]
+            if not nodes:
+                continue
+            count = sum(node.count for node in nodes)
+            total = totals[path] = sum(node.total for node in nodes)
+            children[path[:-1]] = children.get(path[:-1], 0) + total
+            samples = sorted(duration for node in nodes for duration in node.samples)
+            row = DotDict(path=path, name=path[-1], depth=len(path) - 1, count=count, total_us=total / 1e3,
+                          mean_us=total / count / 1e3, min_us=min(node.min for node in nodes) / 1e3,
+                          max_us=max(node.max for node in nodes) / 1e3)
+            for percent in PERCENTILES:
+                row[f'p{percent}_us'] = _percentile(samples, percent) / 1e3
+            rows.append(row)
+        for row in rows:
+            row.self_us = (totals[row.path] - children.get(row.path, 0)) / 1e3
+        return rows
+
+    def trace_events(self) -> List[dict]:
+        """the recorded spans as chrome trace events, a track per thread"""
+        with self._lock:
+            states = list(self._states)
+        pid = os.getpid()
+        events = trace_export.process_events()
+        for state in states:
+            events.append(trace_export.thread_name_event(pid, state.thread_id, state.thread_name))
+            for node, start, duration in list(state.events):
+                events.append(trace_export.complete_event(node.name, start / 1e3, duration / 1e3, pid, state.thread_id))
+        return events
+
+    def write_chrome_trace(self, path: str):
+        trace_export.write_chrome_trace(self.trace_events(), path)
+
+    def folded(self, threads: bool = False) -> Dict[PathType, int]:
+        """self time in microseconds by span path, under a frame per thread with `threads`"""
+        with self._lock:
+            states = list(self._states)
+        stacks: Dict[PathType, int] = {}
+
+        def __collect(node: _Node, path: PathType):
+            children = list(node.children.values())
+            if node.parent is not None:
+                value = (node.total - sum(child.total for child in children)) // 1000
+                stacks[path] = stacks.get(path, 0) + value
+            for child in children:
+                __collect(child, path + (child.name,))
+
+        for state in states:
+            __collect(state.root, (f'{state.thread_name} ({state.thread_id})',) if threads else ())
+        return stacks
+
+    def write_folded(self, path: str, threads: bool = False):
+        trace_export.write_folded(self.folded(threads), path)
+
+    def table(self, rows: List[DotDict] = None):
+        rows = self.stats() if rows is None else rows
+        table = Table()
+        table.set_titles('span', 'count', 'total', 'self', 'mean', 'min', *(f'p{percent}' for percent in PERCENTILES),
+                         'max')
+        for row in rows:
+            table.add_row('  ' * row.depth + row.name, str(row.count), f'{row.total_us:.1f} us',
+                          f'{row.self_us:.1f} us', f'{row.mean_us:.1f} us', f'{row.min_us:.1f} us',
+                          *(f'{row[f"p{percent}_us"]:.1f} us' for percent in PERCENTILES), f'{row.max_us:.1f} us')
+        return table
+
+    def print(self, file=sys.stdout):
+        self.table().print(file=file)
+
+
+# the one used by the library
+profiler = Profiler()
+span = profiler.span
+profile = profiler.profile
@@ -0,0 +1,173 @@
+import mmap
+import os
+import threading
+import time
+from os.path import join
+from typing import BinaryIO, Dict, Iterable, Tuple, Optional
+
+from library.file_lock import lock_fd
+from library.sio import BufferType
+
+SEGMENT_SUFFIX = '.seg'
+DEFAULT_SEGMENT_SIZE = 1 << 26
+
+LocationType = Tuple[int, int, int]
+
+
+class SegmentStore:
+    """
+    values appended to large `{hex}.seg` files, addressed by (segment, offset, length).
+    reads are memoryviews of a read only mmap, no copy is made.
+    a mapped segment stays valid while views of it are alive, even after it's removed.
+    every store appends to a new segment of its own, numbered by creation time & never reused,
+    and keeps it locked (shared) so other processes don't compact it away. a segment it rolled over stays locked
+    until the values appended to it are inserted, see `finish`.
+    """
+    __slots__ = ('_root_path', '_segment_size', '_active', '_active_file', '_active_size', '_maps', '_unfinished',
+                 '_retired', '_lock')
+
+    def __init__(self, root_path: str, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        self._root_path = root_path
+        self._segment_size = segment_size
+        self._maps: Dict[int, mmap.mmap] = {}
+        # segment -> values appended to it that aren't finished
+        self._unfinished: Dict[int, int] = {}
+        # segments rolled over with unfinished values, kept open (& locked)
+        self._retired: Dict[int, BinaryIO] = {}
+        self._lock = threading.Lock()
+        self._active = max(self.segments(), default=-1)
+        self._active_file = None
+        self._open_active()
+
+    def __format_path(self, segment: int):
+        return join(self._root_path, f'{hex(segment)[2:]}{SEGMENT_SUFFIX}')
+
+    def _open_active(self):
+        segment = max(time.time_ns(), self._active + 1)
+        while True:
+            path = self.__format_path(segment)
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o666)
+            except FileExistsError:
+                segment += 1
+                continue
+            # a compaction may have locked it, empty, before it was locked here: it's left to that compaction,
+            # which may be waiting for `_lock` to remove it
+            linked = lock_fd(fd, shared=True, blocking=False)
+            # or removed it already
+            try:
+                linked = linked and os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                linked = False
+            if linked:
+                break
+            os.close(fd)
+            segment += 1
+        self._active = segment
+        self._active_file = os.fdopen(fd, 'ab')
+        self._active_size = 0
+
+    @property
+    def active(self):
+        return self._active
+
+    def segments(self) -> Dict[int, int]:
+        """segment -> file size"""
+        result = {}
+        for name in os.listdir(self._root_path):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    segment = int(name[:-len(SEGMENT_SUFFIX)], 16)
+                except ValueError:
+                    continue
+                try:
+                    result[segment] = os.stat(join(self._root_path, name)).st_size
+                except FileNotFoundError:
+                    # removed by the compaction of another process meanwhile
+                    continue
+        return result
+
+    def roll(self):
+        """starts a new active segment"""
+        with self._lock:
+            self._roll()
+
+    def _roll(self):
+        if self._active in self._unfinished:
+            self._retired[self._active] = self._active_file
+        else:
+            self._active_file.close()
+        self._open_active()
+
+    def append(self, buffer: BufferType) -> LocationType:
+        """`finish` its segment once it's inserted (or given up), a compaction could remove it before that"""
+        length = len(buffer)
+        with self._lock:
+            if self._active_size and self._active_size + length > self._segment_size:
+                self._roll()
+            offset = self._active_size
+            self._active_file.write(buffer)
+            # visible to mmaps of this segment
+            self._active_file.flush()
+            self._active_size += length
+            self._unfinished[self._active] = self._unfinished.get(self._active, 0) + 1
+            return self._active, offset, length
+
+    def finish(self, segments: Iterable[int]):
+        """a segment per appended value"""
+        with self._lock:
+            for segment in segments:
+                count = self._unfinished[segment] - 1
+                if count:
+                    self._unfinished[segment] = count
+                    continue
+                del self._unfinished[segment]
+                retired = self._retired.pop(segment, None)
+                if retired is not None:
+                    retired.close()
+
+    def view(self, segment: int, offset: int, length: int) -> memoryview:
+        if length == 0:
+            return memoryview(b'')
+        end = offset + length
+        buffer = self._maps.get(segment)
+        if buffer is None or len(buffer) < end:
+            # new or grown since it was mapped
+            with open(self.__format_path(segment), 'rb') as infile:
+                buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(buffer) < end:
+                raise ValueError(f'segment {segment} is too short: {len(buffer)} < {end}')
+            self._maps[segment] = buffer
+        return memoryview(buffer)[offset:end]
+
+    def acquire(self, segment: int) -> Optional[int]:
+        """locks a segment for compaction, None while it's some store's active segment (or gone)"""
+        try:
+            fd = os.open(self.__format_path(segment), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        if not lock_fd(fd, blocking=False):
+            os.close(fd)
+            return None
+        return fd
+
+    def remove(self, segment: int):
+        with self._lock:
+            if segment == self._active:
+                self._roll()
+            # not closed, views may still refer to it
+            self._maps.pop(segment, None)
+            try:
+                os.remove(self.__format_path(segment))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self._lock:
+            for retired in self._retired.values():
+                retired.close()
+            self._retired.clear()
+            self._active_file.close()
+            if self._active_size == 0:
+                os.remove(self.__format_path(self._active))
+            self._maps.clear()
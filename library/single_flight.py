@@ -0,0 +1,74 @@
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Hashable, Awaitable
+
+
+class Flight:
+    __slots__ = 'done', 'result', 'error'
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """concurrent calls with the same key wait for the first one & share its result (or exception)"""
+    __slots__ = '_flights', '_lock'
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func(*args, **kwargs)
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class AsyncSingleFlight:
+    """
+    asyncio version of `SingleFlight`, per event loop. the computation runs as its own task,
+    so a cancelled caller doesn't cancel it for the others.
+    """
+    __slots__ = '_flights',
+
+    def __init__(self):
+        self._flights: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        flight_key = loop, key
+        task = self._flights.get(flight_key)
+        if task is None:
+            task = self._flights[flight_key] = loop.create_task(func(*args, **kwargs))
+
+            def __done(_):
+                if self._flights.get(flight_key) is task:
+                    del self._flights[flight_key]
+
+            task.add_done_callback(__done)
+        return await asyncio.shield(task)
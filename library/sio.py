@@ -72,7 +72,7 @@ CONTINUE_MASK = 0b1000_0000
 def __read_big_int_unsigned(infile: BinaryFile):
     byte = read_int(infile, 1, byteorder='big', signed=False)
     value = byte & VALUE_MASK
-    while value & CONTINUE_MASK:
+    while byte & CONTINUE_MASK:
         byte = read_int(infile, 1, byteorder='big', signed=False)
         value = (value << VALUE_BITS) | (byte & VALUE_MASK)
     return value
@@ -95,14 +95,7 @@ def read_big_int(infile: BinaryFile, signed: bool = True):
 
 
 def __count_unsigned_bits(value):
-    total = 8
-    while value & 0xFF00:
-        value >>= 8
-        total += 8
-    while value & 0x80 == 0:
-        value <<= 1
-        total -= 1
-    return total
+    return value.bit_length() or 1
 
 
 def __write_big_int_unsigned(outfile: BinaryFile, value: int):
@@ -113,7 +106,7 @@ def __write_big_int_unsigned(outfile: BinaryFile, value: int):
     # initial bits
     bits = __count_unsigned_bits(value)
     initial_bits = bits % VALUE_BITS
-    if initial_bits > 0:
+    if initial_bits > 0 and bits > VALUE_BITS:
         bits -= initial_bits
         total_write += _write_byte(CONTINUE_MASK | (value >> bits))
     # other 7 bits
@@ -221,6 +214,17 @@ class FileWrapper:
     def write_bytes(self, buffer: bytes):
         return self._file.write(buffer)
 
+    # read, write big bytes
+    def read_big_bytes(self):
+        size = read_big_int(self._file, signed=False)
+        buffer = self._file.read(size)
+        if len(buffer) != size:
+            raise EOFError(f'while reading {size} bytes')
+        return buffer
+
+    def write_big_bytes(self, buffer: bytes):
+        return write_method_bytes(self._file, buffer, lambda outfile, size: write_big_int(outfile, size, signed=False))
+
     @staticmethod
     def open(name, mode='r', buffering=-1, encoding=None, errors=None, newline=None, closefd=True, opener=None):
         file = open(name, mode=mode, buffering=buffering, encoding=encoding, errors=errors, newline=newline,
@@ -228,6 +232,54 @@ class FileWrapper:
         return FileWrapper(file)
 
 
+class ViewIO(io.RawIOBase):
+    """read only file over a buffer that isn't copied, `getbuffer()` returns it like `io.BytesIO` does"""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        return self._view
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        elif whence != io.SEEK_SET:
+            raise ValueError(f'unsupported whence: {whence}')
+        if offset < 0:
+            raise ValueError(f'negative seek position: {offset}')
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        data = self._view[self._position:self._position + len(buffer)]
+        memoryview(buffer).cast('B')[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def read(self, size: int = -1):
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = self._view[self._position:end].tobytes()
+        self._position += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+
 _BITS_IO_SIZE = 8
 
 
@@ -259,16 +311,13 @@ class BitsIO:
         return self
 
     def __next__(self):
-        if self._read_bits < self._data_bits:
+        while self._read_bits < self._data_bits:
             if self._index >= len(self._buffer):
                 raise StopIteration
-            new_read_bits = (len(self._buffer) - self._index) * 8
-            self._read_bits += new_read_bits
-            self._read_value = (self._read_value << new_read_bits) | from_bytes(
-                self._buffer[self._index: self._index + _BITS_IO_SIZE])
+            chunk = self._buffer[self._index: self._index + _BITS_IO_SIZE]
+            self._read_bits += len(chunk) * 8
+            self._read_value = (self._read_value << (len(chunk) * 8)) | from_bytes(chunk)
             self._index += _BITS_IO_SIZE
-            if self._read_bits < self._data_bits:
-                raise StopIteration
         self._read_bits -= self._data_bits
         value = self._read_value >> self._read_bits
         self._read_value &= bits_mask(self._read_bits)
@@ -276,3 +325,31 @@ class BitsIO:
 
     def remaining(self):
         return self._read_value
+
+
+class BitsWriter:
+    __slots__ = '_buffer', '_value', '_bits'
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._value = 0
+        self._bits = 0
+
+    @property
+    def bits(self):
+        return len(self._buffer) * 8 + self._bits
+
+    def write(self, value: int, bits: int):
+        self._value = (self._value << bits) | value
+        self._bits += bits
+        if self._bits >= _BITS_IO_SIZE * 8:
+            extra = self._bits % 8
+            self._buffer += (self._value >> extra).to_bytes((self._bits - extra) // 8, byteorder='big')
+            self._value &= bits_mask(extra)
+            self._bits = extra
+
+    def getvalue(self):
+        if self._bits == 0:
+            return bytes(self._buffer)
+        padding = -self._bits % 8
+        return bytes(self._buffer) + to_bytes(self._value << padding, (self._bits + padding) // 8)
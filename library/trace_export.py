@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+from typing import Dict, Iterable, List, Tuple
+
+# `Trace Event Format`, the json that chrome://tracing & https://ui.perfetto.dev open
+trace_json_setting = {
+    'allow_nan': False,
+    'separators': (',', ':')
+}
+
+StackType = Tuple[str, ...]
+
+
+def complete_event(name: str, start_us: float, duration_us: float, pid: int, tid: int, args: dict = None):
+    """a span, from its start to its end, nested in the spans of its thread that contain it"""
+    event = {'name': name, 'ph': 'X', 'ts': start_us, 'dur': duration_us, 'pid': pid, 'tid': tid}
+    if args:
+        event['args'] = args
+    return event
+
+
+def process_name_event(pid: int, name: str):
+    return {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': name}}
+
+
+def thread_name_event(pid: int, tid: int, name: str):
+    return {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+
+
+def process_events(name: str = None):
+    """names the track of this process"""
+    return [process_name_event(os.getpid(), name or f'{os.path.basename(sys.argv[0] or "python")} {os.getpid()}')]
+
+
+def write_chrome_trace(events: Iterable[dict], path: str):
+    with open(path, 'wt') as outfile:
+        json.dump({'traceEvents': list(events), 'displayTimeUnit': 'ns'}, outfile, **trace_json_setting)
+
+
+def read_chrome_trace(path: str) -> List[dict]:
+    """the events of a trace file, in the object or the array form"""
+    with open(path, 'rt') as infile:
+        data = json.load(infile)
+    return data['traceEvents'] if isinstance(data, dict) else data
+
+
+def merge_chrome_traces(paths: Iterable[str], path: str):
+    """one trace of the traces of several processes, they keep their own tracks by their pids"""
+    events = []
+    for source in paths:
+        events.extend(read_chrome_trace(source))
+    write_chrome_trace(events, path)
+
+
+def write_folded(stacks: Dict[StackType, int], path: str):
+    """
+    a line per stack, `outer;inner;leaf value`, the input of flamegraph.pl, inferno, speedscope, ...
+    the names can't have `;` or new lines, they're replaced.
+    """
+    with open(path, 'wt') as outfile:
+        for stack, value in stacks.items():
+            if value > 0:
+                names = ';'.join(name.replace(';', ':').replace('\n', ' ') for name in stack)
+                print(f'{names} {value}', file=outfile)
@@ -1,9 +1,13 @@
+import os
 import re
 import sys
+import threading
 import time
 from collections import deque
 from typing import Callable, Iterable, Any
 
+from library import trace_export
+
 EXIT_NORMAL = 0
 EXIT_ERROR = 1
 EXIT_ARGUMENT_ERROR = 2
@@ -149,29 +153,39 @@ class StopWatch:
 
 
 class StopWatchLogger:
-    __slots__ = '_now', '_start_time', '_laps', '_format'
+    __slots__ = '_now', '_start_time', '_laps', '_thread_ids', '_lock', '_format'
 
     def __init__(self, start: bool = False, now: Callable[[], Any] = None, time_format: str = None):
         self._now = now or _default_time_func
-        self._start_time = now() if start else 0
+        self._start_time = self._now() if start else 0
         self._laps = deque()
+        # of the laps, for the exports
+        self._thread_ids = deque()
+        self._lock = threading.Lock()
         self._format = time_format or _default_time_format
 
     def start(self):
         self._start_time = self._now()
 
     def lap(self, message: str):
-        self._laps.append((self._now(), message))
+        with self._lock:
+            self._laps.append((self._now(), message))
+            self._thread_ids.append(threading.get_native_id())
 
     @property
     def laps(self):
         return self._laps
 
+    @property
+    def thread_ids(self):
+        """the thread of each lap"""
+        return self._thread_ids
+
     @property
     def differences(self):
         last = self._start_time
         result = list()
-        for _next in self._laps:
+        for _next, log in self._laps:
             result.append(_next - last)
             last = _next
         return result
@@ -181,3 +195,34 @@ class StopWatchLogger:
         for num, (lap, log) in enumerate(self._laps, 1):
             print(f'{lap - start:{self._format}}: {log}', file=file)
             start = lap
+
+    def __spans(self):
+        """`(start, end, message, thread id)`, a lap of a thread starts at the previous lap of that thread"""
+        with self._lock:
+            laps = list(zip(self._laps, self._thread_ids))
+        first = self._start_time or (laps[0][0][0] if laps else 0)
+        last = {}
+        for (_next, log), thread_id in laps:
+            yield last.get(thread_id, first), _next, log, thread_id
+            last[thread_id] = _next
+
+    def trace_events(self, scale: float = 1e6):
+        """chrome trace events, a track per thread. `scale` turns the times into microseconds, seconds by default"""
+        pid = os.getpid()
+        events = trace_export.process_events()
+        for start, end, log, thread_id in self.__spans():
+            events.append(trace_export.complete_event(log, start * scale, (end - start) * scale, pid, thread_id))
+        return events
+
+    def write_chrome_trace(self, path: str, scale: float = 1e6):
+        trace_export.write_chrome_trace(self.trace_events(scale), path)
+
+    def folded(self, scale: float = 1e6):
+        """total microseconds by message"""
+        stacks = {}
+        for start, end, log, thread_id in self.__spans():
+            stacks[(log,)] = stacks.get((log,), 0) + round((end - start) * scale)
+        return stacks
+
+    def write_folded(self, path: str, scale: float = 1e6):
+        trace_export.write_folded(self.folded(scale), path)
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+import pytest
+
+from library.cache_folder import CacheFolder, title_key
+
+
+@pytest.mark.parametrize('packed', [False, True], ids=['files', 'packed'])
+def test_reopening_with_the_other_layout_fails(packed):
+    root_path = tempfile.mkdtemp()
+    with CacheFolder(root_path, packed=packed) as folder:
+        folder.put(title_key('a'), b'value')
+    with pytest.raises(ValueError, match='unsupported layout'):
+        CacheFolder(root_path, packed=not packed)
+    with CacheFolder(root_path, packed=packed) as folder:
+        folder.compact()
+        assert bytes(folder.get(title_key('a'))) == b'value'
+    with pytest.raises(ValueError):
+        CacheFolder(root_path, packed=not packed)
+
+
+def test_empty_folder_records_its_layout():
+    root_path = tempfile.mkdtemp()
+    CacheFolder(root_path, packed=True).close()
+    assert os.path.exists(os.path.join(root_path, 'container.bin'))
+    with pytest.raises(ValueError):
+        CacheFolder(root_path)
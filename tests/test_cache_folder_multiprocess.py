@@ -0,0 +1,103 @@
+"""
+many processes against one cache folder: they put, get, delete & compact the same keys at once.
+a value starts with its key, so a read of another key's value (or of a half written one) is caught.
+"""
+import multiprocessing
+import os
+import random
+import tempfile
+import traceback
+
+import pytest
+
+from library.cache_folder import CacheFolder, title_key
+from library.cache_index import TEMP_SUFFIX
+from library.segment_store import SEGMENT_SUFFIX
+
+PROCESSES = 8
+STEPS = 400
+KEYS = 64
+
+
+def _value(number: int, version: int):
+    # sizes vary so segments roll & values move between them
+    header = f'k{number}:{version}:'.encode()
+    return header + bytes([number]) * (16 + (number * 37 + version) % 2000)
+
+
+def _check(number: int, value) -> bool:
+    value = bytes(value)
+    name, sep, rest = value.partition(b':')
+    if name != f'k{number}'.encode():
+        return False
+    version, sep, body = rest.partition(b':')
+    return value == _value(number, int(version))
+
+
+def _worker(root_path: str, seed: int, packed: bool, results):
+    rnd = random.Random(seed)
+    wrong = reads = 0
+    try:
+        with CacheFolder(root_path, compact_threshold=50, packed=packed, segment_size=1 << 15) as folder:
+            for step in range(STEPS):
+                number = rnd.randrange(KEYS)
+                key = title_key(f'k{number}')
+                action = rnd.random()
+                if action < 0.45:
+                    value = folder.get(key)
+                    if value is not None:
+                        reads += 1
+                        if not _check(number, value):
+                            wrong += 1
+                elif action < 0.85:
+                    folder.put(key, _value(number, rnd.randrange(1000)))
+                elif action < 0.95:
+                    folder.delete(key)
+                elif packed and action < 0.98:
+                    folder.compact_segments(0.2)
+                else:
+                    folder.compact()
+        results.put((seed, wrong, reads, None))
+    except BaseException:
+        results.put((seed, wrong, reads, traceback.format_exc()))
+
+
+@pytest.mark.parametrize('packed', [False, True], ids=['files', 'packed'])
+def test_processes_share_a_folder(packed):
+    root_path = tempfile.mkdtemp()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_worker, args=(root_path, seed, packed, results))
+                 for seed in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    reports = [results.get(timeout=300) for process in processes]
+    for process in processes:
+        process.join()
+
+    for seed, wrong, reads, error in reports:
+        assert error is None, f'worker {seed} failed:\n{error}'
+        assert wrong == 0, f'worker {seed} read {wrong} wrong values of {reads}'
+    assert all(process.exitcode == 0 for process in processes)
+    assert sum(reads for seed, wrong, reads, error in reports) > 0
+
+    with CacheFolder(root_path, packed=packed) as folder:
+        entries = dict(folder._index.items())
+        for key, entry in entries.items():
+            assert _check(int(key[1][1:]), folder.get(key))
+        if packed:
+            # nothing is dead after a full compaction, so every segment left holds a live value
+            folder.compact_segments(0)
+            segments = {entry.file_index for key, entry in dict(folder._index.items()).items()}
+        else:
+            data_names = {f'{hex(entry.file_index)[2:]}.data' for entry in entries.values()}
+
+    names = os.listdir(root_path)
+    assert not [name for name in names if name.endswith(TEMP_SUFFIX)]
+    if packed:
+        assert not [name for name in names if name.endswith('.data')]
+        orphans = [name for name in names
+                   if name.endswith(SEGMENT_SUFFIX) and int(name[:-len(SEGMENT_SUFFIX)], 16) not in segments]
+        assert not orphans, f'segments without live values: {orphans}'
+    else:
+        assert {name for name in names if name.endswith('.data')} == data_names
+        assert not [name for name in names if name.endswith(SEGMENT_SUFFIX)]
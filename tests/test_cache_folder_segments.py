@@ -0,0 +1,61 @@
+"""
+`compact_segments` while values are inserted: nothing may be left referring to a removed segment.
+"""
+import os
+import tempfile
+
+from library.cache_folder import CacheFolder, title_key
+from library.cache_index import CacheIndex
+from library.segment_store import SEGMENT_SUFFIX
+
+
+def test_compaction_moves_values_inserted_meanwhile(monkeypatch):
+    root_path = tempfile.mkdtemp()
+    value = b'shared value ' * 64
+    first, second = title_key('first'), title_key('second')
+    with CacheFolder(root_path, packed=True, deduplicate=True) as folder:
+        folder.put(first, value)
+        old = folder._index.get(first).file_index
+        folder._segments.roll()
+        replace = CacheIndex.replace
+
+        def __replace(index, key, entry, moved):
+            if folder.get(second) is None:
+                # an equal value refers to the place of `first`, which isn't moved yet
+                folder.put(second, value)
+                assert folder._index.get(second).file_index == old
+            return replace(index, key, entry, moved)
+
+        monkeypatch.setattr(CacheIndex, 'replace', __replace)
+        assert folder.compact_segments(0).segments == 1
+        monkeypatch.undo()
+
+        assert bytes(folder.get(first)) == value
+        assert bytes(folder.get(second)) == value
+        segments = {int(name[:-len(SEGMENT_SUFFIX)], 16) for name in os.listdir(root_path)
+                    if name.endswith(SEGMENT_SUFFIX)}
+        assert old not in segments
+        assert all(entry.file_index in segments for key, entry in folder._index.items())
+
+
+def test_compaction_waits_for_appended_values(monkeypatch):
+    root_path = tempfile.mkdtemp()
+    key = title_key('key')
+    with CacheFolder(root_path, packed=True) as folder:
+        insert_many = CacheIndex.insert_many
+
+        def __insert_many(index, items):
+            # its segment is rolled over & compacted between the append & the insert
+            items = list(items)
+            folder._segments.roll()
+            assert folder.compact_segments(0).segments == 0
+            return insert_many(index, items)
+
+        monkeypatch.setattr(CacheIndex, 'insert_many', __insert_many)
+        folder.put(key, b'value')
+        monkeypatch.undo()
+
+        assert bytes(folder.get(key)) == b'value'
+        # inserted now, so it's moved
+        assert folder.compact_segments(0).segments == 1
+        assert bytes(folder.get(key)) == b'value'
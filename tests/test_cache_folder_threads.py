@@ -0,0 +1,76 @@
+"""
+threads of one process on one cache folder: some get while others delete & put again, so freed file indexes are
+reused under the readers. a value starts with its key, so a read of another key's value is caught.
+"""
+import random
+import tempfile
+import threading
+
+import pytest
+
+from library.cache_folder import CacheFolder, title_key
+
+THREADS = 6
+STEPS = 1500
+KEYS = 40
+
+
+def _value(number: int, version: int):
+    return f'k{number}:{version}:'.encode() + bytes([number]) * (64 + (number * 37 + version) % 512)
+
+
+def _check(number: int, value) -> bool:
+    value = bytes(value)
+    if not value.startswith(f'k{number}:'.encode()):
+        return False
+    return value == _value(number, int(value.split(b':')[1]))
+
+
+@pytest.mark.parametrize('options', [{}, {'compression': 'zlib'}, {'bloom_fp_rate': 0.01}, {'max_size': 1 << 14}],
+                         ids=['plain', 'zlib', 'bloom', 'max_size'])
+def test_gets_while_deleting_and_putting(options):
+    root_path = tempfile.mkdtemp()
+    errors = []
+    wrong = []
+    reads = [0] * THREADS
+
+    with CacheFolder(root_path, **options) as folder:
+        def __work(index: int):
+            rnd = random.Random(index)
+            try:
+                for step in range(STEPS):
+                    number = rnd.randrange(KEYS)
+                    key = title_key(f'k{number}')
+                    action = rnd.random()
+                    if action < 0.5:
+                        if action < 0.3:
+                            values = {number: folder.get(key)}
+                        elif action < 0.4:
+                            numbers = rnd.sample(range(KEYS), 4)
+                            found = folder.get_many([title_key(f'k{number}') for number in numbers])
+                            values = {number: found.get(title_key(f'k{number}')) for number in numbers}
+                        else:
+                            out = bytearray(1024)
+                            size = folder.read_into(key, out)
+                            values = {number: None if size is None else out[:size]}
+                        for number, value in values.items():
+                            if value is not None:
+                                reads[index] += 1
+                                if not _check(number, value):
+                                    wrong.append((number, bytes(value)[:16]))
+                    elif action < 0.8:
+                        folder.put(key, _value(number, rnd.randrange(1000)))
+                    else:
+                        folder.delete(key)
+            except BaseException as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=__work, args=(index,)) for index in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert not errors
+    assert not wrong, f'{len(wrong)} wrong values of {sum(reads)}: {wrong[:5]}'
+    assert sum(reads) > 0
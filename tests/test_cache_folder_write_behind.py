@@ -0,0 +1,73 @@
+"""
+`write_behind`: a value is queued, then written & inserted by the background writer while puts & deletes go on.
+"""
+import os
+import tempfile
+import threading
+
+import pytest
+
+from library.cache_folder import CacheFolder, ReadWriteWrapper, title_key
+
+
+class _SlowWrite:
+    """a `ReadWriteWrapper` whose writes wait for `release`"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.rw = ReadWriteWrapper(lambda wrapper: wrapper.file.read().decode(), self.__write)
+
+    def __write(self, wrapper, value: str):
+        self.started.set()
+        assert self.release.wait(10)
+        wrapper.file.write(value.encode())
+
+
+@pytest.mark.parametrize('options', [{}, {'packed': True}, {'deduplicate': True}],
+                         ids=['files', 'packed', 'deduplicate'])
+def test_delete_during_persist(options):
+    root_path = tempfile.mkdtemp()
+    slow = _SlowWrite()
+    key = title_key('k')
+    with CacheFolder(root_path, write_behind=8, **options) as folder:
+        folder.put(key, 'value', slow.rw)
+        assert slow.started.wait(10)
+        folder.delete(key)
+        assert folder.get(key, slow.rw) is None
+        slow.release.set()
+        folder.flush()
+        assert folder.get(key, slow.rw) is None
+        assert len(folder._index) == 0
+    # the written data isn't left behind
+    assert not [name for name in os.listdir(root_path) if name.endswith(('.data', '.blob'))]
+
+
+class _RacingPending(dict):
+    """pending values where the writer's cleanup lets a put of `value` run first, once"""
+
+    def __init__(self, folder: CacheFolder, value: bytes):
+        super().__init__()
+        self.folder = folder
+        self.value = value
+        self.put = None
+
+    def __delitem__(self, key):
+        if self.put is None:
+            self.put = threading.Thread(target=self.folder.put, args=(key, self.value))
+            self.put.start()
+            # it waits for the cleanup, unless that isn't guarded
+            self.put.join(0.5)
+        super().__delitem__(key)
+
+
+def test_put_during_writer_cleanup():
+    root_path = tempfile.mkdtemp()
+    key = title_key('k')
+    with CacheFolder(root_path, write_behind=8) as folder:
+        pending = folder._pending = _RacingPending(folder, b'second')
+        folder.put(key, b'first')
+        folder.flush()
+        pending.put.join()
+        folder.flush()
+        assert bytes(folder.get(key)) == b'second'
@@ -0,0 +1,56 @@
+import io
+import json
+import os
+import pickle
+import tempfile
+
+import pytest
+
+from library.cache_folder import CacheFolder, title_key
+from library.cache_migration import LEGACY_INFO_NAME, _JsonReader, legacy_path, legacy_read_write, migrate_data_cache
+
+DOCUMENT = {'numbers': [1.5e3, -12345678901234567890, 0.000125, 7, -0.5, 3e-7], 'text': 'a "b" é', 'flag': True}
+
+
+def _read(text: str, chunk_size: int):
+    reader = _JsonReader(io.StringIO(text), chunk_size)
+    reader.expect('{')
+    result = {}
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if reader.peek() == '[':
+            reader.expect('[')
+            values = result[name] = []
+            while True:
+                values.append(reader.value())
+                if reader.expect(',]') == ']':
+                    break
+        else:
+            result[name] = reader.value()
+        if reader.expect(',}') == '}':
+            return result
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64])
+def test_values_split_across_chunks(chunk_size):
+    for separators in ((',', ':'), (', ', ': ')):
+        assert _read(json.dumps(DOCUMENT, separators=separators), chunk_size) == DOCUMENT
+
+
+def test_migrate_links_the_data_files():
+    legacy_dir = tempfile.mkdtemp()
+    titles = {f'title {number}': number for number in range(20)}
+    for title, number in titles.items():
+        with open(legacy_path(legacy_dir, number), 'wb') as outfile:
+            pickle.dump(title, outfile)
+    with open(os.path.join(legacy_dir, LEGACY_INFO_NAME), 'wt') as outfile:
+        json.dump({'titles': titles, 'max_index': 19}, outfile)
+
+    rw = legacy_read_write((pickle.load, pickle.dump))
+    with CacheFolder(tempfile.mkdtemp()) as folder:
+        result = migrate_data_cache(legacy_dir, folder)
+        assert (result.files, result.missing) == (20, 0)
+        for title in titles:
+            assert folder.get(title_key(title), rw) == title
+    assert os.stat(legacy_path(legacy_dir, 0)).st_nlink == 2
@@ -0,0 +1,41 @@
+import asyncio
+
+from library.profiler import Profiler
+
+
+def test_profile_nests_spans():
+    profiler = Profiler()
+
+    @profiler.profile
+    def work():
+        with profiler.span('inner'):
+            pass
+
+    work()
+    work()
+    name = work.__qualname__
+    rows = {row.path: row for row in profiler.stats()}
+    assert rows[(name,)].count == 2
+    assert rows[(name, 'inner')].count == 2
+    assert ('inner',) not in rows
+
+
+def test_profile_awaits_coroutines():
+    profiler = Profiler()
+
+    @profiler.profile('work')
+    async def work(delay: float):
+        with profiler.span('inner'):
+            await asyncio.sleep(delay)
+        return delay
+
+    async def main():
+        return await asyncio.gather(work(0.05), work(0.05))
+
+    assert asyncio.run(main()) == [0.05, 0.05]
+    rows = {row.path: row for row in profiler.stats()}
+    assert ('inner',) not in rows
+    assert rows[('work',)].count == 2
+    assert rows[('work', 'inner')].count == 2
+    assert rows[('work',)].min_us >= 45_000
+    assert rows[('work', 'inner')].min_us >= 45_000